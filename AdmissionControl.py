@@ -0,0 +1,102 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+"""
+Capacity limits of RTSP server
+
+New sessions are refused when a limit is reached, so admitted viewers keep their streams
+and quality, instead of everybody getting a worse service
+"""
+
+
+class AdmissionControl:
+    """
+    Checks new sessions and stream openings against configured limits
+    Every limit is disabled if it is None
+    """
+    def __init__(self, max_sessions=None, max_sessions_per_ip=None, max_transcodes=None, max_bitrate=None):
+        """
+        :param max_sessions:int maximum number of sessions
+        :param max_sessions_per_ip:int maximum number of sessions from a single client address
+        :param max_transcodes:int maximum number of streams being opened at once. Opening a still
+                image transcodes it, unless it is cached
+        :param max_bitrate:int maximum aggregate egress, in bits per second. It is estimated from
+                bytes per frame and framerate of each session
+        """
+        self.max_sessions = max_sessions
+        self.max_sessions_per_ip = max_sessions_per_ip
+        self.max_transcodes = max_transcodes
+        self.max_bitrate = max_bitrate
+        # Number of streams being opened right now
+        self.transcodes = 0
+        # Number of refused sessions. It is counted by the server, once per refused SETUP, since checks
+        # are repeated for the same viewer by DESCRIBE and SETUP
+        self.refused = 0
+
+    @staticmethod
+    def session_bitrate(stream, variant=None):
+        """
+        Estimates egress of a single session
+        :param stream:RtpFrameGenerator
+        :param variant: stream variant of the session
+        :return:float bits per second
+        """
+        return stream.frame_size(variant) * 8.0 * stream.fps
+
+    def bitrate(self, clients):
+        """
+        :param clients:iterable of ClientInfo with opened streams
+        :return:float estimated egress of all the sessions, in bits per second
+        """
+        return sum(self.session_bitrate(client.stream, client.quality)
+                   for client in clients if client.stream is not None)
+
+    def _refuse(self, reason):
+        logger.warn("Refusing a session: %s" % reason)
+        return reason
+
+    def check_session(self, address, clients):
+        """
+        Checks if one more session can be started
+        :param address:string client IP address
+        :param clients:collection of ClientInfo of existing sessions
+        :return:string reason of refusal, or None if session is admitted
+        """
+        if self.max_sessions is not None and len(clients) >= self.max_sessions:
+            return self._refuse("%d sessions are open already" % len(clients))
+        if self.max_sessions_per_ip is not None:
+            count = sum(1 for client in clients if client.address == address)
+            if count >= self.max_sessions_per_ip:
+                return self._refuse("%s has %d sessions already" % (address, count))
+        return None
+
+    def check_bitrate(self, client, variant, clients):
+        """
+        Checks if the session fits the egress limit
+        :param client:ClientInfo of the new session, with its stream
+        :param variant: requested stream variant
+        :param clients:collection of ClientInfo of all sessions
+        :return:string reason of refusal, or None if session is admitted
+        """
+        if self.max_bitrate is None or client.stream is None:
+            return None
+        others = self.bitrate(other for other in clients if other is not client)
+        wanted = self.session_bitrate(client.stream, variant)
+        if others + wanted > self.max_bitrate:
+            return self._refuse("%.0f kbit/s on top of %.0f kbit/s would exceed %.0f kbit/s" %
+                                (wanted / 1000, others / 1000, self.max_bitrate / 1000))
+        return None
+
+    def begin_transcode(self):
+        """
+        Takes a slot for opening a stream
+        :return:string reason of refusal, or None if stream can be opened
+        """
+        if self.max_transcodes is not None and self.transcodes >= self.max_transcodes:
+            return self._refuse("%d streams are being opened already" % self.transcodes)
+        self.transcodes += 1
+        return None
+
+    def end_transcode(self):
+        self.transcodes -= 1
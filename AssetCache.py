@@ -0,0 +1,217 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threading import Lock, Thread, get_ident
+from time import time
+import hashlib
+import logging
+import os
+
+from JpegFile import JpegFile
+from JpegRtpStillStream import RtpJpegEncoder, encode_variants
+from Timing import stages
+
+logger = logging.getLogger(__name__)
+
+"""
+Cache of transcoded and packetized jpeg assets
+
+Every asset is transcoded once and saved to the disk cache as standard jpegs, one per quality.
+Assets, that fit the memory budget, are kept resident together with their RTP payloads.
+The rest of them are read back from the disk cache, that costs just a header parse and packetizing
+"""
+
+
+def prewarm_asset(path, qualities, frame_budget, packet_size):
+    """
+    Transcodes and packetizes a jpeg. It is run inside prewarm workers
+    :param path:string path to jpeg file
+    :param qualities:list of int jpeg qualities
+    :param frame_budget:int maximum size of encoded frame, or None
+    :param packet_size:int desired RTP packet size
+    :return:tuple (list of tuples (quality, bytes jpeg, payloads), float seconds spent)
+    """
+    start = time()
+    with stages.time('file_read'), open(path, 'rb') as file:
+        raw_data = file.read()
+    encoder = RtpJpegEncoder()
+    result = []
+    for quality, used_quality, data in encode_variants(raw_data, qualities, frame_budget, packet_size):
+        jpeg = JpegFile()
+        jpeg.load_data(data)
+        result.append((quality, data, encoder.packetize(jpeg, packet_size)))
+    return result, time() - start
+
+
+def encoded_size(encoded):
+    """
+    Calculates memory, used by encoded variants
+    :param encoded:list of tuples (quality, bytes jpeg, payloads)
+    :return:int number of bytes
+    """
+    total = 0
+    for quality, data, payloads in encoded:
+        total += len(data)
+        if payloads:
+            total += sum(len(payload) for payload in payloads)
+    return total
+
+
+class AssetCache:
+    """
+    Two-level cache of encoded jpeg variants: memory with a budget, and a directory on the disk
+    """
+    def __init__(self, cache_dir, qualities, frame_budget=None, packet_size=1000, memory_budget=256 << 20):
+        """
+        :param cache_dir:string directory for transcoded jpegs. It is created if missing
+        :param qualities:list of int jpeg qualities of each asset
+        :param frame_budget:int maximum size of encoded frame, or None
+        :param packet_size:int RTP packet size, used for packetizing
+        :param memory_budget:int number of bytes, that resident assets can use
+        """
+        self._cache_dir = cache_dir
+        self._qualities = sorted(set(qualities))
+        self._frame_budget = frame_budget
+        self._packet_size = packet_size
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self._lock = Lock()
+        # Maps path->encoded variants, that are kept in memory
+        self._resident = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+        # Statistics
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _variant_path(self, path, quality):
+        """
+        Gets path of a cached variant. Its name depends on the file version and encoding settings,
+        so the outdated variants are never picked
+        """
+        stats = os.stat(path)
+        key = '%s:%d:%d:%s:%s:%d' % (os.path.realpath(path), stats.st_size, stats.st_mtime_ns,
+                                     self._qualities, self._frame_budget, self._packet_size)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_dir, '%s-q%d.jpg' % (digest, quality))
+
+    def load(self, path):
+        """
+        Gets encoded variants of an asset
+        :param path:string path to source jpeg
+        :return:list of tuples (quality, bytes jpeg, payloads or None), or None if asset is not cached
+        """
+        with self._lock:
+            encoded = self._resident.get(path)
+            if encoded is not None:
+                self._resident.move_to_end(path)
+                self.memory_hits += 1
+                return encoded
+
+        encoded = []
+        try:
+            for quality in self._qualities:
+                with open(self._variant_path(path, quality), 'rb') as file:
+                    encoded.append((quality, file.read(), None))
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        return encoded
+
+    def discard(self, path):
+        """
+        Drops resident variants of a changed or removed asset. Outdated files on the disk are never
+        picked, since their names depend on the file version
+        """
+        with self._lock:
+            encoded = self._resident.pop(path, None)
+            if encoded is not None:
+                self.memory_used -= encoded_size(encoded)
+
+    def store(self, path, encoded, evict=True):
+        """
+        Saves encoded variants to the disk cache, and keeps them in memory if the budget allows
+        :param path:string path to source jpeg
+        :param encoded:list of tuples (quality, bytes jpeg, payloads or None)
+        :param evict:bool evict the least recently used assets to free memory. Otherwise asset is kept
+                only on the disk, if it does not fit
+        :return:bool True if asset is resident. Asset, whose source is gone, is skipped
+        """
+        try:
+            variant_paths = [(self._variant_path(path, quality), data) for quality, data, payloads in encoded]
+        except (IOError, OSError) as e:
+            # Source is removed or replaced by now, so its variants would never be picked
+            logger.warn("Skipping %s: %s" % (path, str(e)))
+            return False
+
+        for variant_path, data in variant_paths:
+            try:
+                # Writing to a temporary file, so readers never see a partial jpeg. Its name is unique,
+                # since server processes and their threads can store the same asset at once
+                temp_path = '%s.%d-%d.tmp' % (variant_path, os.getpid(), get_ident())
+                with open(temp_path, 'wb') as file:
+                    file.write(data)
+                os.replace(temp_path, variant_path)
+            except (IOError, OSError) as e:
+                logger.warn("Failed to cache %s: %s" % (variant_path, str(e)))
+
+        size = encoded_size(encoded)
+        with self._lock:
+            if path in self._resident:
+                return True
+            if size > self.memory_budget:
+                return False
+            while evict and self._resident and self.memory_used + size > self.memory_budget:
+                old_path, old = self._resident.popitem(last=False)
+                self.memory_used -= encoded_size(old)
+                logger.debug("Evicted %s from memory", old_path)
+            if self.memory_used + size > self.memory_budget:
+                return False
+            self._resident[path] = encoded
+            self.memory_used += size
+            return True
+
+    def prewarm(self, paths, workers=None):
+        """
+        Transcodes and packetizes assets in a pool of processes
+        :param paths:list of paths to jpeg files
+        :param workers:int number of processes. os.cpu_count() is used if None
+        :return:int number of prepared assets
+        """
+        start = time()
+        done = 0
+        # Assets from the disk cache are not transcoded again
+        pending = [path for path in paths if self.load(path) is None]
+        logger.info("Prewarming %d assets, %d are cached already" % (len(pending), len(paths) - len(pending)))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for path in pending:
+                future = executor.submit(prewarm_asset, path, self._qualities, self._frame_budget, self._packet_size)
+                futures[future] = path
+            for future in as_completed(futures):
+                path = futures[future]
+                done += 1
+                if future.exception() is not None:
+                    logger.error("[%d/%d] Failed to prewarm %s: %s" %
+                                 (done, len(pending), path, str(future.exception())))
+                    continue
+                encoded, elapsed = future.result()
+                # Assets, prewarmed earlier, are as good as the later ones
+                in_memory = self.store(path, encoded, evict=False)
+                logger.info("[%d/%d] Prewarmed %s in %.3fs: %d bytes, %s" %
+                            (done, len(pending), path, elapsed, encoded_size(encoded),
+                             'resident' if in_memory else 'on disk'))
+
+        logger.info("Prewarm is done in %.3fs. %d of %d bytes of memory budget are used" %
+                    (time() - start, self.memory_used, self.memory_budget))
+        return done
+
+    def start_prewarm(self, paths, workers=None):
+        """
+        Runs prewarm in a background thread, so the server accepts connections meanwhile
+        """
+        thread = Thread(target=self.prewarm, args=(paths, workers))
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,341 @@
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+import logging
+import mmap
+import os
+
+from JpegFile import JpegFile
+from JpegRtpStillStream import rtp_incompatibility
+from RtpFrameGenerator import RtpFrameGenerator
+from VideoStream import IndexedVideoFile
+from sdp_utils import make_sdp2
+
+logger = logging.getLogger(__name__)
+
+"""
+Catalog of media files, that can be streamed
+
+Files are probed once at startup. Only jpeg markers are parsed, nothing is decoded.
+RTSP server answers DESCRIBE and 404 from the catalog, without touching the disk
+"""
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+VIDEO_EXTENSIONS = ('.mjpeg', '.mjpg')
+PLAYLIST_EXTENSIONS = ('.m3u', '.m3u8')
+
+
+def is_playlist(path):
+    """
+    Playlist is either a directory with jpegs, or an .m3u file
+    """
+    return path.lower().endswith(PLAYLIST_EXTENSIONS) or os.path.isdir(path)
+
+
+def source_file(root, path):
+    """
+    Maps URL path to a file under the root directory
+    :param root:string directory with media files
+    :param path:string URL path, starting with '/'
+    :return:string path to the file
+    raises IOError if the path leads outside the root, by '..' or a symlink
+    """
+    file = os.path.join(root, path.lstrip('/'))
+    real_root = os.path.realpath(root)
+    real_file = os.path.realpath(file)
+    if real_file != real_root and not real_file.startswith(os.path.join(real_root, '')):
+        raise IOError("Path %s is outside of %s" % (path, root))
+    return file
+
+
+def read_playlist(path):
+    """
+    Lists images of a playlist
+    Directory lists its own jpegs, in name order. M3U lists paths relative to itself, and
+    #EXTINF:<seconds>,<title> line sets the duration of the next item
+    :param path:string path to a directory or .m3u file
+    :return:list of tuples (path to jpeg, float duration or None)
+    """
+    if os.path.isdir(path):
+        return [(os.path.join(path, name), None) for name in sorted(os.listdir(path))
+                if name.lower().endswith(JPEG_EXTENSIONS) and os.path.isfile(os.path.join(path, name))]
+
+    result = []
+    base = os.path.dirname(path)
+    duration = None
+    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                try:
+                    duration = float(line[len('#EXTINF:'):].split(',', 1)[0])
+                except ValueError:
+                    duration = None
+                if duration is not None and duration <= 0:
+                    duration = None
+                continue
+            if not line or line.startswith('#'):
+                continue
+            if line.lower().endswith(JPEG_EXTENSIONS):
+                result.append((os.path.join(base, line), duration))
+            else:
+                logger.warn("Skipping %s in playlist %s: not a jpeg" % (line, path))
+            duration = None
+    return result
+
+
+class AssetInfo(object):
+    """
+    Properties of a media file, collected from its headers
+    """
+    __slots__ = ('path', 'size', 'mtime', 'kind', 'width', 'height', 'components', 'sampling', 'progressive',
+                 'reset_interval', 'standard_tables', 'rtp_incompatibility', 'frames', 'error')
+
+    def __init__(self, path, kind):
+        """
+        :param path:string path to the file
+        :param kind:string 'jpeg', 'video' or 'playlist'
+        """
+        self.path = path
+        self.kind = kind
+        self.size = 0
+        self.mtime = 0
+        self.width = 0
+        self.height = 0
+        self.components = 0
+        # Sampling factors of luma component (h, v)
+        self.sampling = None
+        self.progressive = False
+        self.reset_interval = 0
+        self.standard_tables = False
+        # Reason, why frames should be transcoded before packetizing, or None
+        self.rtp_incompatibility = None
+        # Number of frames. Still jpeg has just one, playlist has one per image
+        self.frames = 0
+        # Reason, why the file can not be streamed at all, or None
+        self.error = None
+
+    @property
+    def playable(self):
+        return self.error is None
+
+    def sdp_options(self, fps):
+        """
+        Gets the values, that go to SDP of the stream of this file, without opening it
+        :param fps:float stream framerate
+        :return:dict of hashable values
+        """
+        options = {
+            'width': self.width,
+            'height': self.height,
+            'fps': fps,
+        }
+        if self.kind == 'video':
+            options['range'] = 'npt=0-%.3f' % (self.frames / fps)
+        return options
+
+    def get_sdp(self, options, fps):
+        """
+        Generates SDP for the stream of this file, without opening it
+        :param options:dict server video options. It is not modified
+        :param fps:float stream framerate
+        :return:string SDP
+        """
+        return make_sdp2(dict(options, **self.sdp_options(fps)))
+
+
+def _probe_header(info, data):
+    """
+    Fills asset info from jpeg markers
+    :param info:AssetInfo
+    :param data:buffer with jpeg data
+    """
+    jpeg = JpegFile()
+    if not jpeg.load_data(data):
+        info.error = "broken jpeg header"
+        return
+    info.width, info.height = jpeg.width, jpeg.height
+    info.components = len(jpeg.components)
+    if jpeg.components:
+        info.sampling = (jpeg.components[0].h, jpeg.components[0].v)
+    info.progressive = jpeg.progressive
+    info.reset_interval = jpeg.reset_interval
+    info.standard_tables = jpeg.has_standard_huffman_tables()
+    info.rtp_incompatibility = rtp_incompatibility(jpeg)
+    # Frames, that can not be sent as is, are decoded. Decoder does not cover everything
+    if not jpeg.components:
+        info.error = "unsupported frame type"
+    elif jpeg.progressive:
+        info.error = "progressive encoding"
+    elif not jpeg.qtables_raw or not jpeg.htables_raw:
+        info.error = "missing coding tables"
+
+
+def _probe_jpeg_file(info, path):
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Only pages with markers are read from the disk
+            _probe_header(info, data)
+
+
+def probe_asset(path):
+    """
+    Probes a media file. It is run inside catalog workers
+    :param path:string path to the file
+    :return:AssetInfo
+    """
+    if is_playlist(path):
+        kind = 'playlist'
+    elif path.lower().endswith(VIDEO_EXTENSIONS):
+        kind = 'video'
+    else:
+        kind = 'jpeg'
+    info = AssetInfo(path, kind)
+    try:
+        stats = os.stat(path)
+        info.size, info.mtime = stats.st_size, stats.st_mtime_ns
+        if kind == 'video':
+            # Index is saved next to the file, so streams open it without scanning
+            video = IndexedVideoFile(path)
+            info.frames = len(video)
+            if info.frames:
+                frame = video.frame(0)
+                _probe_header(info, frame)
+                frame.release()
+            else:
+                info.error = "no frames"
+            video.close()
+        elif kind == 'playlist':
+            items = read_playlist(path)
+            info.frames = len(items)
+            if items:
+                # Stream is announced with the size of its first image
+                _probe_jpeg_file(info, items[0][0])
+            else:
+                info.error = "empty playlist"
+        elif info.size == 0:
+            info.error = "empty file"
+        else:
+            info.frames = 1
+            _probe_jpeg_file(info, path)
+    except (IOError, OSError, ValueError) as e:
+        info.error = str(e)
+    return info
+
+
+class AssetCatalog:
+    """
+    In-memory index of media files in a directory tree
+    Files are looked up by URL path, like '/dir/image.jpg'
+    """
+    def __init__(self, root, fps=RtpFrameGenerator.DEFAULT_FPS, still_fps=None):
+        """
+        :param root:string directory with media files
+        :param fps:float framerate, announced for the streams
+        :param still_fps:float framerate of still images and playlists. fps is used if None
+        """
+        self.root = root
+        self.fps = fps
+        self.still_fps = still_fps
+        # Maps URL path->AssetInfo
+        self._assets = {}
+
+    def __len__(self):
+        return len(self._assets)
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def get(self, path):
+        """
+        :param path:string URL path, starting with '/'. Directories can end with '/'
+        :return:AssetInfo, or None if there is no such file
+        """
+        return self._assets.get(path.rstrip('/') or '/')
+
+    def stream_fps(self, info):
+        """
+        :param info:AssetInfo
+        :return:float framerate of the stream for the asset
+        """
+        if info.kind != 'video' and self.still_fps:
+            return self.still_fps
+        return self.fps
+
+    def paths(self, kind=None):
+        """
+        :param kind:string 'jpeg', 'video' or 'playlist'. All kinds are listed if None
+        :return:list of paths to playable files
+        """
+        return [info.path for info in self._assets.values()
+                if info.playable and (kind is None or info.kind == kind)]
+
+    def update(self, changed, removed=()):
+        """
+        Probes changed files again and forgets removed ones
+        :param changed:list of paths to new or changed files
+        :param removed:list of paths to removed files
+        """
+        for path in removed:
+            self._assets.pop(self.url_path(path), None)
+        # Directory playlists change together with their images
+        changed = list(changed)
+        for path in list(changed) + list(removed):
+            directory = os.path.dirname(path)
+            info = self._assets.get(self.url_path(directory))
+            if info is not None and info.kind == 'playlist' and directory not in changed:
+                changed.append(directory)
+        for path in changed:
+            info = probe_asset(path)
+            if info.error is not None:
+                logger.warn("Can not stream %s: %s" % (info.path, info.error))
+            self._assets[self.url_path(path)] = info
+
+    def url_path(self, path):
+        """
+        Converts file path to URL path
+        """
+        path = os.path.relpath(path, self.root)
+        if path == os.curdir:
+            # Root directory is a playlist as well
+            return '/'
+        return '/' + path.replace(os.sep, '/')
+
+    def find_files(self):
+        """
+        :return:list of paths to media files and playlists under the root
+        """
+        result = []
+        for directory, _, files in os.walk(self.root):
+            has_jpegs = False
+            for name in files:
+                lower = name.lower()
+                if lower.endswith(JPEG_EXTENSIONS + VIDEO_EXTENSIONS + PLAYLIST_EXTENSIONS):
+                    result.append(os.path.join(directory, name))
+                has_jpegs = has_jpegs or lower.endswith(JPEG_EXTENSIONS)
+            if has_jpegs:
+                result.append(directory)
+        return result
+
+    def scan(self, workers=None):
+        """
+        Probes all media files under the root
+        :param workers:int number of probing processes. Files are probed in this process if 0,
+                and by os.cpu_count() processes if None
+        :return:int number of indexed files
+        """
+        start = time()
+        paths = self.find_files()
+        if workers == 0 or len(paths) < 2:
+            infos = [probe_asset(path) for path in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                infos = list(executor.map(probe_asset, paths, chunksize=16))
+
+        assets = {}
+        for info in infos:
+            if info.error is not None:
+                logger.warn("Can not stream %s: %s" % (info.path, info.error))
+            assets[self.url_path(info.path)] = info
+        self._assets = assets
+        logger.info("Indexed %d files of %s in %.3fs" % (len(assets), self.root, time() - start))
+        return len(assets)
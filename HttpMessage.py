@@ -74,18 +74,25 @@ class HttpMessage:
         self._method = None
         # Requested url, in a raw string form
         self._url_raw = ""
-        # Parsed url
+        # Parsed url. It is parsed on the first access
         self._url = None
-        self.values = {}
-        self._payload = ""
-        self._seq = None
+        # All header values. They are parsed on the first access
+        self._values = None
+        # Raw header block and its lowercase copy, for lazy lookups of single headers
+        self._head = b''
+        self._head_lower = b''
+        # Maps lowercase header name->value, that was looked up already
+        self._found = {}
+        self._payload = b''
 
     @property
     def seq(self):
-        return self._seq
+        return self.get("cseq")
 
     @property
     def url(self):
+        if self._url is None:
+            self._url = urlparse(self._url_raw)
         return self._url
 
     @property
@@ -96,8 +103,45 @@ class HttpMessage:
     def type(self):
         return self._method
 
+    @property
+    def payload(self):
+        return self._payload
+
+    @property
+    def values(self):
+        """
+        All headers as dict lowercase name->value
+        """
+        if self._values is None:
+            lines = self._head.decode('utf-8', 'replace').split('\r\n')[1:]
+            self._values = HttpMessage.parse_rtsp_values(lines)
+        return self._values
+
     def get(self, key, default=None):
-        return self.values.get(key, default)
+        found = self._found
+        if key not in found:
+            found[key] = self._find_header(key.lower())
+        value = found[key]
+        return default if value is None else value
+
+    def _find_header(self, key):
+        """
+        Looks up a single header in the raw header block
+        :param key:string lowercase header name
+        :return:string header value, or None if there is no such header
+        """
+        if self._values is not None:
+            return self._values.get(key)
+        name = ('\r\n%s:' % key).encode('latin-1')
+        start = self._head_lower.find(name)
+        if start < 0:
+            return None
+        start += len(name)
+        end = self._head.find(b'\r\n', start)
+        if end < 0:
+            end = len(self._head)
+        value = self._head[start:end].strip()
+        return value.decode('utf-8', 'replace') if value else None
 
     def deserialize(self, raw_message):
         """
@@ -121,13 +165,36 @@ class HttpMessage:
         self._url_raw = self._header_line[1]
         self._protocol = self._header_line[2]
         self._url = urlparse(self._url_raw)
-        self.values = HttpMessage.parse_rtsp_values(lines[1:])
-        self._payload = ""
-        self._seq = self.values.get("cseq")
+        self._values = HttpMessage.parse_rtsp_values(lines[1:])
+        self._payload = b''
 
         logger.debug("REQ=%s\nDAT=%s" % (str(self._header_line), lines[1:]))
         return True
 
+    def load(self, head, payload=b''):
+        """
+        Loads a request from raw bytes. Only the request line is parsed here,
+        headers are parsed when they are requested
+        :param head:bytes request line and headers, without the empty line
+        :param payload:bytes request body
+        :return:bool True if request line is valid
+        """
+        end = head.find(b'\r\n')
+        if end < 0:
+            end = len(head)
+        self._header_line = head[:end].decode('utf-8', 'replace').split(' ')
+        if len(self._header_line) != 3:
+            logger.error("Corrupted request")
+            return False
+        self._method, self._url_raw, self._protocol = self._header_line
+        self._head = head
+        self._head_lower = head.lower()
+        self._payload = payload
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("REQ=%s\nDAT=%s", self._header_line, head[end + 2:].decode('utf-8', 'replace').split('\r\n'))
+        return True
+
     @staticmethod
     def parse_rtsp_values(lines):
         values = {}
@@ -148,27 +215,181 @@ class HttpMessage:
         :param seq:int - sequence code
         :param values:dict - header values
         :param data:bytes - payload
-        :return:string complete RTSP response
+        :return:bytes complete RTSP response
         """
-        msg = 'RTSP/1.0 %d %s\r\n' % (code, StatusCodes.get(code, 'Unknown code'))
+        if data:
+            response = RtspResponse(code, data=data)
+        else:
+            response = RtspResponse.plain(code)
+        return response.render(seq, values)
+
+
+CRLF = b'\r\n'
+
+# Status lines of all known codes, like b'RTSP/1.0 200 OK\r\n'
+STATUS_LINES = dict((code, ('RTSP/1.0 %d %s\r\n' % (code, reason)).encode()) for code, reason in StatusCodes.items())
 
-        # Send RTSP reply to the client
-        def add_data(buffer, field, value):
-            buffer += ("%s: %s\r\n" % (str(field), str(value)))
-            return buffer
+# Maps header name->b'Name: '
+_header_prefixes = {}
+
+
+def _render_header(parts, name, value):
+    prefix = _header_prefixes.get(name)
+    if prefix is None:
+        prefix = _header_prefixes[name] = ('%s: ' % name).encode()
+    parts.append(prefix)
+    parts.append(value if isinstance(value, bytes) else str(value).encode())
+    parts.append(CRLF)
+
+
+class RtspResponse:
+    """
+    RTSP response with pre-rendered static part
+
+    Status line, static headers and body are serialized once. Every request fills in only
+    its own fields, like CSeq, Session or RTP-Info
+    """
+    # Maps code->RtspResponse without static headers
+    _plain = {}
 
+    def __init__(self, code, values=None, data=None):
+        """
+        :param code:int RTSP status code
+        :param values:dict static header values
+        :param data:string or bytes body
+        """
+        self.code = code
+        self._status = STATUS_LINES.get(code) or ('RTSP/1.0 %d Unknown code\r\n' % code).encode()
+        parts = []
+        for key, value in (values or {}).items():
+            _render_header(parts, key, value)
+        if data:
+            if not isinstance(data, bytes):
+                data = str(data).encode()
+            _render_header(parts, 'Content-Length', len(data))
+            parts.append(CRLF)
+            parts.append(data)
+        else:
+            parts.append(CRLF)
+        self._tail = b''.join(parts)
+
+    @classmethod
+    def plain(cls, code):
+        """
+        :param code:int RTSP status code
+        :return:RtspResponse without static headers and body
+        """
+        response = cls._plain.get(code)
+        if response is None:
+            response = cls._plain[code] = cls(code)
+        return response
+
+    def render(self, seq, values=None):
+        """
+        Serializes the response for a request
+        :param seq:string or int CSeq of the request
+        :param values:dict header values of this request
+        :return:bytes complete RTSP response
+        """
+        parts = [self._status]
         if seq is not None:
-            msg = add_data(msg, 'CSeq', seq)
-        if values is not None:
+            _render_header(parts, 'CSeq', seq)
+        if values:
             for key, value in values.items():
-                msg = add_data(msg, key, value)
+                _render_header(parts, key, value)
+        parts.append(self._tail)
+        return b''.join(parts)
 
-        if data is not None and len(data) > 0:
-            data = str(data)
-            msg = add_data(msg, 'Content-Length', len(data))
-            msg += '\r\n'
-            msg += data
-        else:
-            msg += '\r\n'
 
-        return msg
+class RtspRequestParser:
+    """
+    Incremental parser of RTSP requests
+
+    Bytes are fed as they come from the socket, and complete requests are cut from them
+    together with their bodies. So pipelined requests are handled one by one, and a body
+    of SET_PARAMETER or ANNOUNCE does not leak into the next request
+    """
+    # Requests with longer headers are refused
+    MAX_HEAD_SIZE = 64 * 1024
+    MAX_BODY_SIZE = 1024 * 1024
+    # Consumed bytes are dropped from the buffer, when there are more of them
+    COMPACT_SIZE = 64 * 1024
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # Offset of the next request in the buffer
+        self._start = 0
+        # Tuple (HttpMessage, body length) of the request, waiting for its body. Body starts at _start
+        self._pending = None
+
+    def feed(self, data):
+        """
+        Adds received bytes
+        :param data:bytes
+        """
+        if self._start and (self._start == len(self._buffer) or self._start > self.COMPACT_SIZE):
+            # Pipelining clients never let the buffer be consumed completely, so it is compacted
+            # once in a while. Offsets of a pending request are relative to _start, so they stay valid
+            del self._buffer[:self._start]
+            self._start = 0
+        self._buffer += data
+
+    @property
+    def buffered(self):
+        """
+        :return:int number of received bytes, that do not make a complete request yet
+        """
+        return len(self._buffer) - self._start
+
+    def _content_length(self, message):
+        value = message.get('content-length')
+        if value is None:
+            return 0
+        try:
+            length = int(value)
+        except ValueError:
+            raise ValueError("Invalid Content-Length %s" % value)
+        if length < 0 or length > self.MAX_BODY_SIZE:
+            raise ValueError("Content-Length %d is out of range" % length)
+        return length
+
+    def next_message(self):
+        """
+        Cuts the next complete request from the received bytes
+        Broken request is dropped, so parsing goes on with the next one. If the length of its body is unknown,
+        the rest of the received bytes is dropped as well
+        :return:HttpMessage, or None if there is no complete request yet
+        raises ValueError if the request is broken
+        """
+        buffer = self._buffer
+        if self._pending is None:
+            # Clients can send empty lines between requests
+            while buffer.startswith(b'\r\n', self._start):
+                self._start += 2
+            head_end = buffer.find(b'\r\n\r\n', self._start)
+            if head_end < 0:
+                if self.buffered > self.MAX_HEAD_SIZE:
+                    self._start = len(buffer)
+                    raise ValueError("Request header is longer than %d bytes" % self.MAX_HEAD_SIZE)
+                return None
+            head = bytes(buffer[self._start:head_end])
+            self._start = head_end + 4
+            message = HttpMessage()
+            if not message.load(head):
+                raise ValueError("Invalid request line")
+            try:
+                length = self._content_length(message)
+            except ValueError:
+                # Body can not be told from the next request, so all the received bytes are dropped
+                self._start = len(buffer)
+                raise
+            self._pending = (message, length)
+
+        message, length = self._pending
+        body_end = self._start + length
+        if body_end > len(buffer):
+            return None
+        message._payload = bytes(buffer[self._start:body_end])
+        self._start = body_end
+        self._pending = None
+        return message
@@ -1,13 +1,28 @@
-from struct import pack_into, unpack_from, pack, pack_into, calcsize
+from struct import pack_into, unpack_from, pack, pack_into, calcsize, Struct
 from io import BytesIO
 from array import array
 from copy import copy
 import logging
 
+from Timing import timed
+
 logger = logging.getLogger(__name__)
 
 component_map = {1: 'Y', 2: 'Cb', 3: 'Cr', 4: 'I', 5: 'Q'}
 
+# Precompiled readers for marker segments. Header parser uses them on every segment
+_marker = Struct('!BB')
+_segment = Struct('!BBH')
+_jfif_version = Struct('!BBB')
+_jfif_density = Struct('!hhbb')
+_sof_header = Struct('!BHHB')
+_sof_component = Struct('!3B')
+_dri_segment = Struct('!BBHH')
+_dht_lengths = Struct('!16B')
+_sos_header = Struct('!BBHB')
+_sos_component = Struct('!BB')
+_sos_tail = Struct('!BBB')
+
 """
 References:
 
@@ -362,6 +377,15 @@ _ca_values = bytearray([
     226,227,228,229,230,231,232,233,234,242,243,244,245,246,247,248,249,250])
 
 
+# Standard MJPEG Huffman tables, mapped by DHT table class and destination
+_standard_huffman_tables = {
+    0x00: (bytes(_lum_dc_code_length), bytes(_lum_dc_symbols)),
+    0x10: (bytes(_lum_ac_code_length), bytes(_lum_ac_symbols)),
+    0x01: (bytes(_chm_dc_codelens), bytes(_chm_dc_symbols)),
+    0x11: (bytes(_ca_lengths), bytes(_ca_values)),
+}
+
+
 class EntropyDecoder(object):
 
     def __init__(self, readable):
@@ -638,8 +662,10 @@ class JpegFile:
         # Raw quantitization tables, as specified in the file
         self.qtables_raw = {}
 
-        # Huffman tables,
-        self.htables = {}
+        # Raw Huffman tables (lengths, values), as specified in the file
+        self.htables_raw = {}
+        # Decoding caches for Huffman tables. They are built only when decoding is needed
+        self._htables = None
 
         # Coding table destinations for a scan
         self.scans = {}
@@ -655,8 +681,13 @@ class JpegFile:
         self.bit = 0
         self.nmcu = None
         self.reset_interval = 0
+        self.type = 0
+        self.progressive = False
+        self.components = []
         self.qtables = {}
-        self.htables = {}
+        self.qtables_raw = {}
+        self.htables_raw = {}
+        self._htables = None
         self.scans = {}
         self._raw_blocks = []
         self._has_thumbnail = False
@@ -666,6 +697,39 @@ class JpegFile:
     def image_data(self):
         return self._image_data
 
+    def release_data(self):
+        """
+        Drops image data and decoded pixels, keeping the parsed header
+        It is used once the image is packetized, so the source buffer can be freed
+        """
+        if isinstance(self._image_data, memoryview):
+            self._image_data.release()
+        self._image_data = None
+        self.pixels = None
+        self._mcu_blocks = []
+        self._coded_mcu_blocks = []
+
+    @property
+    def htables(self):
+        """
+        Huffman decoding tables. Building them is expensive, so it is postponed until decoding
+        """
+        if self._htables is None:
+            self._htables = {}
+            for key, (lengths, values) in self.htables_raw.items():
+                self._htables[key] = HuffmanCachedTable(lengths, values)
+        return self._htables
+
+    def has_standard_huffman_tables(self):
+        """
+        Checks if jpeg uses standard MJPEG Huffman tables
+        RTP receivers can not get Huffman tables from the stream, so they always use the standard ones
+        """
+        for key, (lengths, values) in self.htables_raw.items():
+            if _standard_huffman_tables.get(key) != (bytes(lengths), bytes(values)):
+                return False
+        return True
+
     def _add_raw_block(self, hdr_lo, hdr_hi, data):
         """
         Adds raw block to the storage
@@ -679,59 +743,66 @@ class JpegFile:
     def write_chroma(self, out, offset):
         """
         Writes jpeg chroma table to a specified location of a bytearray
+        Table is written in zig-zag order, as it is stored in DQT block
         :param out:bytes output data
         :param offset:int offset to the table
         """
-        out[offset:offset + 64] = self.qtables[0][0:64]
+        out[offset:offset + 64] = self.qtables_raw[1][0:64]
 
     def write_luma(self, out, offset):
         """
         Writes jpeg luminance table to a specified location of a bytearray
+        Table is written in zig-zag order, as it is stored in DQT block
         :param out:bytes output data
         :param offset:int offset to the table
         """
-        out[offset:offset + 64] = self.qtables[1][0:64]
+        out[offset:offset + 64] = self.qtables_raw[0][0:64]
 
+    @timed('load_data')
     def load_data(self, jpeg_bytes, offset=0, end=0):
         """
         Parses JPEG header from a block of data
-        :param jpeg_bytes: a list of bytes
+        Data is never copied: segments are read through a memoryview, and image_data is a view
+        of the source buffer. So the buffer should not be changed while image_data is used
+        :param jpeg_bytes: bytes, bytearray, mmap or memoryview with jpeg data
         :param offset:int byte offset to start of image data
         :param end:int byte offset to an end of data block
-        :return:
+        :return:bool True if header was parsed
         """
-
-        start = offset
+        data = jpeg_bytes if isinstance(jpeg_bytes, memoryview) else memoryview(jpeg_bytes)
+        if data.format != 'B' or data.ndim != 1:
+            data = data.cast('B')
 
         if end == 0:
-            end = len(jpeg_bytes)
+            end = len(data)
 
         self.reset()
 
-        if jpeg_bytes[offset+0] != 0xff or jpeg_bytes[offset+1] != 0xd8:
+        if end - offset < 4 or data[offset] != 0xff or data[offset+1] != 0xd8:
             logger.error("No SOI header at start")
             return False
 
         pstate = self._parse_state
         pstate.done = False
+        parsers = self.block_parsers
 
         while offset+4 < end and not pstate.done:
-            temp_data = jpeg_bytes[offset:]          # Debug view of the data
-            (head_lo, head_hi) = unpack_from('!BB', jpeg_bytes, offset)
+            (head_lo, head_hi) = _marker.unpack_from(data, offset)
             head = (head_lo << 8) | head_hi
 
-            handler = self.block_parsers.get(head)
+            handler = parsers.get(head)
             if handler:
                 try:
-                    offset += handler(self, jpeg_bytes, offset, pstate)
+                    offset += handler(self, data, offset, pstate)
                 except:  # Everything we catch here is really internal crap
                     logger.error("Internal JPEG decoder error")
+                    return False
 
             else:
-                length = unpack_from("!H", jpeg_bytes, offset + 2)[0]
-                logger.warn("Unknown block %x:%x len=%d at offset=%d" % (head_lo, head_hi, length, offset))
-                next_block = temp_data[length:]
-                offset += length
+                # APPn, COM and other segments are skipped by their length
+                length = _segment.unpack_from(data, offset)[2]
+                logger.debug("Skipping block %x:%x len=%d at offset=%d", head_lo, head_hi, length, offset)
+                offset += length + 2
 
         if pstate.found_data:
             if offset + 2 >= end:
@@ -739,38 +810,35 @@ class JpegFile:
                 return False
             else:
                 # Try end of data block
-                (head_lo, head_hi) = unpack_from('!BB', jpeg_bytes, end-2)
+                (head_lo, head_hi) = _marker.unpack_from(data, end-2)
                 if head_lo != 0xff and head_hi != 0xd9:
                     logger.error("Missing EOI block")
-                self._image_data = jpeg_bytes[offset:end]
+                self._image_data = data[offset:end]
 
-                logger.debug("Length of image data=%d bytes" % len(self._image_data))
+                logger.debug("Length of image data=%d bytes", len(self._image_data))
                 return True
         return False
 
     def _parse_jfif(self, data, offset, pstate):
         pos = 0
-        (app_l, app_h, length) = unpack_from("!BBH", data, offset)
-        logger.debug("Parsing JFIF block id=%x:%x len=%d" % (app_l, app_h, length))
+        (app_l, app_h, length) = _segment.unpack_from(data, offset)
+        logger.debug("Parsing JFIF block id=%x:%x len=%d", app_l, app_h, length)
         if app_l != 0xff and app_h != 0xe0:
             logger.error("Wrong APP0 header %x:%x" % (app_l, app_h))
             return length+2
         pos += 4
-        id = unpack_from("!5c", data, offset+pos)
         # Should be 'JFIF'#0 (0x4a, 0x46, 0x49, 0x46, 0x00)
         pos += 5
-        (version_major, version_minor, units) = unpack_from("!BBB", data, offset+pos)
+        (version_major, version_minor, units) = _jfif_version.unpack_from(data, offset+pos)
         if version_major != 1:
             logger.warn("Strange JFIF version %d.%d" % (version_major, version_minor))
         pos += 3
 
-        (width, height, xtumb, ytumb) = unpack_from("!hhbb", data, offset+pos)
+        (width, height, xtumb, ytumb) = _jfif_density.unpack_from(data, offset+pos)
         pos += 6
-        if 2 + length - pos > 0:
-            thumb_data = 3*width*height
 
         if xtumb > 0 or ytumb > 0:
-            logger.debug("Expecting thumbnail %dx%d" % (xtumb, ytumb))
+            logger.debug("Expecting thumbnail %dx%d", xtumb, ytumb)
             self._thumb_height = ytumb
             self._thumb_width = xtumb
 
@@ -778,17 +846,17 @@ class JpegFile:
         return length+2
 
     def _parse_start_of_image(self, data, offset, pstate):
-        (app_l, app_h) = unpack_from("!BB", data, offset)
-        logger.debug("Parsing SOI block id=%x:%x" % (app_l, app_h))
+        (app_l, app_h) = _marker.unpack_from(data, offset)
+        logger.debug("Parsing SOI block id=%x:%x", app_l, app_h)
         pstate.found_soi += 1
         return 2
 
     def _parse_comment(self, data, offset, pstate):
-        (app_l, app_h, length) = unpack_from("!BBH", data, offset)
+        (app_l, app_h, length) = _segment.unpack_from(data, offset)
         if app_l != 0xff or app_h != 0xfe:
-            logger.debug("Not a comment block id=%x:%x" % (app_l, app_h))
+            logger.debug("Not a comment block id=%x:%x", app_l, app_h)
         else:
-            logger.debug("Found comment block id=%x:%x" % (app_l, app_h))
+            logger.debug("Found comment block id=%x:%x", app_l, app_h)
         return length+2
 
     def _parse_start_of_frames(self, data, offset, pstate):
@@ -808,20 +876,21 @@ class JpegFile:
                                            quantization table number (1 byte)).
         Remarks:     JFIF uses either 1 component (Y, greyscaled) or 3 components (YCbCr, sometimes called YUV, colour).
         """
-        (app_l, app_h, length) = unpack_from("!BBH", data, offset)
-        if app_l == 0xff and app_h in range(0xc0, 0xcf):
-            logger.debug("Parsing SOF block id=%x:%x len=%d" % (app_l, app_h, length))
+        (app_l, app_h, length) = _segment.unpack_from(data, offset)
+        if app_l == 0xff and 0xc0 <= app_h < 0xcf:
+            logger.debug("Parsing SOF block id=%x:%x len=%d", app_l, app_h, length)
         else:
             logger.error("Block mismatch")
             return None
 
         if app_h == 0xc2:
             logger.warn("This is progressive encoding!")
+        self.progressive = app_h == 0xc2
 
         pos = 4
-        (precision, self.height, self.width, num_components) = unpack_from("!BHHB", data, offset+pos)
+        (precision, self.height, self.width, num_components) = _sof_header.unpack_from(data, offset+pos)
         pos += 6
-        logger.debug("\t - image size %dx%d" % (self.width, self.height))
+        logger.debug("\t - image size %dx%d", self.width, self.height)
         pstate.found_sof += 1
 
         if num_components == 1:
@@ -834,7 +903,7 @@ class JpegFile:
         self.kind = kind
 
         for i in range(0, num_components):
-            (comp_id, comp_sampling, quant_table) = unpack_from("!3B", data, offset+pos)
+            (comp_id, comp_sampling, quant_table) = _sof_component.unpack_from(data, offset+pos)
             h, v = comp_sampling >> 4, comp_sampling & 15
             if h not in (1, 2, 4):
                 raise ValueError('Invalid horizontal sampling factor.')
@@ -846,11 +915,11 @@ class JpegFile:
 
             if num_components == 1:
                 h, v = 1, 1
-            logger.debug("\t -component %s samp=%d, qt=%d" % (component_map.get(comp_id, 'N'), comp_sampling, quant_table))
+            logger.debug("\t -component %s samp=%d, qt=%d", component_map.get(comp_id, 'N'), comp_sampling, quant_table)
             self.components.append(Component(comp_id, h, v, quant_table))
 
             if i == 0:
-                if comp_sampling == 0x11:
+                if comp_sampling == 0x11 or comp_sampling == 0x21:
                     self.type = 0
                 elif comp_sampling == 0x22:
                     self.type = 1
@@ -898,9 +967,9 @@ class JpegFile:
                                         MCU blocks a RSTn marker can be found.The first marker
                                         will be RST0, then RST1 etc, after RST7 repeating from RST0.
         """
-        (app_l, app_h, length, self.reset_interval) = unpack_from("!BBH", data, offset)
+        (app_l, app_h, length, self.reset_interval) = _dri_segment.unpack_from(data, offset)
         if app_l == 0xff and app_h == 0xdd:
-            logger.debug("Parsed DRI block id=%x:%x len=%d" % (app_l, app_h, length))
+            logger.debug("Parsed DRI block id=%x:%x len=%d", app_l, app_h, length)
         return length + 2
 
     def _parse_huffman_table(self, data, offset, pstate):
@@ -917,14 +986,12 @@ class JpegFile:
             int8[16] ht_header
             int8[] table_data
         """
-        (app_l, app_h, length) = unpack_from("!BBH", data, offset)
+        (app_l, app_h, length) = _segment.unpack_from(data, offset)
         offset += 4
 
         if app_l != 0xff or app_h != 0xc4 or length < 16:
             logger.error("Wrong DHT block id=%x:%x len=%d" % (app_l, app_h, length))
 
-        self.progressive = (app_h == 0xc2)
-
         offset_end = offset + length - 2
 
         while offset_end - offset > 17:
@@ -938,22 +1005,18 @@ class JpegFile:
             is_dc = (table_flags & 0b0001000) == 0
 
             # Obtaining header of the table
-            lengths = unpack_from("!BBBBBBBBBBBBBBBB", data, offset)
+            lengths = _dht_lengths.unpack_from(data, offset)
             offset += 16
 
-            total_len = 0
-            for l in lengths:
-                total_len += l
+            total_len = sum(lengths)
 
-            if is_dc:
-                logger.info("Found id=%x:%x len=%d DHT DC table=%d header=%s table_len=%d" %
-                             (app_l, app_h, length, identifier, lengths, total_len))
-            else:
-                logger.info("Found id=%x:%x len=%d DHT AC table=%d header=%s table_len=%d" %
-                             (app_l, app_h, length, identifier, lengths, total_len))
+            logger.debug("Found id=%x:%x len=%d DHT %s table=%d header=%s table_len=%d",
+                         app_l, app_h, length, 'DC' if is_dc else 'AC', identifier, lengths, total_len)
 
-            values = data[offset:offset + total_len]
-            self.htables[table_flags] = HuffmanCachedTable(lengths, values)
+            # Tables are small, so they are copied. It does not pin the source buffer
+            values = bytes(data[offset:offset + total_len])
+            self.htables_raw[table_flags] = (lengths, values)
+            self._htables = None
             pstate.found_dht += 1
             offset += total_len
 
@@ -965,19 +1028,19 @@ class JpegFile:
 
     def _parse_start_of_frame_n(self, data, offset, pstate):
         # We skip this block
-        (app_l, app_h, length) = unpack_from("!BBH", data, offset)
-        if app_l == 0xff and app_h in range(0xc0, 0xcf):
+        (app_l, app_h, length) = _segment.unpack_from(data, offset)
+        if app_l == 0xff and 0xc0 <= app_h < 0xcf:
             logger.error("Skipping SOFn block id=%x:%x len=%d" % (app_l, app_h, length))
             pstate.found_sofn += 1
         return length+2
 
     def _parse_quant_block(self, data, offset, pstate):
-        (head_lo, head_hi, length) = unpack_from('!BBH', data, offset)
+        (head_lo, head_hi, length) = _segment.unpack_from(data, offset)
         offset += 4
         if head_lo != 0xff and head_hi != 0xdb:
             logger.error("Failed to find DQT header")
             return length + 2
-        logger.info("Parsing Quantization block id=%x:%x len=%d" % (head_lo, head_hi, length))
+        logger.debug("Parsing Quantization block id=%x:%x len=%d", head_lo, head_hi, length)
 
         offset_end = offset + length - 2
 
@@ -992,12 +1055,13 @@ class JpegFile:
             if table_index >= 4:  # Invalid qtable destination identifier.
                 offset += table_length
                 continue
-            qt = data[offset:offset+table_length]
+            qt = bytes(data[offset:offset+table_length])
             table = bytearray(64)
             table[0] = qt[0]
             i = 1
             for z in _z_z:
                 table[z] = qt[i]
+                i += 1
 
             pstate.found_quant += 1
 
@@ -1024,25 +1088,26 @@ class JpegFile:
                                                                bit 4..7 : DC table (0..3)
         Ignorable Bytes               3 bytes      We have to skip 3 bytes.
         """
-        (head_lo, head_hi, length, num_components) = unpack_from('!BBHB', data, offset)
+        (head_lo, head_hi, length, num_components) = _sos_header.unpack_from(data, offset)
 
         if num_components not in range(1, 4):
             logger.warn("\t %d - strange number of components" % num_components)
         pos = 5
         for c in range(0, num_components):
-            (comp_id, table_flags) = unpack_from('!BB', data, offset+pos)
+            (comp_id, table_flags) = _sos_component.unpack_from(data, offset+pos)
             comp_name = component_map.get(comp_id, 'N')
             ac_table = table_flags & 0b1111
             dc_table = (table_flags >> 4) & 0b1111
-            logger.info("\t- component %s uses Huffman AC table %d DC table %d" % (comp_name, ac_table, dc_table))
+            logger.debug("\t- component %s uses Huffman AC table %d DC table %d", comp_name, ac_table, dc_table)
             # ACs always have Tc == 1
             self.scans[comp_id] = CodingDestination(dc_table, 16 | ac_table)
             pos += 2
 
-        (scan_start, scan_end, bit_pos) = unpack_from('!BBB', data, offset+pos)
+        (scan_start, scan_end, bit_pos) = _sos_tail.unpack_from(data, offset+pos)
         pos += 3
 
-        logger.debug("Parsing Start Of Scan id=%x:%x len=%d, start=%d, end=%d" % (head_lo, head_hi, length, scan_start, scan_end))
+        logger.debug("Parsing Start Of Scan id=%x:%x len=%d, start=%d, end=%d",
+                     head_lo, head_hi, length, scan_start, scan_end)
 
         pstate.found_data = True
         pstate.done = True
@@ -1051,16 +1116,16 @@ class JpegFile:
 
     def _parse_end_of_image(self, data, offset, pstate):
         logger.debug("Parsing End Of Image")
-        (head_lo, head_hi, length) = unpack_from('!BBH', data, offset)
         pstate.done = True
-        return length + 2
+        return 2
 
     def decompress(self):
         """
         Does full jpeg decompression
         :return:bytearray decompressed pixel data
         """
-        readable = Readable(self._image_data)
+        # Decoder needs bytes methods, so the view is copied here
+        readable = Readable(bytes(self._image_data))
         data = decompress_impl(self, readable)
         return data
 
@@ -1338,6 +1403,19 @@ class EntropyEncoder(object):
         _forward_dct(block)
         for i in range(64):
             block[i] = (((block[i] << 1)//scale[i]) + 1) >> 1
+        return self.encode_quantized(previous, block, dc, ac)
+
+    def encode_coefficients(self, previous, coefficients, scale, dc, ac, block):
+        """
+        Quantizes and encodes precomputed DCT coefficients
+        Coefficients are kept intact, so they can be encoded again with another scale
+        :param block:list scratch storage for quantized values
+        """
+        for i in range(64):
+            block[i] = (((coefficients[i] << 1)//scale[i]) + 1) >> 1
+        return self.encode_quantized(previous, block, dc, ac)
+
+    def encode_quantized(self, previous, block, dc, ac):
         d = block[0] - previous
         if d == 0:
             self.write(*dc[0])
@@ -1388,6 +1466,7 @@ class ReferenceJpeg(object):
     def valid(data):
         return data.startswith('\xff\xd8\xff')
 
+    @timed('reference_jpeg')
     def __init__(self, data):
         self.readable = r = Readable(data)
         self.width, self.height, self.kind, self.n = 0, 0, '', 0
@@ -1459,6 +1538,7 @@ class ReferenceJpeg(object):
             raise ValueError('Missing EOI segment.')
         return data
 
+    @timed('decompress_ref')
     def decompress_ref(self):
         if not self.components:
             raise ValueError('Missing SOF segment.')
@@ -1534,44 +1614,37 @@ class ReferenceJpeg(object):
         return data
 
 
-def serialize_scanlines(image, quality, default_tables=True):
-    """
-    Serializes scanlines using default tables
-    :param image:JpegFile with decoded pixel data
-    :param quality:int quality level, in percents
-    :return:bytearray with encoded scanlines
-    """
-    if image.kind not in ('g', 'rgb', 'cmyk'):
+def _check_encodable(image):
+    if image.kind not in ('g', 'rgb', 'ycc', 'cmyk'):
         raise ValueError('Invalid image kind.')
 
-    w, h, n = image.width, image.height, image.n
-
     if image.pixels is None:
         raise ValueError('Image contains no pixel data')
 
-    if w == 0 or h == 0:
-        raise ValueError('Image has wrong size: %dx%d' % (w, h))
-
-    ydc = udc = vdc = kdc = 0
-    # This one serializes using standard huffman table
-    yblock, ublock, vblock, kblock = [0] * 64, [0] * 64, [0] * 64, [0] * 64
-    # TODO: We should able to use tables from JpegFile
-    lq = _quantization_table(_luminance_quantization, quality)
-    ld = _huffman_table(_lum_dc_code_length, _lum_dc_symbols)
-    la = _huffman_table(_lum_ac_code_length, _lum_ac_symbols)
-    ls = _scale_factor(lq)
+    if image.width == 0 or image.height == 0:
+        raise ValueError('Image has wrong size: %dx%d' % (image.width, image.height))
 
-    if n == 3:
-        cq = _quantization_table(_chrominance_quantization, quality)
-        cd = _huffman_table(_chm_dc_codelens, _chm_dc_symbols)
-        ca = _huffman_table(_ca_lengths, _ca_values)
-        cs = _scale_factor(cq)
 
-    encoder = EntropyEncoder()
+def _image_blocks(image, y_start=0, y_end=None):
+    """
+    Iterates over 8x8 blocks of image pixels, converted to encoder color space
+    Blocks are reused between iterations
+    :param image:JpegFile with decoded pixel data
+    :param y_start:int first row to be encoded. Should be aligned to 8
+    :param y_end:int end row to be encoded. Image height is used if None
+    :return:generator of (yblock, ublock, vblock, kblock) tuples
+    """
+    w, h, n = image.width, image.height, image.n
+    if y_end is None or y_end > h:
+        y_end = h
+    # Pixels are already in YCbCr color space
+    ycc = image.kind == 'ycc'
+    yblock, ublock, vblock, kblock = [0] * 64, [0] * 64, [0] * 64, [0] * 64
+    blocks = yblock, ublock, vblock, kblock
 
     data = image.pixels
     # For each block
-    for y in range(0, h, 8):
+    for y in range(y_start, y_end, 8):
         for x in range(0, w, 8):
             # For each pixel in the block - generate contents for the block
             # BTW, if we have just unpacked jpeg, we could keep this blocks there
@@ -1581,6 +1654,10 @@ def serialize_scanlines(image, quality, default_tables=True):
                     j = (min(xx, w - 1) + min(yy, h - 1) * w) * n
                     if n == 1:
                         yblock[i] = data[j]
+                    elif ycc:
+                        yblock[i] = data[j]
+                        ublock[i] = data[j + 1]
+                        vblock[i] = data[j + 2]
                     elif n == 3:
                         r, g, b = data[j], data[j + 1], data[j + 2]
                         yblock[i] = (19595 * r + 38470 * g + 7471 * b + 32768) >> 16
@@ -1592,32 +1669,311 @@ def serialize_scanlines(image, quality, default_tables=True):
                         vblock[i] = data[j + 2]
                         kblock[i] = data[j + 3]
                     i += 1
-            ydc = encoder.encode(ydc, yblock, ls, ld, la)
-            if n == 3:
-                udc = encoder.encode(udc, ublock, cs, cd, ca)
-                vdc = encoder.encode(vdc, vblock, cs, cd, ca)
-            elif n == 4:
-                udc = encoder.encode(udc, ublock, ls, ld, la)
-                vdc = encoder.encode(vdc, vblock, ls, ld, la)
-                kdc = encoder.encode(kdc, kblock, ls, ld, la)
+            yield blocks
+
+
+class _EncoderTables(object):
+    """
+    Standard MJPEG coding tables for a specific quality
+    """
+    def __init__(self, quality):
+        self.lq = _quantization_table(_luminance_quantization, quality)
+        self.ld = _huffman_table(_lum_dc_code_length, _lum_dc_symbols)
+        self.la = _huffman_table(_lum_ac_code_length, _lum_ac_symbols)
+        self.ls = _scale_factor(self.lq)
+        self.cq = _quantization_table(_chrominance_quantization, quality)
+        self.cd = _huffman_table(_chm_dc_codelens, _chm_dc_symbols)
+        self.ca = _huffman_table(_ca_lengths, _ca_values)
+        self.cs = _scale_factor(self.cq)
+
+    def component_tables(self, n):
+        """
+        :return:list of (scale, dc, ac) tuples for each color component
+        """
+        luma = self.ls, self.ld, self.la
+        if n == 3:
+            chroma = self.cs, self.cd, self.ca
+            return [luma, chroma, chroma]
+        return [luma] * n
+
+
+def serialize_scanlines(image, quality, default_tables=True):
+    """
+    Serializes scanlines using default tables
+    :param image:JpegFile with decoded pixel data
+    :param quality:int quality level, in percents
+    :return:bytearray with encoded scanlines
+    """
+    _check_encodable(image)
+
+    n = image.n
+    predictions = [0, 0, 0, 0]
+    # This one serializes using standard huffman table
+    # TODO: We should able to use tables from JpegFile
+    tables = _EncoderTables(quality).component_tables(n)
+
+    encoder = EntropyEncoder()
+
+    for blocks in _image_blocks(image):
+        for c in range(n):
+            scale, dc, ac = tables[c]
+            predictions[c] = encoder.encode(predictions[c], blocks[c], scale, dc, ac)
 
     encoder.write(0x7f, 7)  # padding
     return encoder.dump()
 
 
-def serialize(image, quality):
+def serialize_interval(image, quality, y_start, y_end):
+    """
+    Serializes a band of rows as a separate restart interval
+    Encoder state and DC predictions start from scratch, and the data is padded to a byte boundary
+    :param image:JpegFile with decoded pixel data
+    :param quality:int quality level, in percents
+    :param y_start:int first row of the band. Should be aligned to 8
+    :param y_end:int end row of the band
+    :return:bytes with encoded scanlines, without RST marker
+    """
+    n = image.n
+    predictions = [0, 0, 0, 0]
+    tables = _EncoderTables(quality).component_tables(n)
+    encoder = EntropyEncoder()
+
+    for blocks in _image_blocks(image, y_start, y_end):
+        for c in range(n):
+            scale, dc, ac = tables[c]
+            predictions[c] = encoder.encode(predictions[c], blocks[c], scale, dc, ac)
+
+    encoder.write(0x7f, 7)  # padding
+    return encoder.dump()
+
+
+class IncrementalScanEncoder(object):
+    """
+    Encodes frames of a live source, splitting the scan to restart intervals
+    Every interval covers a band of block rows. Only bands with changed pixels are encoded again,
+    the rest of the scan is spliced from the previous frame
+    """
+    def __init__(self, width, height, n, quality, band_rows=1):
+        """
+        :param width:int frame width
+        :param height:int frame height
+        :param n:int number of color components
+        :param quality:int quality level, in percents
+        :param band_rows:int number of block rows in a restart interval
+        """
+        self.width, self.height, self.n = width, height, n
+        self.quality = quality
+        self.band_height = 8 * band_rows
+        # serialize_scanlines uses 1x1 sampling, so every MCU is a single 8x8 block
+        self.reset_interval = ((width + 7) // 8) * band_rows
+        self.bands = (height + self.band_height - 1) // self.band_height
+        # Pixels of each band from the previous frame
+        self._pixels = [None] * self.bands
+        # Encoded data of each band
+        self._intervals = [None] * self.bands
+
+    def band_rows(self, index):
+        """
+        :return:tuple (y_start, y_end) with pixel rows of the band
+        """
+        y_start = index * self.band_height
+        return y_start, min(y_start + self.band_height, self.height)
+
+    def changed_bands(self, pixels):
+        """
+        Compares frame pixels with the previous frame and remembers the new ones
+        :param pixels:bytes pixel data of the new frame
+        :return:list of indices of changed bands
+        """
+        stride = self.width * self.n * self.band_height
+        changed = []
+        for i in range(self.bands):
+            band = pixels[i * stride:(i + 1) * stride]
+            if band != self._pixels[i]:
+                self._pixels[i] = band
+                changed.append(i)
+        return changed
+
+    def band_pixels(self, index):
+        """
+        :return:bytes pixels of the band from the latest frame
+        """
+        return self._pixels[index]
+
+    def forget_bands(self, indices):
+        """
+        Forces bands to be treated as changed in the next frame
+        """
+        for index in indices:
+            self._pixels[index] = None
+
+    def update(self, index, data):
+        """
+        Stores encoded data of the band
+        """
+        self._intervals[index] = data
+
+    def scan_data(self):
+        """
+        Splices encoded bands together, adding RST markers between them
+        :return:bytes with encoded scanlines, or None if some bands were never encoded
+        """
+        output = bytearray()
+        for i, data in enumerate(self._intervals):
+            if data is None:
+                return None
+            if i > 0:
+                output.append(0xff)
+                output.append(0xd0 + ((i - 1) & 7))
+            output += data
+        return bytes(output)
+
+    def encode(self, image):
+        """
+        Encodes the next frame
+        :param image:JpegFile with decoded pixel data
+        :return:tuple (bytes encoded scanlines, int number of encoded bands)
+        """
+        changed = self.changed_bands(image.pixels)
+        for index in changed:
+            y_start, y_end = self.band_rows(index)
+            self.update(index, serialize_interval(image, self.quality, y_start, y_end))
+        return self.scan_data(), len(changed)
+
+
+def transform_blocks(image):
+    """
+    Converts image pixels to DCT coefficients, which do not depend on quality
+    Coefficients can be serialized with any quality by serialize_coefficients
+    :param image:JpegFile with decoded pixel data
+    :return:list with 64-element coefficient arrays, in scan order
+    """
+    _check_encodable(image)
+
+    n = image.n
+    result = []
+    for blocks in _image_blocks(image):
+        for c in range(n):
+            block = blocks[c]
+            _forward_dct(block)
+            result.append(array('i', block))
+    return result
+
+
+def serialize_coefficients(coefficients, n, quality):
+    """
+    Quantizes and serializes scanlines from precomputed DCT coefficients
+    :param coefficients:list with coefficient arrays, generated by transform_blocks
+    :param n:int number of color components
+    :param quality:int quality level, in percents
+    :return:bytes with encoded scanlines
+    """
+    predictions = [0] * n
+    block = [0] * 64
+    tables = _EncoderTables(quality).component_tables(n)
+    encoder = EntropyEncoder()
+
+    c = 0
+    for coefficients_block in coefficients:
+        scale, dc, ac = tables[c]
+        predictions[c] = encoder.encode_coefficients(predictions[c], coefficients_block, scale, dc, ac, block)
+        c += 1
+        if c == n:
+            c = 0
+
+    encoder.write(0x7f, 7)  # padding
+    return encoder.dump()
+
+
+@timed('serialize_for_size')
+def serialize_for_size(image, target_size, min_quality=5, max_quality=95, max_probes=7, coefficients=None):
+    """
+    Serializes JPEG with the best quality, that fits the size budget
+    DCT is done only once, so every probe costs only quantization and entropy coding.
+    Quality is picked by a binary search, limited by max_probes
+    :param image:JpegFile or ReferenceJpeg with decoded image data
+    :param target_size:int desired size of encoded scanlines, in bytes
+    :param min_quality:int lowest quality to be used. Result can exceed the budget at this quality
+    :param max_quality:int highest quality to be used
+    :param max_probes:int maximum number of encoding attempts
+    :param coefficients:list precomputed result of transform_blocks(image)
+    :return:tuple (bytes serialized image, int quality)
+    """
+    if coefficients is None:
+        coefficients = transform_blocks(image)
+    n = image.n
+
+    best_quality, best_data = None, None
+    low, high = min_quality, max_quality
+    probes = 0
+    while low <= high and probes < max_probes:
+        # Trying the top quality first, as it fits the budget quite often
+        quality = high if probes == 0 else (low + high + 1) // 2
+        data = serialize_coefficients(coefficients, n, quality)
+        probes += 1
+        logger.debug("Rate control probe q=%d: %d bytes of %d" % (quality, len(data), target_size))
+        if len(data) <= target_size:
+            best_quality, best_data = quality, data
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if best_data is None:
+        best_quality = min_quality
+        best_data = serialize_coefficients(coefficients, n, best_quality)
+        logger.warn("Frame does not fit %d bytes even at q=%d: got %d bytes" %
+                    (target_size, best_quality, len(best_data)))
+
+    return serialize(image, best_quality, best_data), best_quality
+
+
+def make_scan_jpeg(width, height, n, quality, data, reset_interval=0):
+    """
+    Makes JpegFile around scanlines, encoded by serialize_scanlines
+    It skips building and parsing of a complete jpeg file, so it is cheap enough for live streams
+    :param width:int image width
+    :param height:int image height
+    :param n:int number of color components
+    :param quality:int quality, used to encode scanlines
+    :param data:bytes encoded scanlines
+    :param reset_interval:int restart interval, used to encode scanlines
+    :return:JpegFile
+    """
+    jpeg = JpegFile()
+    jpeg.width, jpeg.height = width, height
+    jpeg.reset_interval = reset_interval
+    jpeg.kind = 'g' if n == 1 else 'rgb'
+    # serialize_scanlines uses 1x1 sampling for every component
+    jpeg.type = 0
+    for index, table in enumerate((_luminance_quantization, _chrominance_quantization)):
+        qt = _quantization_table(table, quality)
+        natural = bytearray(64)
+        natural[0] = qt[0]
+        for i, z in enumerate(_z_z):
+            natural[z] = qt[i + 1]
+        jpeg.qtables[index] = natural
+        jpeg.qtables_raw[index] = qt
+    jpeg._image_data = data
+    return jpeg
+
+
+@timed('serialize')
+def serialize(image, quality, data=None, reset_interval=0):
     """
     Serializes JPEG to a bytearray using standard MJPEG tables
     It can be dumped to jpeg file directly
     :param image:JpegFile or ReferenceJpeg with decoded image data
     :param quality:int quality, in percents
+    :param data:bytes scanlines, already encoded with the same quality. Encoded from image if None
+    :param reset_interval:int restart interval, used to encode the data
     :return:bytes serialized image
     """
-    if image.kind not in ('g', 'rgb', 'cmyk'):
+    if image.kind not in ('g', 'rgb', 'ycc', 'cmyk'):
         raise ValueError('Invalid image kind.')
 
-    w, h, n = image.width, image.height, len(image.components)
-    data = serialize_scanlines(image, quality)
+    w, h, n = image.width, image.height, image.n
+    if data is None:
+        data = serialize_scanlines(image, quality)
 
     lq = _quantization_table(_luminance_quantization, quality)
     ld = _huffman_table(_lum_dc_code_length, _lum_dc_symbols)
@@ -1651,6 +2007,8 @@ def serialize(image, quality):
     output.write(_marker_segment(b'\xdb', dqt))
     output.write(_marker_segment(b'\xc0', sof))
     output.write(_marker_segment(b'\xc4', dht))
+    if reset_interval:
+        output.write(_marker_segment(b'\xdd', pack('>H', reset_interval)))
     output.write(_marker_segment(b'\xda', sos))
     output.write(data)
     output.write(b'\xff\xd9')  # EOI
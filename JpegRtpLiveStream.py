@@ -0,0 +1,300 @@
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock, Thread
+from math import sin, pi
+from time import time
+import logging
+
+from JpegFile import serialize_scanlines, serialize_interval, make_scan_jpeg, IncrementalScanEncoder
+from JpegRtpStillStream import RtpJpegEncoder
+
+logger = logging.getLogger(__name__)
+
+"""
+Streams raw frames from live sources, like cameras, pipes or test generators.
+Frames are encoded to jpeg in a pool of workers and packetized on demand
+"""
+
+# Number of color components for each supported pixel format
+PIXEL_FORMATS = {
+    'gray': 1,
+    'rgb': 3,
+    # Packed YCbCr 4:4:4, i.e. ffmpeg's 'yuv444p' interleaved to 3 bytes per pixel
+    'yuv': 3,
+}
+
+
+class RawFrame(object):
+    """
+    Uncompressed frame, that can be passed to serialize_scanlines
+    """
+    __slots__ = 'width', 'height', 'n', 'kind', 'pixels'
+
+    def __init__(self, width, height, pixel_format, pixels):
+        self.width = width
+        self.height = height
+        self.n = PIXEL_FORMATS[pixel_format]
+        self.kind = {'gray': 'g', 'rgb': 'rgb', 'yuv': 'ycc'}[pixel_format]
+        self.pixels = pixels
+
+
+def frame_bytes(frame, width, height, pixel_format):
+    """
+    Extracts pixel data from a frame object
+    :param frame: numpy uint8 array with shape (height, width[, channels]) or any buffer
+    :param width:int expected frame width
+    :param height:int expected frame height
+    :param pixel_format:string one of PIXEL_FORMATS
+    :return:bytes pixel data
+    """
+    shape = getattr(frame, 'shape', None)
+    if shape is not None and (shape[0] != height or shape[1] != width):
+        raise ValueError("Frame has wrong shape %s, expected %dx%d" % (str(shape), width, height))
+
+    data = memoryview(frame)
+    expected = width * height * PIXEL_FORMATS[pixel_format]
+    if data.nbytes != expected:
+        raise ValueError("Frame has %d bytes, expected %d" % (data.nbytes, expected))
+    return data.tobytes()
+
+
+def encode_frame(frame, quality):
+    """
+    Encodes scanlines of a raw frame. It is run inside encoder workers
+    :param frame:RawFrame
+    :param quality:int jpeg quality
+    :return:bytes encoded scanlines
+    """
+    return serialize_scanlines(frame, quality)
+
+
+def encode_bands(width, pixel_format, quality, bands):
+    """
+    Encodes bands of a frame as separate restart intervals. It is run inside encoder workers
+    :param width:int frame width
+    :param pixel_format:string one of PIXEL_FORMATS
+    :param quality:int jpeg quality
+    :param bands:list of bytes with band pixels
+    :return:list of bytes with encoded intervals
+    """
+    result = []
+    for pixels in bands:
+        height = len(pixels) // (width * PIXEL_FORMATS[pixel_format])
+        band = RawFrame(width, height, pixel_format, pixels)
+        result.append(serialize_interval(band, quality, 0, height))
+    return result
+
+
+def make_test_pattern(width, height, frame_index, total_frames=96):
+    """
+    Generates a frame with slowly cycling color, like tests/test_video.py does
+    :return:bytes RGB pixel data
+    """
+    phase = frame_index / float(total_frames)
+    color = bytes(int(round(255 * (0.5 + 0.5 * sin(2 * pi * (c / 3.0 + phase))))) for c in range(3))
+    return color * (width * height)
+
+
+class RtpJpegLiveStream(RtpJpegEncoder):
+    """
+    RTP stream of raw frames, pushed by a producer
+
+    Producer calls push_frame from any thread. Frames are encoded in a bounded pool of workers.
+    If all workers are busy, new frames are dropped, so the stream never lags behind the source
+
+    Incremental mode suits screen captures and fixed cameras. Every band of block rows is a separate
+    restart interval, and only changed bands are encoded. They are spread over workers, so a single
+    frame is encoded at a time
+    """
+    def __init__(self, width, height, pixel_format='rgb', quality=80, fps=25.0, packet_size=1000,
+                 workers=2, executor=None, incremental=False):
+        """
+        :param width:int frame width
+        :param height:int frame height
+        :param pixel_format:string one of PIXEL_FORMATS
+        :param quality:int jpeg quality
+        :param fps:float framerate of the source
+        :param packet_size:int desired RTP packet size
+        :param workers:int maximum number of frames being encoded at once
+        :param executor: concurrent.futures executor. ProcessPoolExecutor is created if None
+        :param incremental:bool encode only changed bands of the frame
+        """
+        super(RtpJpegLiveStream, self).__init__()
+        if pixel_format not in PIXEL_FORMATS:
+            raise ValueError("Unsupported pixel format %s" % pixel_format)
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.pixel_format = pixel_format
+        self._quality = quality
+        self._packet_size = packet_size
+        self._workers = workers
+        self._own_executor = executor is None
+        self._executor = executor or ProcessPoolExecutor(max_workers=workers)
+        self._lock = Lock()
+        self._incremental = None
+        if incremental:
+            self._incremental = IncrementalScanEncoder(width, height, PIXEL_FORMATS[pixel_format], quality)
+        # Maximum number of frames being encoded at once
+        self._max_in_flight = 1 if incremental else workers
+        # Number of frames being encoded right now
+        self._in_flight = 0
+        self._last_pushed = 0
+        # The latest encoded frame, waiting to be sent: (frame_index, timestamp, JpegFile)
+        self._ready = None
+        self._last_ready = 0
+        # Packets of the current frame, returned by next_packet
+        self._pending = []
+        # Statistics
+        self.frames_dropped = 0
+        self.frames_encoded = 0
+        self.bands_encoded = 0
+
+    def push_frame(self, frame, timestamp=None):
+        """
+        Pushes raw frame to the encoder
+        :param frame: numpy uint8 array with shape (height, width[, channels]) or any buffer
+        :param timestamp:float capture time. Current time is used if None
+        :return:bool True if frame was accepted, False if it was dropped
+        """
+        if timestamp is None:
+            timestamp = time()
+        with self._lock:
+            if self._in_flight >= self._max_in_flight:
+                self.frames_dropped += 1
+                return False
+            self._in_flight += 1
+            self._last_pushed += 1
+            index = self._last_pushed
+
+        try:
+            pixels = frame_bytes(frame, self.width, self.height, self.pixel_format)
+            if self._incremental is not None:
+                self._push_incremental(pixels, index, timestamp)
+            else:
+                raw = RawFrame(self.width, self.height, self.pixel_format, pixels)
+                future = self._executor.submit(encode_frame, raw, self._quality)
+                future.add_done_callback(lambda f: self._on_encoded(f, index, timestamp))
+        except:
+            with self._lock:
+                self._in_flight -= 1
+            raise
+        return True
+
+    def _push_incremental(self, pixels, index, timestamp):
+        encoder = self._incremental
+        changed = encoder.changed_bands(pixels)
+        # Splitting changed bands between workers
+        chunks = [changed[i::self._workers] for i in range(self._workers) if changed[i::self._workers]]
+        pending = [len(chunks)]
+
+        def on_chunk_encoded(future, chunk):
+            with self._lock:
+                if future.exception() is None:
+                    for band, data in zip(chunk, future.result()):
+                        encoder.update(band, data)
+                    self.bands_encoded += len(chunk)
+                else:
+                    # Band should be encoded again with the next frame
+                    logger.error("Failed to encode frame %d: %s" % (index, str(future.exception())))
+                    encoder.forget_bands(chunk)
+                pending[0] -= 1
+                if pending[0] > 0:
+                    return
+                self._in_flight -= 1
+                data = encoder.scan_data()
+                if data is not None:
+                    self._set_ready(index, timestamp, data)
+
+        if not chunks:
+            # Nothing has changed, so the previous scan is sent again
+            with self._lock:
+                self._in_flight -= 1
+                data = encoder.scan_data()
+                if data is not None:
+                    self._set_ready(index, timestamp, data)
+            return
+
+        for chunk in chunks:
+            bands = [encoder.band_pixels(band) for band in chunk]
+            future = self._executor.submit(encode_bands, self.width, self.pixel_format, self._quality, bands)
+            future.add_done_callback(lambda f, chunk=chunk: on_chunk_encoded(f, chunk))
+
+    def _on_encoded(self, future, index, timestamp):
+        with self._lock:
+            self._in_flight -= 1
+            if future.exception() is not None:
+                logger.error("Failed to encode frame %d: %s" % (index, str(future.exception())))
+                return
+            self._set_ready(index, timestamp, future.result())
+
+    def _set_ready(self, index, timestamp, data):
+        """
+        Makes encoded frame ready to be sent. It should be called under the lock
+        """
+        self.frames_encoded += 1
+        # Workers can finish out of order. Older frames are just dropped
+        if index <= self._last_ready:
+            self.frames_dropped += 1
+            return
+        if self._ready is not None:
+            self.frames_dropped += 1
+        self._last_ready = index
+        reset_interval = self._incremental.reset_interval if self._incremental is not None else 0
+        jpeg = make_scan_jpeg(self.width, self.height, PIXEL_FORMATS[self.pixel_format],
+                              self._quality, data, reset_interval)
+        self._ready = (index, timestamp, jpeg)
+
+    def next_frame(self, variant=None):
+        with self._lock:
+            ready, self._ready = self._ready, None
+        if ready is None:
+            return None
+        index, timestamp, jpeg = ready
+        return self.encode_rtp(timestamp, jpeg, self._packet_size)
+
+    def next_packet(self, variant=None):
+        if not self._pending:
+            self._pending = self.next_frame(variant) or []
+            self._pending.reverse()
+        if not self._pending:
+            return None
+        return self._pending.pop()
+
+    def sdp_options(self):
+        options = super(RtpJpegLiveStream, self).sdp_options()
+        options['width'] = self.width
+        options['height'] = self.height
+        return options
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown()
+
+
+def read_raw_frames(file, stream):
+    """
+    Reads raw frames of the stream format from a file or a pipe, like
+    ffmpeg -i <input> -f rawvideo -pix_fmt rgb24 pipe:1
+    :param file: binary file object
+    :param stream:RtpJpegLiveStream
+    :return:int number of frames read
+    """
+    frame_size = stream.width * stream.height * PIXEL_FORMATS[stream.pixel_format]
+    count = 0
+    while True:
+        frame = file.read(frame_size)
+        if len(frame) != frame_size:
+            logger.info("Raw frame source is closed after %d frames" % count)
+            return count
+        stream.push_frame(frame)
+        count += 1
+
+
+def start_reader_thread(target, *args):
+    """
+    Runs a frame producer in a daemon thread
+    """
+    thread = Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
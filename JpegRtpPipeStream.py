@@ -0,0 +1,257 @@
+from threading import Condition, Thread
+from time import time
+import logging
+import os
+import stat
+
+from JpegRtpStillStream import RtpJpegEncoder, load_rtp_compatible
+
+logger = logging.getLogger(__name__)
+
+"""
+Streams MJPEG from pipes, FIFOs or files with concatenated jpeg frames, like
+ffmpeg -i <input> -f mjpeg pipe:1
+
+Frames are not decoded. Only jpeg headers are parsed and scan data is packetized as is
+"""
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+
+def jpeg_frame_end(data, start, end):
+    """
+    Finds the end of jpeg frame, starting from SOI at specified position
+    Marker segments are skipped by their length, so EOI markers of embedded thumbnails are not confused
+    with the real one. Entropy-coded data can not contain EOI, so it is scanned by bytes.find
+    :param data:bytearray buffer with jpeg data
+    :param start:int position of SOI marker
+    :param end:int end of valid data in the buffer
+    :return:int position right after EOI, or -1 if frame is not complete yet
+    """
+    pos = start + 2
+    while pos + 4 <= end:
+        if data[pos] != 0xff:
+            raise ValueError("Invalid marker at %d" % (pos - start))
+        marker = data[pos + 1]
+        if marker == 0xff:  # Fill byte
+            pos += 1
+            continue
+        if marker == 0xd9:  # EOI without scan data
+            return pos + 2
+        length = data[pos + 2] << 8 | data[pos + 3]
+        pos += 2 + length
+        if marker == 0xda:  # SOS
+            eoi = data.find(EOI, pos, end)
+            return -1 if eoi < 0 else eoi + 2
+    return -1
+
+
+class JpegSplitter:
+    """
+    Splits a byte stream of concatenated jpegs to separate frames
+
+    Data is read to a reusable buffer, that grows only if a single frame does not fit it
+    """
+    def __init__(self, file, buffer_size=1 << 20):
+        """
+        :param file: binary file object with readinto method
+        :param buffer_size:int initial size of the buffer
+        """
+        self._file = file
+        self._buffer = bytearray(buffer_size)
+        # Start and end of valid data in the buffer
+        self._start = 0
+        self._end = 0
+
+    def reset(self):
+        """
+        Drops buffered data. It should be called after source file is rewound
+        """
+        self._start = self._end = 0
+
+    def _read(self):
+        """
+        Reads more data to the buffer
+        :return:bool False on EOF
+        """
+        buffer = self._buffer
+        if self._start > 0:
+            # Moving unparsed tail to the start. It does not reallocate the buffer
+            length = self._end - self._start
+            buffer[0:length] = buffer[self._start:self._end]
+            self._start, self._end = 0, length
+        if self._end == len(buffer):
+            # A frame does not fit the buffer
+            grown = bytearray(len(buffer) * 2)
+            grown[0:self._end] = buffer[0:self._end]
+            self._buffer = buffer = grown
+            logger.info("Growing jpeg buffer to %d bytes" % len(grown))
+
+        with memoryview(buffer) as view:
+            read = self._file.readinto(view[self._end:])
+        if not read:
+            return False
+        self._end += read
+        return True
+
+    def frames(self):
+        """
+        Generates frames from the stream
+        Frame memory is reused, so it is valid only until next frame is requested
+        :return:generator of memoryview with complete jpeg frames
+        """
+        while True:
+            buffer = self._buffer
+            soi = buffer.find(SOI, self._start, self._end)
+            if soi < 0:
+                # Keeping the last byte, it can be the first half of SOI
+                self._start = max(self._start, self._end - 1)
+            else:
+                self._start = soi
+                try:
+                    frame_end = jpeg_frame_end(buffer, soi, self._end)
+                except ValueError as e:
+                    logger.error("Skipping corrupted jpeg: %s" % str(e))
+                    self._start = soi + 2
+                    continue
+                if frame_end > 0:
+                    self._start = frame_end
+                    with memoryview(buffer) as view:
+                        frame = view[soi:frame_end]
+                        yield frame
+                        frame.release()
+                    continue
+
+            if not self._read():
+                return
+
+
+class RtpJpegPipeStream(RtpJpegEncoder):
+    """
+    RTP stream of jpeg frames, read from a pipe, a FIFO or a file
+
+    Frames, that can be sent by RFC 2435, are packetized without transcoding.
+    The rest of them are transcoded to standard MJPEG
+    """
+    def __init__(self, source, fps=25.0, packet_size=1000, quality=80, live=None, loop=True):
+        """
+        :param source: path to a file or FIFO, or binary file object
+        :param fps:float stream framerate
+        :param packet_size:int desired RTP packet size
+        :param quality:int jpeg quality for transcoded frames
+        :param live:bool if True, frames are dropped when sender can not keep up.
+                Otherwise reader waits for the sender. Regular files are not live by default
+        :param loop:bool restart regular files from the beginning on EOF
+        """
+        super(RtpJpegPipeStream, self).__init__()
+        self.fps = fps
+        self._packet_size = packet_size
+        self._quality = quality
+        if isinstance(source, str):
+            self._path = source
+            self._file = open(source, 'rb')
+        else:
+            self._path = getattr(source, 'name', str(source))
+            self._file = source
+        try:
+            regular = stat.S_ISREG(os.fstat(self._file.fileno()).st_mode)
+        except (AttributeError, OSError, ValueError):
+            regular = False
+        self._live = not regular if live is None else live
+        self._loop = loop and regular
+        self.width = 0
+        self.height = 0
+        self._ready_condition = Condition()
+        # Payloads of the latest frame, waiting to be sent: (timestamp, payloads)
+        self._ready = None
+        # Packets of the current frame, returned by next_packet
+        self._pending = []
+        self._closed = False
+        # Statistics
+        self.frames_passed = 0
+        self.frames_transcoded = 0
+        self.frames_dropped = 0
+
+        self._reader = Thread(target=self._read_frames)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _prepare_frame(self, frame):
+        """
+        Parses jpeg header and packetizes the frame
+        :param frame:memoryview with a complete jpeg
+        :return:tuple (JpegFile, list of RTP payloads). Payloads are None for broken frames
+        """
+        try:
+            jpeg, reason = load_rtp_compatible(frame, self._quality)
+        except ValueError as e:
+            logger.error("Failed to transcode a frame from %s: %s" % (self._path, str(e)))
+            return None, None
+        if reason is None:
+            self.frames_passed += 1
+        else:
+            if self.frames_transcoded == 0:
+                logger.warn("Transcoding frames from %s: %s" % (self._path, reason))
+            self.frames_transcoded += 1
+        return jpeg, self.packetize(jpeg, self._packet_size)
+
+    def _read_frames(self):
+        splitter = JpegSplitter(self._file)
+        while not self._closed:
+            for frame in splitter.frames():
+                jpeg, payloads = self._prepare_frame(frame)
+                if not payloads:
+                    continue
+                self.width, self.height = jpeg.width, jpeg.height
+                with self._ready_condition:
+                    if self._ready is not None:
+                        if self._live:
+                            self.frames_dropped += 1
+                        else:
+                            self._ready_condition.wait_for(lambda: self._ready is None or self._closed)
+                    if self._closed:
+                        return
+                    self._ready = (time(), payloads)
+
+            if not self._loop:
+                break
+            self._file.seek(0)
+            splitter.reset()
+        logger.info("Jpeg source %s is closed" % self._path)
+
+    def next_frame(self, variant=None):
+        with self._ready_condition:
+            ready, self._ready = self._ready, None
+            self._ready_condition.notify()
+        if ready is None:
+            return None
+
+        timestamp, payloads = ready
+        rtp_time = self.get_timestamp_90khz(timestamp)
+        last = len(payloads) - 1
+        result = []
+        for i, payload in enumerate(payloads):
+            result.append(self.make_packet(payload, self.seq, rtp_time, int(i == last)))
+            self.seq += 1
+        return result
+
+    def next_packet(self, variant=None):
+        if not self._pending:
+            self._pending = self.next_frame(variant) or []
+            self._pending.reverse()
+        if not self._pending:
+            return None
+        return self._pending.pop()
+
+    def sdp_options(self):
+        options = super(RtpJpegPipeStream, self).sdp_options()
+        options['width'] = self.width
+        options['height'] = self.height
+        return options
+
+    def close(self):
+        with self._ready_condition:
+            self._closed = True
+            self._ready_condition.notify()
+        self._file.close()
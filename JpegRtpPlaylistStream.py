@@ -0,0 +1,178 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from threading import Lock, Thread
+from time import sleep, time
+import logging
+import os
+
+from AssetCache import prewarm_asset
+from AssetCatalog import read_playlist
+from JpegRtpStillStream import RtpJpegFileStream
+
+logger = logging.getLogger(__name__)
+
+"""
+Slideshow of still jpegs
+
+Playlist is a directory with jpegs or an .m3u file. Every image is shown for a dwell time,
+then the stream switches to the next one and starts over after the last one
+"""
+
+# Transcoding workers and loader threads are shared by all the playlists of the process
+TRANSCODE_WORKERS = 2
+LOADER_THREADS = 4
+
+_pools_lock = Lock()
+_transcoder = None
+_loader = None
+
+
+def _watch_server(server):
+    """
+    Stops a transcoding worker, when the server process is gone. Pool is never shut down by a killed server
+    :param server:int pid of the server process
+    """
+    def check_server():
+        while os.getppid() == server:
+            sleep(1)
+        os._exit(0)
+    watcher = Thread(target=check_server)
+    watcher.daemon = True
+    watcher.start()
+
+
+def _transcode_pool():
+    global _transcoder
+    with _pools_lock:
+        if _transcoder is None:
+            # Spawned workers do not inherit server sockets, so they can not keep them busy
+            # after the server is gone
+            _transcoder = ProcessPoolExecutor(max_workers=TRANSCODE_WORKERS, mp_context=get_context('spawn'),
+                                              initializer=_watch_server, initargs=(os.getpid(),))
+        return _transcoder
+
+
+def _loader_pool():
+    global _loader
+    with _pools_lock:
+        if _loader is None:
+            _loader = ThreadPoolExecutor(max_workers=LOADER_THREADS)
+        return _loader
+
+
+class RtpJpegPlaylistStream(RtpJpegFileStream):
+    """
+    RTP stream that cycles through the images of a playlist
+    Next image is loaded from the cache, or transcoded and packetized by a shared worker process, ahead of
+    time. Nothing is parsed or packetized on IOLoop then. Each variant swaps
+    to it at a frame boundary, the same way as a reloaded file. Sequence numbers and timestamps go on
+    across the images, so clients see a single continuous stream
+    """
+    DEFAULT_DWELL = 5.0
+
+    def __init__(self, path, dwell=DEFAULT_DWELL, packet_size=RtpJpegFileStream.DEFAULT_PACKET_SIZE,
+                 qualities=None, frame_budget=None, cache=None, executor=None, refresh_rate=None):
+        """
+        :param path:string path to a directory or .m3u file
+        :param dwell:float seconds to show each image. M3U can override it per image
+        :param packet_size:int desired RTP packet size
+        :param qualities:list of quality levels to be encoded. DEFAULT_QUALITY is used if empty
+        :param frame_budget:int maximum size of encoded frame, in bytes, or None
+        :param cache:AssetCache for encoded images, or None
+        :param executor:Executor for transcoding. Worker processes, shared by playlists, are used if None
+        :param refresh_rate:float number of times per second the image is repeated, or None for DEFAULT_FPS.
+                Images are switched at these frame boundaries
+        """
+        # List of tuples (path, duration or None)
+        self._items = read_playlist(path)
+        if not self._items:
+            raise IOError("Playlist %s has no images" % path)
+        self._playlist = path
+        self._dwell = dwell
+        self._cache = cache
+        self._executor = executor
+        # Index of the image being shown
+        self._index = 0
+        # Time to switch to the next image. The clock starts with the first packet
+        self._switch_at = None
+        # Tuple (index, Future with tuple (variants, seconds spent)) of the next image
+        self._next = None
+
+        first = self._items[0][0]
+        encoded = cache.load(first) if cache is not None else None
+        super(RtpJpegPlaylistStream, self).__init__(first, packet_size, qualities, frame_budget, encoded,
+                                                    refresh_rate)
+        logger.info("Opened playlist %s with %d images" % (path, len(self._items)))
+        self._prefetch(1)
+
+    def _item_dwell(self, index):
+        return self._items[index][1] or self._dwell
+
+    def _prefetch(self, index):
+        """
+        Starts preparing the image in background
+        """
+        index %= len(self._items)
+        if index == self._index:
+            # Single image is never switched
+            return
+        path = self._items[index][0]
+        self._next = (index, _loader_pool().submit(self._prepare, path))
+
+    def _prepare(self, path):
+        """
+        Loads or transcodes the image, and makes its variants. It runs in a loader thread
+        :param path:string path to jpeg file
+        :return:tuple (dict quality->JpegVariant, float seconds spent)
+        """
+        start = time()
+        encoded = self._cache.load(path) if self._cache is not None else None
+        if encoded is None:
+            executor = self._executor or _transcode_pool()
+            encoded, elapsed = executor.submit(prewarm_asset, path, self._qualities, self._frame_budget,
+                                               self._packet_size).result()
+            if self._cache is not None:
+                self._cache.store(path, encoded)
+        # Disk cache keeps no payloads, so images from it are packetized here
+        variants = self._make_variants(encoded)
+        return variants, time() - start
+
+    def _advance(self):
+        """
+        Switches to the next image, if its time has come and it is ready
+        """
+        now = time()
+        if self._switch_at is None:
+            self._switch_at = now + self._item_dwell(self._index)
+            return
+        if now < self._switch_at or self._next is None:
+            return
+        index, future = self._next
+        if not future.done():
+            # Current image is shown a bit longer, rather than stalling the stream
+            return
+
+        self._next = None
+        self._index = index
+        self._switch_at = now + self._item_dwell(index)
+        path = self._items[index][0]
+        if future.exception() is not None:
+            logger.error("Skipping %s of playlist %s: %s" % (path, self._playlist, str(future.exception())))
+        else:
+            variants, elapsed = future.result()
+            self._path = path
+            # Each variant swaps at its own frame boundary, to the latest image
+            self.queue_variants(variants)
+            logger.info("Playlist %s switched to [%d/%d] %s, prepared in %.3fs" %
+                        (self._playlist, index + 1, len(self._items), path, elapsed))
+        self._prefetch(index + 1)
+
+    def next_packet(self, variant=None):
+        if self.get_variant(variant).position == 0:
+            self._advance()
+        return super(RtpJpegPlaylistStream, self).next_packet(variant)
+
+    def close(self):
+        super(RtpJpegPlaylistStream, self).close()
+        # Image, being prepared, is dropped when it is ready. Shared workers go on
+        self._next = None
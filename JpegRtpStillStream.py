@@ -2,8 +2,9 @@ from struct import pack_into, unpack_from, pack, pack_into
 from sdp_utils import make_sdp2
 from RtpFrameGenerator import RtpPacket, RtpFrameGenerator
 from time import time
+from Timing import stages, timed
 
-from JpegFile import JpegFile, serialize_scanlines, ReferenceJpeg, serialize
+from JpegFile import JpegFile, serialize_scanlines, ReferenceJpeg, serialize, serialize_for_size, transform_blocks
 import logging
 
 logger = logging.getLogger(__name__)
@@ -12,6 +13,8 @@ RTP_JPEG_RESTART = 0x40
 RTP_PT_JPEG = 26
 JPG_HDR_SIZE = 8  # Number of bytes for RTP-JPG header
 DRI_SIZE = 4  # Number of bytes for DRI
+QT_SIZE = 132  # Number of bytes for in-band quantization tables
+EOI_SIZE = 2  # Number of bytes for EOI marker
 
 """
 TODO: Check huffman table inside jpeg. We need to repack it
@@ -38,6 +41,107 @@ def make_jpeg_data_standard(raw_data, quality):
     return out_data
 
 
+def rtp_incompatibility(jpeg):
+    """
+    Checks if parsed jpeg can be packetized to RTP as is
+    RFC 2435 restricts jpegs to baseline YCbCr images with standard Huffman tables
+    :param jpeg:JpegFile parsed jpeg header
+    :return:string reason, why jpeg should be transcoded, or None if it is compatible
+    """
+    if jpeg.progressive:
+        return "progressive encoding"
+    if len(jpeg.components) != 3:
+        return "%d color components" % len(jpeg.components)
+    luma = jpeg.components[0]
+    # 1x1 luma is sent with type 0 as well, the same way as transcoded frames are
+    if (luma.h, luma.v) not in ((1, 1), (2, 1), (2, 2)):
+        return "luma sampling %dx%d" % (luma.h, luma.v)
+    if jpeg.width % 8 != 0 or jpeg.height % 8 != 0 or jpeg.width > 2040 or jpeg.height > 2040:
+        return "image size %dx%d" % (jpeg.width, jpeg.height)
+    if 0 not in jpeg.qtables_raw or 1 not in jpeg.qtables_raw:
+        return "missing 8-bit quantization tables"
+    if not jpeg.has_standard_huffman_tables():
+        return "custom Huffman tables"
+    return None
+
+
+def load_rtp_compatible(data, quality):
+    """
+    Parses a jpeg frame, transcoding it to standard MJPEG if it can not be sent by RFC 2435
+    :param data:bytes or memoryview with a complete jpeg
+    :param quality:int jpeg quality for transcoded frames
+    :return:tuple (JpegFile, reason). Reason is None if frame was not transcoded
+    raises ValueError if frame can not be transcoded
+    """
+    jpeg = JpegFile()
+    if jpeg.load_data(data):
+        reason = rtp_incompatibility(jpeg)
+        if reason is None:
+            return jpeg, None
+    else:
+        reason = "broken header"
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    jpeg = JpegFile()
+    if not jpeg.load_data(make_jpeg_data_standard(data, quality)):
+        raise ValueError("Transcoded frame is broken")
+    return jpeg, reason
+
+
+def scan_budget(frame_budget, packet_size, restart=False, qtables=True):
+    """
+    Calculates size of entropy coded data, that fits the frame budget once it is packetized.
+    Every RTP packet adds RTP and RTP/JPEG headers, the first one carries quantization tables, and the last one
+    carries EOI marker after the scan data
+    :param frame_budget:int maximum number of bytes of RTP packets of a frame
+    :param packet_size:int RTP payload size
+    :param restart:bool frame has restart markers, so every packet has restart header
+    :param qtables:bool quantization tables are sent in-band, as they are for Q>127
+    :return:int number of bytes of scan data
+    """
+    header = JPG_HDR_SIZE + (DRI_SIZE if restart else 0)
+    tables = QT_SIZE if qtables else 0
+    # The largest number of packets, that the frame can take
+    packets = -(-frame_budget // (packet_size + RtpPacket.HEADER_SIZE))
+    return max(frame_budget - packets * (RtpPacket.HEADER_SIZE + header) - tables - EOI_SIZE, 0)
+
+
+def encode_variants(raw_data, qualities, frame_budget=None, packet_size=None):
+    """
+    Decodes a jpeg once and encodes it with each quality
+    :param raw_data:bytes source jpeg
+    :param qualities:list of int jpeg qualities
+    :param frame_budget:int maximum size of RTP packets of encoded frame. Qualities are upper limits then
+    :param packet_size:int RTP payload size. It is needed by frame_budget
+    :return:list of tuples (quality, used quality, bytes encoded jpeg)
+    """
+    # Decoding is the most expensive part, so it is done once for all the variants
+    ref_image = ReferenceJpeg(raw_data)
+    ref_image.decompress_ref()
+
+    result = []
+    coefficients = transform_blocks(ref_image) if frame_budget else None
+    for quality in qualities:
+        if frame_budget:
+            data, used_quality = serialize_for_size(ref_image, scan_budget(frame_budget, packet_size),
+                                                    max_quality=quality, coefficients=coefficients)
+        else:
+            data, used_quality = serialize(ref_image, quality), quality
+        result.append((quality, used_quality, data))
+    return result
+
+
+def frame_budget(bitrate, fps):
+    """
+    Calculates frame size budget for the stream
+    :param bitrate:int target bitrate, in bits per second
+    :param fps:float stream framerate
+    :return:int number of bytes per frame
+    """
+    return int(bitrate / (8.0 * fps))
+
+
 class RtpJpegEncoder(RtpFrameGenerator):
     """
     Encodes Jpeg file to RTP packets
@@ -97,9 +201,11 @@ class RtpJpegEncoder(RtpFrameGenerator):
         output = bytearray()
         width_packed = jpeg.width >> 3
         height_packed = jpeg.height >> 3
+        # Types 64-127 tell that restart markers are present
+        jpeg_type = jpeg.type | RTP_JPEG_RESTART if jpeg.reset_interval else jpeg.type
         header = pack('!BBHBBBB',
                       self.jpeg_TypeSpecific,
-                      hoffset, loffset, jpeg.type, self.jpeg_Q,
+                      hoffset, loffset, jpeg_type, self.jpeg_Q,
                       width_packed, height_packed)
 
         output += header
@@ -144,110 +250,302 @@ class RtpJpegEncoder(RtpFrameGenerator):
         jpeg_offset = next_jpeg_pos
         return output, jpeg_offset
 
-    # Encode to RTP payload stream
-    def encode_rtp(self, timestamp, jpeg, max_datagram_size):
+    @timed('packetize')
+    def packetize(self, jpeg, max_datagram_size):
         """
-        :param timestamp:Time
+        Splits jpeg scan data to a list of RTP payloads
+        Payloads do not depend on RTP header, so they can be cached and reused
         :param jpeg:JpegFile parsed Jpeg object
-        :param max_datagram_size:
-        :return:
+        :param max_datagram_size:int
+        :return:list of RTP mjpeg payloads
         """
         jpeg_offset = 0
         total_length = len(jpeg.image_data)
         result = []
-        done = jpeg_offset >= total_length
-        first = True
 
-        while not done:
-            packet = self._create_rtp_packet()
-            packet.seqnum = self.seq
-            packet.timestamp = self.get_timestamp_90khz(timestamp)
-
-            frame_length = min(max_datagram_size, total_length-jpeg_offset)
+        while jpeg_offset < total_length:
             data, jpeg_offset = self.make_rtp_frame_payload(jpeg, jpeg_offset, max_datagram_size)
-            done = jpeg_offset >= total_length
+            result.append(data)
 
-            if done:
-                packet.marker = 1
+        return result
 
-            # TODO: hide it inside RtpPacket
-            # We should implement copyless jpeg serialization as well
-            header_size = packet.calc_header_size()
-            packet.raw_packet = bytearray(header_size + len(data))
-            packet.encode_header(packet.raw_packet, 0)
-            packet.raw_packet[header_size:] = data
+    def make_packet(self, payload, seqnum, timestamp, marker):
+        """
+        Wraps cached payload into RTP packet
+        :param payload:bytes RTP mjpeg payload
+        :param seqnum:int RTP sequence number
+        :param timestamp:int RTP timestamp, in 90kHz units
+        :param marker:int end-of-frame marker
+        :return:RtpPacket
+        """
+        packet = self._create_rtp_packet()
+        packet.seqnum = seqnum & 0xffff
+        packet.timestamp = timestamp & 0xffffffff
+        packet.marker = marker
+
+        # We should implement copyless jpeg serialization as well
+        header_size = packet.calc_header_size()
+        packet.raw_packet = bytearray(header_size + len(payload))
+        packet.encode_header(packet.raw_packet, 0)
+        packet.raw_packet[header_size:] = payload
+        return packet
+
+    # Encode to RTP payload stream
+    @timed('encode_rtp')
+    def encode_rtp(self, timestamp, jpeg, max_datagram_size):
+        """
+        :param timestamp:Time
+        :param jpeg:JpegFile parsed Jpeg object
+        :param max_datagram_size:
+        :return:
+        """
+        payloads = self.packetize(jpeg, max_datagram_size)
+        rtp_time = self.get_timestamp_90khz(timestamp)
+        last = len(payloads) - 1
+        result = []
 
+        for i, data in enumerate(payloads):
+            result.append(self.make_packet(data, self.seq, rtp_time, int(i == last)))
             self.seq += 1
-            result.append(packet)
 
         return result
 
+    def rtp_info(self, variant=None):
+        return self.seq & 0xffff, self.get_timestamp_90khz() & 0xffffffff
+
     def get_sdp(self, options):
-        return make_sdp2(options)
+        return make_sdp2(dict(options, **self.sdp_options()))
+
+
+class JpegVariant:
+    """
+    Jpeg asset, encoded with a specific quality
+    Keeps cached RTP payloads and playback position of its own RTP stream
+    """
+    def __init__(self, quality, jpeg, payloads):
+        """
+        :param quality:int quality of the encoded jpeg
+        :param jpeg:JpegFile parsed encoded jpeg
+        :param payloads:list cached RTP payloads
+        """
+        self.quality = quality
+        self.jpeg = jpeg
+        self.payloads = payloads
+        # Index of a next payload to be sent
+        self.position = 0
+        # Every variant is a separate RTP stream with its own sequence
+        self.seq = 0
+        # RTP timestamp of the frame being sent
+        self.rtp_time = 0
+        # Generation of the stream image, this variant belongs to
+        self.generation = 0
+
+    @property
+    def frame_size(self):
+        return sum(len(payload) for payload in self.payloads)
 
 
 class RtpJpegFileStream(RtpJpegEncoder):
     """
     RTP Stream that sends a single jpeg frame
+    Jpeg can be encoded with several quality levels. Each client picks its own variant
     """
-    def __init__(self, path, packet_size=1000):
+    DEFAULT_QUALITY = 80
+    DEFAULT_PACKET_SIZE = 1000
+
+    static = True
+
+    def __init__(self, path, packet_size=DEFAULT_PACKET_SIZE, qualities=None, frame_budget=None, encoded=None,
+                 refresh_rate=None):
         """
         :param path:string path to jpeg file
         :param packet_size:int desired RTP packet size
+        :param qualities:list of quality levels to be encoded. DEFAULT_QUALITY is used if empty
+        :param frame_budget:int maximum size of RTP packets of encoded frame, in bytes. Variant quality is
+                reduced to fit the budget. Qualities are used as is if None
+        :param encoded:list of tuples (quality, bytes jpeg, payloads or None), encoded ahead of time.
+                File is not read then
+        :param refresh_rate:float number of times per second the frame is repeated. It keeps decoders alive
+                and recovers lost packets. Frame is repeated at DEFAULT_FPS if None
         """
         super(RtpJpegFileStream, self).__init__()
-        self._jpeg = JpegFile()
+        if refresh_rate:
+            self.fps = refresh_rate
+        self._jpeg = None
         self._path = path
-        # Encoded RTP frames
-        self._frames = []
         self._packet_size = packet_size
-        self._generator = None
-        self._quality=80
-        self.read_data()
-
-    def get_sdp(self, options):
+        self._qualities = sorted(set(qualities or [self.DEFAULT_QUALITY]))
+        self._frame_budget = frame_budget
+        # Maps quality->JpegVariant
+        self._variants = {}
+        # Variants of the latest image: quality->JpegVariant. Variant of an older generation swaps to it
+        # at its own frame boundary, however many times the image was replaced meanwhile
+        self._pending = {}
+        # Generation of the latest image. Every replacement makes a new one
+        self._generation = 0
+        if encoded is None:
+            encoded = self.read_data()
+        self.set_variants(encoded)
+
+    @property
+    def qualities(self):
+        return self._qualities
+
+    def sdp_options(self):
+        options = super(RtpJpegFileStream, self).sdp_options()
         options['width'] = self._jpeg.width
         options['height'] = self._jpeg.height
-        return super(RtpJpegFileStream, self).get_sdp(options)
+        return options
 
     def read_data(self):
+        """
+        Reads and transcodes the file
+        :return:list of tuples (quality, bytes jpeg, None)
+        """
         logger.info("Opening jpeg file %s"%self._path)
-        file = open(self._path, 'rb')
-        raw_data_base = file.read()
-        file.close()
+        with stages.time('file_read'):
+            file = open(self._path, 'rb')
+            raw_data_base = file.read()
+            file.close()
         logger.info("Starting JPEG decoding")
-        raw_data = make_jpeg_data_standard(raw_data_base, self._quality)
-
-        if raw_data is None:
-            raise IOError("Failed to open the file %s" % self._path)
-
+        result = []
+        for quality, used_quality, raw_data in encode_variants(raw_data_base, self._qualities, self._frame_budget,
+                                                                 self._packet_size):
+            logger.info("Encoded variant q=%d (used q=%d): %d bytes" % (quality, used_quality, len(raw_data)))
+            result.append((quality, raw_data, None))
         logger.info("Done JPEG decoding")
-        #logger.debug("Loaded %d bytes" % len(raw_data))
-        self._jpeg.load_data(raw_data)
-        timestamp = time()
-        self._frames = self.encode_rtp(timestamp, self._jpeg, self._packet_size)
-
-    def restart_generator(self):
-        def frame_generator():
-            timestamp = time()
-            frames = self.encode_rtp(timestamp, self._jpeg, self._packet_size)
-
-            for frame in frames:
-                yield frame
-
-        if self._generator is None:
-            self._generator = frame_generator()
-
-    def next_packet(self):
-        if self._generator is None:
-            self.restart_generator()
-
-        while True:
-            try:
-                frame = next(self._generator)
-                return frame
-            except StopIteration:
-                self._generator = None
-                self.restart_generator()
-        return None
+        return result
 
+    def _make_variants(self, encoded):
+        """
+        Makes variants from encoded jpegs, packetizing them if needed
+        :param encoded:list of tuples (quality, bytes jpeg, payloads or None)
+        :return:dict quality->JpegVariant
+        """
+        variants = {}
+        for quality, raw_data, payloads in encoded:
+            jpeg = JpegFile()
+            jpeg.load_data(raw_data)
+            if payloads is None:
+                payloads = self.packetize(jpeg, self._packet_size)
+            # Only the header is needed from now on
+            jpeg.release_data()
+            variants[quality] = JpegVariant(quality, jpeg, payloads)
+        return variants
+
+    def set_variants(self, encoded):
+        """
+        Sets encoded image before the stream is played
+        :param encoded:list of tuples (quality, bytes jpeg, payloads or None)
+        """
+        variants = self._make_variants(encoded)
+        self._variants = variants
+        self._qualities = sorted(variants)
+        # The best variant is used as a default one
+        self._jpeg = variants[self._qualities[-1]].jpeg
+
+    def memory_size(self):
+        # Swapped variants are kept by both dicts
+        variants = dict((id(variant), variant) for variant in list(self._variants.values()) +
+                        list(self._pending.values()))
+        return sum(variant.frame_size for variant in variants.values())
+
+    def close(self):
+        self._variants = {}
+        self._pending = {}
+
+    def get_variant(self, quality=None):
+        """
+        Picks the best variant that does not exceed requested quality
+        :param quality:int requested quality. Best available quality is used if None
+        :return:JpegVariant
+        """
+        if quality is None:
+            return self._variants[self._qualities[-1]]
+        best = self._qualities[0]
+        for q in self._qualities:
+            if q <= quality:
+                best = q
+        return self._variants[best]
+
+    def resolve_variant(self, variant=None):
+        return self.get_variant(variant)
+
+    def frame_size(self, variant=None):
+        variant = self.get_variant(variant)
+        return variant.frame_size + len(variant.payloads) * RtpPacket.HEADER_SIZE
+
+    def rtp_info(self, variant=None):
+        variant = self.get_variant(variant)
+        seq = self._repeat_seq(variant)
+        if seq is not None:
+            # New clients get the repeated frame first
+            return seq & 0xffff, variant.rtp_time & 0xffffffff
+        return variant.seq & 0xffff, self.get_timestamp_90khz() & 0xffffffff
+
+    def _repeat_seq(self, variant):
+        """
+        :param variant:JpegVariant
+        :return:int sequence number of the last sent frame, or None if the variant sent no complete frame yet
+        """
+        count = len(variant.payloads)
+        if variant.position != 0 or variant.seq < count:
+            return None
+        return variant.seq - count
+
+    def repeat_frame(self, variant=None):
+        variant = self.get_variant(variant)
+        seq = self._repeat_seq(variant)
+        if seq is None:
+            return None
+        # Pending replacement is swapped by the next frame, so the payloads are the ones that were sent
+        last = len(variant.payloads) - 1
+        return [self.make_packet(payload, seq + i, variant.rtp_time, int(i == last))
+                for i, payload in enumerate(variant.payloads)]
+
+    def replace_variants(self, encoded):
+        """
+        Replaces the image of a playing stream. It can be called from any thread.
+        Each variant is swapped at its frame boundary, so clients never get a mix of two images
+        :param encoded:list of tuples (quality, bytes jpeg, payloads or None) with the same qualities
+        """
+        self.queue_variants(self._make_variants(encoded))
+
+    def queue_variants(self, variants):
+        """
+        Replaces the image of a playing stream with variants, that are made already
+        :param variants:dict quality->JpegVariant with the same qualities
+        """
+        generation = self._generation + 1
+        for variant in variants.values():
+            variant.generation = generation
+        # Variants are published before the generation, so a variant, that sees the new generation, finds them
+        self._pending = variants
+        self._generation = generation
+
+    def _swap_variant(self, variant):
+        replacement = self._pending.get(variant.quality)
+        if replacement is None or replacement.generation == variant.generation:
+            return variant
+        # Sequence of the RTP stream goes on
+        replacement.seq = variant.seq
+        self._variants[variant.quality] = replacement
+        if variant.quality == self._qualities[-1]:
+            self._jpeg = replacement.jpeg
+        logger.info("Swapped variant q=%d of %s" % (variant.quality, self._path))
+        return replacement
+
+    def next_packet(self, variant=None):
+        variant = self.get_variant(variant)
+        position = variant.position
+        if position == 0:
+            if variant.generation != self._generation:
+                variant = self._swap_variant(variant)
+            variant.rtp_time = self.get_timestamp_90khz()
+
+        last = position == len(variant.payloads) - 1
+        packet = self.make_packet(variant.payloads[position], variant.seq, variant.rtp_time, int(last))
+
+        variant.seq += 1
+        variant.position = 0 if last else position + 1
+        return packet
@@ -0,0 +1,287 @@
+from threading import Lock, Thread
+from queue import Queue, Empty
+import logging
+
+from JpegFile import JpegFile
+from JpegRtpStillStream import RtpJpegEncoder, load_rtp_compatible, JPG_HDR_SIZE
+from RtpFrameGenerator import RtpPacket
+from VideoStream import open_indexed
+from Timing import timed
+
+logger = logging.getLogger(__name__)
+
+"""
+Plays .mjpeg files, the same ones VideoStream reads, at their frame rate.
+
+Frames are parsed and packetized by a prefetch thread ahead of time.
+Sender only takes ready payloads from a bounded queue, so it never waits for disk or parser.
+Frame index makes seeking and trick play a matter of picking another frame number
+"""
+
+
+class RtpJpegVideoStream(RtpJpegEncoder):
+    """
+    RTP stream of a .mjpeg file with length-prefixed jpeg frames
+    """
+    # Number of packetized frames, kept ahead of the sender
+    DEFAULT_PREFETCH = 16
+
+    def __init__(self, path, fps=25.0, packet_size=1000, quality=80, prefetch=DEFAULT_PREFETCH, loop=True):
+        """
+        :param path:string path to .mjpeg file
+        :param fps:float framerate of the file
+        :param packet_size:int desired RTP packet size
+        :param quality:int jpeg quality for frames, that should be transcoded
+        :param prefetch:int maximum number of frames, prepared ahead
+        :param loop:bool restart from the first frame at the end of file
+        """
+        super(RtpJpegVideoStream, self).__init__()
+        self.fps = fps
+        self._path = path
+        self._packet_size = packet_size
+        self._quality = quality
+        self._loop = loop
+        self.video = self._open_video()
+
+        # Prepared frames: (generation, frame number, payloads). None marks the end of file
+        self._queue = Queue(maxsize=max(1, prefetch))
+        # Guards playback position. Every seek starts a new generation, older frames are discarded
+        self._lock = Lock()
+        self._generation = 0
+        # Next frame to be prepared by the prefetch thread. It is fractional for scaled playback
+        self._position = 0.0
+        # Frames advanced per sent frame. Fast forward skips frames, slow motion repeats them
+        self._step = 1.0
+        # Normal play time of the next frame to be sent
+        self._npt = 0.0
+        # Number of frames sent. RTP timestamps follow media time, not wall clock
+        self._frames_sent = 0
+        # Packets of the current frame, returned by next_packet. A seek lets the frame finish
+        self._pending = []
+        self._finished = False
+        self._closed = False
+        # Statistics
+        self.frames_passed = 0
+        self.frames_transcoded = 0
+        self.underruns = 0
+
+        self._prefetcher = Thread(target=self._prefetch)
+        self._prefetcher.daemon = True
+        self._prefetcher.start()
+
+    def _open_video(self):
+        """
+        Opens the file and gets the stream properties from it
+        :return:IndexedVideoFile
+        """
+        video = open_indexed(self._path)
+        if len(video) == 0:
+            raise ValueError("No frames in %s" % self._path)
+
+        # Only the header of the first frame is parsed, to announce frame size in SDP
+        header = JpegFile()
+        first = video.frame(0)
+        if header.load_data(first):
+            self.width, self.height = header.width, header.height
+        else:
+            self.width = self.height = 0
+        first.release()
+        # Average size of a frame on the wire, with RTP and RTP/JPEG headers
+        average = sum(video.lengths) / len(video)
+        packets = average // self._packet_size + 1
+        self._frame_size = int(average + packets * (RtpPacket.HEADER_SIZE + JPG_HDR_SIZE))
+        return video
+
+    def reopen(self):
+        """
+        Switches to the changed file. Playback goes on from the same position, or from the start
+        if the file got shorter. It can be called from any thread
+        """
+        video = self._open_video()
+        with self._lock:
+            self.video = video
+            index = int(self._npt * self.fps)
+            if index >= len(video):
+                index = 0
+            self._generation += 1
+            self._position = float(index)
+            self._npt = index / self.fps
+            self._finished = False
+        self._drain()
+        logger.info("Reopened changed %s with %d frames" % (self._path, len(video)))
+
+    @timed('prepare_video_frame')
+    def _prepare_frame(self, video, index):
+        """
+        Parses and packetizes a frame
+        :param video:IndexedVideoFile the frame is read from
+        :param index:int frame number
+        :return:list of RTP payloads, or None for broken frames
+        raises IOError if the file was truncated under the frame
+        """
+        frame = video.frame(index)
+        try:
+            jpeg, reason = load_rtp_compatible(frame, self._quality)
+            if reason is not None:
+                if self.frames_transcoded == 0:
+                    logger.warn("Transcoding frames from %s: %s" % (self._path, reason))
+                self.frames_transcoded += 1
+            else:
+                self.frames_passed += 1
+            return self.packetize(jpeg, self._packet_size)
+        except ValueError as e:
+            logger.error("Skipping broken frame %d of %s: %s" % (index, self._path, str(e)))
+            return None
+        finally:
+            frame.release()
+
+    @property
+    def duration(self):
+        return len(self.video) / self.fps
+
+    def seekable(self):
+        return True
+
+    def seek(self, npt=None, scale=1.0):
+        """
+        Moves playback to the specified position. It takes constant time, frames are picked by the index
+        :param npt:float normal play time in seconds. None keeps current position
+        :param scale:float playback speed. Fast forward sends every scale-th frame
+        :return:float normal play time of the next frame
+        """
+        if scale == 0:
+            raise ValueError("Scale should not be zero")
+        if npt is None:
+            npt = self._npt
+        index = int(npt * self.fps)
+        if index < 0 or index >= len(self.video):
+            raise ValueError("Position %.3f is out of range [0, %.3f)" % (npt, self.duration))
+        with self._lock:
+            self._generation += 1
+            self._position = float(index)
+            self._step = float(scale)
+            self._npt = index / self.fps
+            self._finished = False
+        # Unblocking the prefetch thread, if it waits for the space in the queue
+        self._drain()
+        logger.info("Seeking %s to frame %d with scale %.2f" % (self._path, index, scale))
+        return self._npt
+
+    def position(self):
+        with self._lock:
+            return self._npt, self._step
+
+    def _next_index(self):
+        """
+        Picks the next frame to be prepared
+        :return:tuple (generation, IndexedVideoFile, frame number). Frame number is None at the end of file
+        """
+        with self._lock:
+            count = len(self.video)
+            if self._position >= count or self._position < 0:
+                if not self._loop:
+                    return self._generation, self.video, None
+                self._position %= count
+            index = int(self._position)
+            self._position += self._step
+            return self._generation, self.video, index
+
+    def _prefetch(self):
+        # Generation, whose file was found truncated
+        failed = None
+        while not self._closed:
+            generation, video, index = self._next_index()
+            if index is None:
+                # End of file is repeated until the queue is full. Then thread sleeps till a seek drains it
+                self._queue.put((generation, None, None))
+                continue
+            try:
+                payloads = self._prepare_frame(video, index)
+            except IOError as e:
+                # File was changed in place. Stream ends, until it is reopened
+                if failed != generation:
+                    failed = generation
+                    logger.error("Stopping %s: %s" % (self._path, str(e)))
+                self._queue.put((generation, None, None))
+                continue
+            if payloads:
+                # Blocks while the queue is full
+                self._queue.put((generation, index, payloads))
+
+    def next_frame(self, variant=None):
+        if self._finished:
+            return None
+        while True:
+            try:
+                generation, index, payloads = self._queue.get_nowait()
+            except Empty:
+                # Prefetch thread did not keep up. Frame is delayed, not skipped
+                self.underruns += 1
+                return None
+            # Frames, prepared before the last seek, are dropped
+            if generation == self._generation:
+                break
+
+        if index is None:
+            logger.info("Finished playing %s" % self._path)
+            self._finished = True
+            return None
+
+        self._npt = index / self.fps
+        rtp_time = self._media_timestamp()
+        self._frames_sent += 1
+        last = len(payloads) - 1
+        result = []
+        for i, payload in enumerate(payloads):
+            result.append(self.make_packet(payload, self.seq, rtp_time, int(i == last)))
+            self.seq += 1
+        return result
+
+    def _media_timestamp(self):
+        """
+        RTP timestamp of the next frame. It grows steadily through seeks and loops
+        """
+        return int(round(self._frames_sent * 90000.0 / self.fps)) & 0xffffffff
+
+    def rtp_info(self, variant=None):
+        return self.seq & 0xffff, self._media_timestamp()
+
+    def next_packet(self, variant=None):
+        if not self._pending:
+            self._pending = self.next_frame(variant) or []
+            self._pending.reverse()
+        if not self._pending:
+            return None
+        return self._pending.pop()
+
+    def sdp_options(self):
+        options = super(RtpJpegVideoStream, self).sdp_options()
+        options['width'] = self.width
+        options['height'] = self.height
+        options['range'] = 'npt=0-%.3f' % self.duration
+        return options
+
+    def frame_size(self, variant=None):
+        return self._frame_size
+
+    def memory_size(self):
+        # Frames are mapped from the file, so only prefetched payloads are counted
+        size = 0
+        for generation, index, payloads in list(self._queue.queue):
+            if payloads:
+                size += sum(len(payload) for payload in payloads)
+        return size
+
+    def close(self):
+        self._closed = True
+        self._drain()
+
+    def _drain(self):
+        """
+        Drops prepared frames, so the prefetch thread is not blocked
+        """
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Empty:
+            pass
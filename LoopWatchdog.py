@@ -0,0 +1,149 @@
+from functools import wraps
+from threading import Event, Thread, get_ident
+from time import perf_counter
+import logging
+import sys
+import traceback
+
+from tornado.ioloop import IOLoop
+
+from Timing import Histogram
+
+logger = logging.getLogger(__name__)
+
+"""
+Watchdog of IOLoop lag
+
+Every synchronous piece of work on IOLoop delays all the RTSP replies and RTP packets behind it.
+Watchdog measures how late its own callbacks run, and a background thread logs the stack of IOLoop
+thread, when it is held longer than a threshold. Handlers are tagged by name, so the log tells
+which code path holds the loop
+"""
+
+# Name of the handler, running on IOLoop right now
+_tag = None
+
+
+class tagged:
+    """
+    Tags the code, running on IOLoop. It is a context manager and a function decorator:
+        with tagged('RtspServer._handle_request'):
+            ...
+    """
+    __slots__ = ('name', '_previous')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global _tag
+        self._previous = _tag
+        _tag = self.name
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _tag
+        _tag = self._previous
+        return False
+
+    def __call__(self, function):
+        name = self.name
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            global _tag
+            previous = _tag
+            _tag = name
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _tag = previous
+        return wrapper
+
+
+def current_tag():
+    """
+    :return:string name of the handler, running on IOLoop, or None
+    """
+    return _tag
+
+
+class LoopWatchdog:
+    """
+    Measures IOLoop lag and reports handlers, that hold the loop for too long
+    It is a source of MetricsRegistry
+    """
+    DEFAULT_INTERVAL = 0.05
+    DEFAULT_THRESHOLD = 0.25
+
+    METRICS = (
+        ('ioloop_lag_seconds', 'histogram', 'Delay of IOLoop callbacks behind their schedule'),
+        ('ioloop_stalls_total', 'counter', 'Times IOLoop was held longer than the watchdog threshold'),
+    )
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, interval=DEFAULT_INTERVAL):
+        """
+        :param threshold:float seconds of lag, that are reported with a stack
+        :param interval:float seconds between lag probes
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.lag = Histogram()
+        self.stalls = 0
+        # Time of the last probe, and the time the next one is expected at
+        self._beat = None
+        self._expected = None
+        # Beat of the stall, that was reported already
+        self._reported = None
+        self._loop_thread = None
+        self._stopped = Event()
+        self._watcher = None
+
+    def start(self):
+        """
+        Starts watching the current IOLoop. It should be called in IOLoop thread
+        """
+        self._loop_thread = get_ident()
+        self._beat = perf_counter()
+        self._expected = self._beat + self.interval
+        IOLoop.current().call_later(self.interval, self._probe)
+        self._watcher = Thread(target=self._watch, name='LoopWatchdog')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _probe(self):
+        now = perf_counter()
+        lag = max(now - self._expected, 0.0)
+        self.lag.observe(lag)
+        if lag > self.threshold:
+            self.stalls += 1
+            logger.warn("IOLoop was held for %.3fs" % lag)
+        self._beat = now
+        self._expected = now + self.interval
+        if not self._stopped.is_set():
+            IOLoop.current().call_later(self.interval, self._probe)
+
+    def _watch(self):
+        """
+        Background thread, that catches IOLoop thread in the middle of a stall
+        """
+        while not self._stopped.wait(self.threshold / 2):
+            beat = self._beat
+            held = perf_counter() - beat - self.interval
+            if held <= self.threshold or beat == self._reported:
+                continue
+            # Single report per stall
+            self._reported = beat
+            tag = _tag
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            logger.warn("IOLoop is held for %.3fs by %s:\n%s" % (held, tag or 'untagged code', stack))
+
+    def collect(self):
+        for bound, count in self.lag.cumulative():
+            yield 'ioloop_lag_seconds_bucket', {'le': bound}, count
+        yield 'ioloop_lag_seconds_sum', None, self.lag.sum
+        yield 'ioloop_lag_seconds_count', None, self.lag.count
+        yield 'ioloop_stalls_total', None, self.stalls
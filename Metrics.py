@@ -0,0 +1,153 @@
+from tornado.web import Application, RequestHandler
+import logging
+
+logger = logging.getLogger(__name__)
+
+"""
+Metrics of the server in Prometheus text format
+
+Hot paths only bump plain attributes of their stats objects. Registry reads them when metrics
+are scraped, so keeping the counters costs almost nothing
+"""
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class SendStats:
+    """
+    Counters of RTP packets, sent to a destination or of a stream
+    """
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        # Failed sendto calls
+        self.errors = 0
+        # Datagrams, that were sent partially
+        self.partial = 0
+        self.frames = 0
+        # Frame periods, missed by the scheduler, when IOLoop was busy
+        self.skipped = 0
+
+
+class Summary:
+    """
+    Number and total of observed values, like durations
+    """
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        label_text = ','.join('%s="%s"' % (key, _escape(label)) for key, label in sorted(labels.items()))
+        return '%s{%s} %s\n' % (name, label_text, value)
+    return '%s %s\n' % (name, value)
+
+
+class MetricsRegistry:
+    """
+    Collects metrics from the registered sources on every scrape
+
+    Every source has METRICS, a tuple of (name, type, help), and collect() method, that yields
+    samples as tuples (name, dict of labels, value). Summaries and histograms are yielded by their
+    names with _count, _sum and _bucket suffixes
+    """
+    def __init__(self):
+        # Maps name->(type, help)
+        self._metrics = {}
+        self._sources = []
+
+    def register(self, source):
+        """
+        Adds a source of metrics
+        :param source: object with METRICS and collect()
+        """
+        for name, kind, help in source.METRICS:
+            self._metrics[name] = (kind, help)
+        self._sources.append(source)
+
+    def _family(self, name):
+        if name not in self._metrics:
+            for suffix in ('_count', '_sum', '_bucket'):
+                if name.endswith(suffix) and name[:-len(suffix)] in self._metrics:
+                    return name[:-len(suffix)]
+        return name
+
+    def render(self):
+        """
+        :return:bytes all the metrics in Prometheus text format
+        """
+        # Maps family name->list of sample lines. Samples of a family have to be grouped together
+        families = {}
+        for source in self._sources:
+            try:
+                for name, labels, value in source.collect():
+                    families.setdefault(self._family(name), []).append(_format_sample(name, labels, value))
+            except Exception as e:
+                logger.exception("Failed to collect metrics of %s: %s" % (type(source).__name__, str(e)))
+
+        lines = []
+        for name in sorted(families):
+            kind, help = self._metrics.get(name, ('untyped', ''))
+            lines.append('# HELP %s %s\n' % (name, help))
+            lines.append('# TYPE %s %s\n' % (name, kind))
+            lines.extend(families[name])
+        return ''.join(lines).encode('utf-8')
+
+
+class MetricsHandler(RequestHandler):
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(self.registry.render())
+
+
+class ProfileHandler(RequestHandler):
+    """
+    Starts profiling by POST /profile?seconds=N. Responds with the path of stats
+    """
+    def initialize(self, profiler):
+        self.profiler = profiler
+
+    def post(self):
+        try:
+            duration = float(self.get_argument('seconds', 0))
+        except ValueError:
+            self.set_status(400)
+            self.write("Bad number of seconds\n")
+            return
+        path = self.profiler.start(duration or None)
+        if path is None:
+            self.set_status(409)
+            self.write("Profiling to %s is running already\n" % self.profiler.path)
+            return
+        self.write(path + '\n')
+
+
+def start_metrics_server(registry, port, address='127.0.0.1', profiler=None):
+    """
+    Serves the metrics at http://address:port/metrics, on the current IOLoop
+    :param registry:MetricsRegistry
+    :param port:int HTTP port
+    :param address:string local address to listen on. All of them if empty. Loopback by default,
+            since /profile is not authenticated
+    :param profiler:Profiler, started by POST /profile, or None
+    :return:HTTPServer
+    """
+    handlers = [('/metrics', MetricsHandler, dict(registry=registry))]
+    if profiler is not None:
+        handlers.append(('/profile', ProfileHandler, dict(profiler=profiler)))
+    application = Application(handlers)
+    logger.info("Serving metrics at http://%s:%d/metrics" % (address or '0.0.0.0', port))
+    return application.listen(port, address)
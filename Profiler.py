@@ -0,0 +1,70 @@
+from time import strftime
+import cProfile
+import logging
+import os
+
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger(__name__)
+
+"""
+Profiling of a running server
+
+cProfile is enabled on the IOLoop thread for a while, then its stats are dumped to a file.
+It is started by a signal or an admin request, so the server is never restarted for profiling.
+Stats are read by pstats or snakeviz
+"""
+
+
+class Profiler:
+    """
+    Runs cProfile on the IOLoop thread for a limited time
+    """
+    DEFAULT_DURATION = 30.0
+
+    def __init__(self, directory, duration=DEFAULT_DURATION):
+        """
+        :param directory:string directory for dumped stats
+        :param duration:float default number of seconds to profile
+        """
+        self.directory = directory
+        self.duration = duration
+        self._profile = None
+        # Path of the stats, being collected
+        self.path = None
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self, duration=None):
+        """
+        Starts profiling. It should be called in the IOLoop thread
+        :param duration:float seconds to profile. Default duration is used if None
+        :return:string path, the stats will be dumped to, or None if profiling is running already
+        """
+        if self._profile is not None:
+            logger.warn("Profiling to %s is running already" % self.path)
+            return None
+        duration = duration or self.duration
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, 'rtsp-%d-%s.prof' % (os.getpid(), strftime('%Y%m%d-%H%M%S')))
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        IOLoop.current().call_later(duration, self.stop)
+        logger.info("Profiling for %.0fs to %s" % (duration, self.path))
+        return self.path
+
+    def stop(self):
+        """
+        Stops profiling and dumps the stats
+        """
+        if self._profile is None:
+            return
+        profile, self._profile = self._profile, None
+        profile.disable()
+        try:
+            profile.dump_stats(self.path)
+            logger.info("Profile is saved to %s" % self.path)
+        except (IOError, OSError) as e:
+            logger.error("Failed to save profile to %s: %s" % (self.path, str(e)))
@@ -145,20 +145,127 @@ class RtpFrameGenerator:
     """
     Generic generator of RTP frames
     """
+    # Default framerate of a stream
+    DEFAULT_FPS = 25.0
+
     def __init__(self):
-        pass
+        # Framerate, used by RtpServer to schedule the frames
+        self.fps = self.DEFAULT_FPS
 
-    def next_packet(self):
+    def next_packet(self, variant=None):
         """
         # Generate next RTP packet
         # Should return tuple (data, seq)
+        :param variant: stream variant, requested by a client. None picks the default one
         :return:RtpPacket generated packet
         """
         raise NotImplemented()
 
+    def next_frame(self, variant=None):
+        """
+        Generate all RTP packets of the next frame
+        :param variant: stream variant, requested by a client. None picks the default one
+        :return:list of RtpPacket, or None if there is no new frame yet
+        """
+        packets = []
+        while True:
+            packet = self.next_packet(variant)
+            if packet is None:
+                return packets or None
+            packets.append(packet)
+            if packet.marker:
+                return packets
+
+    def repeat_frame(self, variant=None):
+        """
+        Generates RTP packets of the last sent frame again, with the same sequence numbers and timestamp
+        Static streams send them to new clients right away, and other clients of the variant see no gaps
+        :param variant: stream variant, requested by a client. None picks the default one
+        :return:list of RtpPacket, or None if there is no frame to repeat
+        """
+        return None
+
+    def resolve_variant(self, variant=None):
+        """
+        Gets the stream variant, that is actually sent for a requested one
+        Clients, whose requests resolve to the same variant, share its RTP sequence, so RtpServer
+        generates a single frame per period for all of them
+        Streams without variants send the same frames to everyone
+        :param variant: stream variant, requested by a client. None picks the default one
+        :return: hashable key of the variant
+        """
+        return None
+
+    # Duration of the stream in seconds, or None for endless and live streams
+    duration = None
+
+    # Stream repeats the same image, so it can be refreshed at a low framerate.
+    # New clients get the image on PLAY, without waiting for the next refresh
+    static = False
+
+    def seekable(self):
+        """
+        :return:bool True if the stream supports seek
+        """
+        return False
+
+    def seek(self, npt=None, scale=1.0):
+        """
+        Moves playback to the specified position
+        :param npt:float normal play time in seconds. None keeps current position
+        :param scale:float playback speed. Values above 1 are fast forward, negative ones play backwards
+        :return:float actual normal play time of the next frame
+        """
+        raise NotImplementedError("Stream does not support seeking")
+
+    def position(self):
+        """
+        Gets playback position of a seekable stream
+        :return:tuple (npt, scale) normal play time of the next frame in seconds, and playback speed
+        """
+        raise NotImplementedError("Stream does not support seeking")
+
+    def rtp_info(self, variant=None):
+        """
+        Get RTP state of the next frame, reported to clients by RTP-Info header
+        :param variant: stream variant, requested by a client. None picks the default one
+        :return:tuple (seq, rtptime)
+        """
+        return 0, 0
+
+    def frame_size(self, variant=None):
+        """
+        Estimates number of bytes per frame, sent to a client of the variant
+        It is used for admission control
+        :param variant: stream variant, requested by a client. None picks the default one
+        :return:int number of bytes, or 0 if it is unknown
+        """
+        return 0
+
+    def memory_size(self):
+        """
+        :return:int number of bytes, kept by the stream
+        """
+        return 0
+
+    def close(self):
+        """
+        Releases resources of the stream. It is not used after that
+        """
+        pass
+
+    def sdp_options(self):
+        """
+        Gets the stream values, that go to its SDP, like dimensions and framerate
+        Server caches rendered SDP by them, so SDP changes together with the stream
+        :return:dict of hashable values
+        """
+        return {'fps': self.fps}
+
     def get_sdp(self, options):
         """
         Generate SDP for this generator
+        :param options:dict server video options. It is not modified
         :return:string with SDP stream description
         """
         raise NotImplemented()
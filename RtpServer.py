@@ -1,25 +1,53 @@
 from tornado.ioloop import PeriodicCallback
 from RtpFrameGenerator import RtpPacket, RtpFrameGenerator
+from Metrics import SendStats
+from Timing import stages
+from LoopWatchdog import tagged
+from time import time
+import logging
 import socket
 
+logger = logging.getLogger(__name__)
+
 
 class RtpServer:
     """
     RTP Server
     Deals with publishing rtp datagrams to clients
     """
-    def __init__(self, address="0.0.0.0"):
+    DEFAULT_PORT = 8888
+
+    def __init__(self, address="0.0.0.0", port=DEFAULT_PORT):
+        """
+        :param address:string local address to send RTP from
+        :param port:int first of the two UDP ports to send RTP from. Next one is taken as well
+        """
         self._sockets = None
         self._address = address
-        self._rtp_pub_ports = range(8888, 8889)
-        # Frame provider
-        self._stream = None
-        # Frame generator
-        self._frame_generator = PeriodicCallback(self._gen_rtp_frame, 40)
+        self._rtp_pub_ports = range(port, port + 1)
+        # Frame generators of the streams being published. Period of each one follows its stream framerate
+        # Maps stream->PeriodicCallback
+        self._frame_generators = {}
         # Maps from some key to (address,port) pairs
         self._destinations = {}
+        # Maps from some key to stream variant
+        self._variants = {}
+        # Maps from some key to the stream, it receives
+        self._streams = {}
+        # Send counters. Maps from some key to SendStats of its destination
+        self._send_stats = {}
+        # Maps stream->SendStats, while it is published
+        self._stream_stats = {}
+        # Maps stream->time of its last frame period, to detect the skipped ones
+        self._ticks = {}
+        # Counters of everything sent by the server
+        self.totals = SendStats()
         self._sockets = None
-        self.init_sockets()
+        self._bind_error = None
+        if not self.init_sockets():
+            # Sending is retried with every frame, so it is reported just once
+            logger.warn("Can not bind RTP ports %d-%d: %s" %
+                        (self._rtp_pub_ports.start, self._rtp_pub_ports.stop, str(self._bind_error)))
 
     def init_sockets(self):
         try:
@@ -32,31 +60,76 @@ class RtpServer:
             self._sockets = (sock_primary, sock_secondary)
             return True
         except OSError as e:
+            self._bind_error = e
             return False
 
     def get_server_ports(self):
         return self._rtp_pub_ports
 
-    def set_stream(self, stream):
-        self._stream = stream
+    def destination_stats(self, key):
+        """
+        :return:SendStats of the destination, or None if it is not published to
+        """
+        return self._send_stats.get(key)
+
+    def stream_stats(self, stream):
+        """
+        :return:SendStats of the stream, or None if it is not published
+        """
+        return self._stream_stats.get(stream)
+
+    def is_active(self, stream):
+        """
+        :return:bool True if the stream is published to somebody
+        """
+        return stream in self._frame_generators
 
     # Start RTP streaming
     def start(self):
-        self._frame_generator.start()
+        for generator in self._frame_generators.values():
+            generator.start()
 
     # Stop RTP streaming
     def stop(self):
-        self._frame_generator.stop()
+        for generator in self._frame_generators.values():
+            generator.stop()
 
-    def add_destination(self, key, dest):
+    def add_destination(self, key, dest, variant=None, stream=None):
+        """
+        Starts publishing a stream to the destination
+        :param key: unique key of the destination, like ClientInfo
+        :param dest:tuple (address, port)
+        :param variant: stream variant, requested by a client
+        :param stream:RtpFrameGenerator to be published
+        """
         self._destinations[key] = dest
+        self._variants[key] = variant
+        self._streams[key] = stream
+        if key not in self._send_stats:
+            self._send_stats[key] = SendStats()
+        if stream not in self._frame_generators:
+            generator = PeriodicCallback(lambda: self._gen_rtp_frame(stream), 1000.0 / stream.fps)
+            self._frame_generators[stream] = generator
+            self._stream_stats[stream] = SendStats()
+            generator.start()
 
     def remove_destination(self, key, dest):
         if key in self._destinations:
             self._destinations.pop(key)
+            self._variants.pop(key, None)
+            self._send_stats.pop(key, None)
+            stream = self._streams.pop(key, None)
+            # Nobody receives the stream anymore
+            if stream not in self._streams.values() and stream in self._frame_generators:
+                self._frame_generators.pop(stream).stop()
+                self._stream_stats.pop(stream, None)
+                self._ticks.pop(stream, None)
 
-    # Returns a list of pairs (address, port)
-    def _get_rtp_destinations(self):
+    # Returns a list of tuples (variant, [((address, port), SendStats)]) for the stream,
+    # one per variant the stream actually sends. Variant is one of the requested ones
+    def _get_rtp_destinations(self, stream):
+        # Maps resolved variant->(requested variant, destinations)
+        groups = {}
         result = []
 
         # Add own addresses
@@ -65,7 +138,14 @@ class RtpServer:
         #        result.append((self._local_address, port))
 
         for key, dest in self._destinations.items():
-            result.append(dest)
+            if self._streams.get(key) is stream:
+                variant = self._variants.get(key)
+                resolved = stream.resolve_variant(variant)
+                group = groups.get(resolved)
+                if group is None:
+                    group = groups[resolved] = (variant, [])
+                    result.append(group)
+                group[1].append((dest, self._send_stats[key]))
         return result
 
     def close_sockets(self):
@@ -76,8 +156,7 @@ class RtpServer:
     def sockets_invalid(self):
         return self._sockets is None
 
-    def _publish_rtp_frame(self, rtp_packet):
-        destinations = self._get_rtp_destinations()
+    def _publish_rtp_frame(self, rtp_packet, destinations):
         data_raw = rtp_packet.raw_packet
 
         data_len = len(data_raw)
@@ -88,32 +167,100 @@ class RtpServer:
         if self._sockets is None or len(self._sockets) == 0:
             return
 
-        for address in destinations:
+        for address, stats in destinations:
             try:
                 sent_len = self._sockets[0].sendto(data_raw, address)
                 if sent_len < 0:
-                    print("System error in sendto %s" % address)
+                    stats.errors += 1
+                    self.totals.errors += 1
+                    print("System error in sendto %s" % str(address))
                 elif sent_len < data_len:
-                    print("Sent %d of %d to %s" % (sent_len, data_len, address))
+                    stats.partial += 1
+                    self.totals.partial += 1
+                    print("Sent %d of %d to %s" % (sent_len, data_len, str(address)))
             except OSError as e:
+                stats.errors += 1
+                self.totals.errors += 1
                 # TODO: Switch to NetInit state
                 print("OS Exception: %s" % str(e))
                 self.close_sockets()
+                return
 
     def _restart_stream(self):
         pass
 
-    # Publish RTP frame to all clients
-    def _gen_rtp_frame(self):
+    # Publish RTP frame of the stream to all its clients. Called once per frame period
+    @tagged('RtpServer._gen_rtp_frame')
+    def _gen_rtp_frame(self, stream):
         if self.sockets_invalid():
             self.init_sockets()
 
-        if self._stream is None or not isinstance(self._stream, RtpFrameGenerator):
+        if stream is None or not isinstance(stream, RtpFrameGenerator):
             raise Exception("RtpServer has invalid RTP Frame generator")
 
-        rtp_packet = self._stream.next_packet()
-        if rtp_packet is None:
-            raise Exception("RtpServer got invalid rtp packet")
-            self._restart_stream()
+        # PeriodicCallback drops the periods, that passed while IOLoop was busy
+        now = time()
+        last = self._ticks.get(stream)
+        self._ticks[stream] = now
+        if last is not None:
+            skipped = int((now - last) * stream.fps - 0.5)
+            if skipped > 0:
+                self._stream_stats[stream].skipped += skipped
+                self.totals.skipped += skipped
+
+        # Each variant is a separate packet sequence, shared by its clients
+        for variant, destinations in self._get_rtp_destinations(stream):
+            self._publish_variant_frame(stream, variant, destinations)
+
+    def _publish_variant_frame(self, stream, variant, destinations):
+        with stages.time('next_frame'):
+            rtp_packets = stream.next_frame(variant)
+        if rtp_packets is None:
+            # Live streams can have no new frame yet
+            return
+        self._send_packets(stream, rtp_packets, destinations)
 
-        self._publish_rtp_frame(rtp_packet)
+    def _send_packets(self, stream, rtp_packets, destinations):
+        size = 0
+        # All the packets of the frame, sent to all its destinations
+        with stages.time('sendto'):
+            for rtp_packet in rtp_packets:
+                self._publish_rtp_frame(rtp_packet, destinations)
+                size += len(rtp_packet.raw_packet)
+
+        # Counters are updated once per frame, not per packet
+        count = len(rtp_packets)
+        for address, stats in destinations:
+            stats.frames += 1
+            stats.packets += count
+            stats.bytes += size
+        copies = len(destinations)
+        for stats in (self._stream_stats.get(stream), self.totals):
+            if stats is not None:
+                stats.frames += 1
+                stats.packets += count * copies
+                stats.bytes += size * copies
+
+    def send_frame(self, stream, key):
+        """
+        Sends a frame of the stream to a destination right away, out of its schedule
+        The last frame of the variant is repeated to this destination only, so other clients see no gaps,
+        and the sequence of the new one goes on with the next frame. If the variant has no frame
+        to repeat yet, its first frame is sent to all its destinations
+        :param stream:RtpFrameGenerator being published
+        :param key: unique key of the destination
+        """
+        if self._streams.get(key) is not stream:
+            return
+        if self.sockets_invalid():
+            self.init_sockets()
+        variant = self._variants.get(key)
+        rtp_packets = stream.repeat_frame(variant)
+        if rtp_packets is not None:
+            self._send_packets(stream, rtp_packets, [(self._destinations[key], self._send_stats[key])])
+            return
+        resolved = stream.resolve_variant(variant)
+        for requested, destinations in self._get_rtp_destinations(stream):
+            if stream.resolve_variant(requested) == resolved:
+                self._publish_variant_frame(stream, requested, destinations)
+                return
@@ -1,13 +1,24 @@
-from random import randint
+from binascii import hexlify
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+from urllib.parse import parse_qs
+import os
 import re
 import logging
 from RtpServer import RtpServer
+from StreamCache import StreamCache
+from Metrics import Summary
+from Timing import stages
+from LoopWatchdog import tagged
 
-from HttpMessage import HttpMessage
+from HttpMessage import HttpMessage, RtspRequestParser, RtspResponse
+from sdp_utils import make_sdp2
 
 from tornado.tcpserver import TCPServer
+from tornado.netutil import bind_sockets
 from tornado.iostream import StreamClosedError
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado import gen
 
 __author__ = 'Tibbers, Dmitry Kargin'
@@ -28,6 +39,34 @@ def dump_list(data):
     return result
 
 
+def parse_npt_range(value):
+    """
+    Parse normal play time range from Range header, like 'npt=10.5-20' or 'npt=now-'
+    :param value:string Range header value
+    :return:tuple (start, end) in seconds. Missing values and 'now' are None
+    raises ValueError for other time formats
+    """
+    # Range can also contain ';time=' suffix, telling when the range should be applied
+    npt = value.split(';')[0].strip()
+    if not npt.startswith('npt='):
+        raise ValueError("Unsupported range %s" % value)
+    start, sep, end = npt[len('npt='):].partition('-')
+    if not sep:
+        raise ValueError("Invalid range %s" % value)
+
+    def parse_time(item):
+        item = item.strip()
+        if item in ('', 'now'):
+            return None
+        # npt-hhmmss form: 0:01:10.5
+        seconds = 0.0
+        for part in item.split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+
+    return parse_time(start), parse_time(end)
+
+
 # Contains protocol-specific constants
 class Protocol:
     SETUP = 'SETUP'
@@ -36,6 +75,7 @@ class Protocol:
     PLAY = 'PLAY'
     PAUSE = 'PAUSE'
     TEARDOWN = 'TEARDOWN'
+    GET_PARAMETER = 'GET_PARAMETER'
 
 INIT = 0
 READY = 1
@@ -61,6 +101,18 @@ class ClientInfo:
         self.unicast = False
         self.interleaved = False
         self.rtp = False
+        # Requested stream quality. None means the best one
+        self.quality = None
+        # Stream, opened by SETUP
+        self.stream = None
+        # Session has played the stream already, so its PLAY requests are not joins anymore
+        self.played = False
+        # RTSP session ID, unique for every SETUP
+        self.session = None
+        # Address tuple of the RTSP connection, that made the session
+        self.connection = None
+        # Time of the last request of the session. Sessions without requests expire
+        self.last_seen = time()
 
     def reset(self):
         """
@@ -71,6 +123,20 @@ class ClientInfo:
         self.unicast = False
         self.interleaved = False
         self.rtp = False
+        self.quality = None
+        self.played = False
+
+    def set_transport(self, options):
+        """
+        Takes transport parameters of an accepted SETUP. Session starts over from INIT state
+        :param options:ClientInfo, that parsed the SETUP request
+        """
+        self.reset()
+        self.rtp_ports = options.rtp_ports
+        self.unicast = options.unicast
+        self.interleaved = options.interleaved
+        self.rtp = options.rtp
+        self.quality = options.quality
 
     @property
     def state(self):
@@ -109,6 +175,23 @@ class ClientInfo:
                     self.rtp_ports = None
             elif item.startswith('interleaved'):
                 self.interleaved = True
+            elif item.startswith('x-quality='):
+                self.parse_quality(item[len('x-quality='):])
+
+    def parse_url_options(self, url):
+        """
+        Parse stream options from the query part of requested url
+        :param url:ParseResult parsed url
+        """
+        query = parse_qs(url.query)
+        if 'quality' in query:
+            self.parse_quality(query['quality'][0])
+
+    def parse_quality(self, value):
+        try:
+            self.quality = int(value)
+        except ValueError:
+            print("Unrecognized quality %s" % value)
 
 
 # Implements RTSP protocol FSM
@@ -118,12 +201,60 @@ class RtspServer(TCPServer):
     FILE_NOT_FOUND_404 = 404
     METHOD_NOT_ALLOWED_405 = 405
     UNSUPPORTED_MEDIA_TYPE_415 = 415
+    NOT_ENOUGH_BANDWIDTH_453 = 453
+    SESSION_NOT_FOUND_454 = 454
+    METHOD_NOT_VALID_455 = 455
+    INVALID_RANGE_457 = 457
     UNSUPPORTED_TRANSPORT_461 = 461
     CON_ERR_500 = 500
+    SERVICE_UNAVAILABLE_503 = 503
+
+    # OPTIONS response does not depend on the request
+    OPTIONS_RESPONSE = RtspResponse(OK_200, {'Public': "DESCRIBE, SETUP, TEARDOWN, PLAY, PAUSE, GET_PARAMETER"})
+
+    # Seconds without requests, after which a session expires
+    DEFAULT_SESSION_TIMEOUT = 60
+
+    # Number of bytes, requested from the socket at once
+    READ_CHUNK_SIZE = 4096
+
+    # Number of rendered DESCRIBE responses to keep
+    SDP_CACHE_SIZE = 256
+
+    # Metrics, reported by collect()
+    METRICS = (
+        ('rtsp_connections', 'gauge', 'Open RTSP connections'),
+        ('rtsp_sessions', 'gauge', 'Active RTSP sessions'),
+        ('rtsp_sessions_refused_total', 'counter', 'Sessions refused by admission control'),
+        ('rtsp_streams', 'gauge', 'Opened streams'),
+        ('rtsp_stream_memory_bytes', 'gauge', 'Memory used by opened streams'),
+        ('rtsp_stream_cache_hits_total', 'counter', 'Requests for already opened streams'),
+        ('rtsp_stream_evictions_total', 'counter', 'Idle streams closed to fit the memory budget'),
+        ('rtsp_stream_open_seconds', 'summary', 'Time to open a stream, including jpeg transcoding'),
+        ('rtsp_stream_open_failures_total', 'counter', 'Streams, that failed to open'),
+        ('rtp_sent_frames_total', 'counter', 'RTP frames sent, counted once per stream variant'),
+        ('rtp_sent_packets_total', 'counter', 'RTP packets sent to all destinations'),
+        ('rtp_sent_bytes_total', 'counter', 'RTP bytes sent to all destinations'),
+        ('rtp_send_errors_total', 'counter', 'Failed sendto calls'),
+        ('rtp_partial_sends_total', 'counter', 'RTP datagrams, that were sent partially'),
+        ('rtp_skipped_frames_total', 'counter', 'Frame periods, skipped by the scheduler while IOLoop was busy'),
+        ('rtp_stream_sessions', 'gauge', 'Sessions, receiving the stream'),
+        ('rtp_stream_sent_frames_total', 'counter', 'RTP frames of the stream sent, since it started playing'),
+        ('rtp_stream_sent_packets_total', 'counter', 'RTP packets of the stream sent, since it started playing'),
+        ('rtp_stream_sent_bytes_total', 'counter', 'RTP bytes of the stream sent, since it started playing'),
+        ('rtp_stream_skipped_frames_total', 'counter', 'Frame periods of the stream, skipped by the scheduler'),
+        ('rtp_session_sent_packets_total', 'counter', 'RTP packets sent to the session'),
+        ('rtp_session_sent_bytes_total', 'counter', 'RTP bytes sent to the session'),
+        ('rtp_session_send_errors_total', 'counter', 'Failed sendto calls of the session'),
+        ('rtp_session_partial_sends_total', 'counter', 'RTP datagrams of the session, that were sent partially'),
+    )
 
     # RTSP response
     class CmdRTSPResponse:
         def __init__(self, status, seq, data=None, **kwargs):
+            """
+            :param status:int RTSP status code, or pre-rendered RtspResponse
+            """
             self.code = status
             self.seq = seq
             self.values = kwargs
@@ -146,41 +277,260 @@ class RtspServer(TCPServer):
         def __init__(self, client):
             self.client = client
 
-    def __init__(self, port, stream_factory):
+    # Command to send a frame of client stream right away
+    class CmdSendFrame:
+        def __init__(self, client):
+            self.client = client
+
+    # Command to check if a new session can be started. It sends back the reason of refusal, or None
+    class CmdAdmitSession:
+        pass
+
+    # Command to get a stream for the path. It sends back tuple (stream, None) or (None, error code)
+    class CmdOpenStream:
+        def __init__(self, path):
+            self.path = path
+
+    def __init__(self, port, stream_factory, catalog=None, stream_memory=None,
+                 session_timeout=DEFAULT_SESSION_TIMEOUT, admission=None, rtp_port=RtpServer.DEFAULT_PORT,
+                 reuse_port=False):
         """
         Creates RTP server instance
         :param port:int primary port for RTSP server
         :param stream_factory:function(url) generator for RTP packet provider
+        :param catalog:AssetCatalog with probed files. DESCRIBE is answered from it, without opening the stream
+        :param stream_memory:int memory budget for opened streams, in bytes. Idle streams are evicted
+                to fit it. Streams are kept forever if None
+        :param session_timeout:int seconds without requests, after which a session is closed.
+                Clients keep it alive by OPTIONS or GET_PARAMETER
+        :param admission:AdmissionControl with capacity limits, or None
+        :param rtp_port:int first of the two UDP ports to publish RTP from
+        :param reuse_port:bool bind RTSP port with SO_REUSEPORT, so several worker processes can listen on it.
+                Kernel spreads connections between them. Every worker needs its own rtp_port
         """
         super(RtspServer, self).__init__()
 
         self.logger = logging.getLogger('RtspServer')
-        # Maps address->client
+        # Maps "address:port" of RTSP connection->client
         self.clients = {}
-        self.video_opt = {'video_port': 8400}
+        # Maps session ID->client
+        self.sessions = {}
+        self.session_timeout = session_timeout
+        # Port of m= line is just a recommendation for unicast. Clients pick their ports in SETUP
+        self.video_opt = {'video_port': 0}
+        # Rendered DESCRIBE responses. Maps (url, SDP values of the stream)->RtspResponse
+        self._descriptions = OrderedDict()
         self._stream_factory = stream_factory
-        self._stream = None
-        self._rtp_server = RtpServer()
+        self._catalog = catalog
+        self._rtp_server = RtpServer(port=rtp_port)
+        # Opened streams, shared by clients of the same path
+        self._streams = StreamCache(stream_memory, self._is_stream_used)
+        # Maps path->Future of a stream being opened
+        self._opening = {}
+        self._admission = admission
+        # Streams are opened in threads, so transcoding does not block other clients
+        workers = admission.max_transcodes if admission is not None and admission.max_transcodes else 4
+        self._open_executor = ThreadPoolExecutor(max_workers=workers)
+        self.open_time = Summary()
+        self.open_failures = 0
         self._local_address = '127.0.0.1'
         self._client_address = None
         self._work_thread = None
         self._last_client_id = 0
-        # Generate a randomized RTSP session ID
-        self._session = randint(100000, 999999)
-        self.logger.debug("Starting session id=%d at port %d" % (self._session, port))
+        # Expired sessions are checked several times per timeout
+        self._reaper = PeriodicCallback(self._reap_sessions, session_timeout * 1000.0 / 4)
+        self._reaper.start()
+        self.logger.debug("Starting RTSP server at port %d" % port)
 
-        self.listen(port)
+        self.add_sockets(bind_sockets(port, reuse_port=reuse_port))
 
     def _get_client(self, address):
         return self.clients.get("%s:%d" % address)
 
+    def _find_client(self, request, address):
+        """
+        Finds the client by Session header, or by the connection if there is no such header
+        :param request:HttpMessage
+        :param address: address tuple of the connection
+        :return:ClientInfo, or None if there is no such session
+        """
+        session = request.get('session')
+        if session is not None:
+            # Session header can have a timeout suffix: 'id;timeout=60'
+            return self.sessions.get(session.split(';')[0].strip())
+        return self._get_client(address)
+
+    def _add_client(self, address):
+        """
+        Starts a new session for the connection
+        :param address: address tuple of the connection
+        :return:ClientInfo
+        """
+        self._last_client_id += 1
+        client = ClientInfo(address[0], self._last_client_id)
+        session = hexlify(os.urandom(8)).decode()
+        while session in self.sessions:
+            session = hexlify(os.urandom(8)).decode()
+        client.session = session
+        client.connection = address
+        self.sessions[session] = client
+        self.clients["%s:%d" % address] = client
+        self.logger.info("Started session %s for %s" % (session, str(address)))
+        return client
+
+    def _drop_client(self, client):
+        """
+        Closes the session and stops publishing its stream
+        :param client:ClientInfo
+        """
+        self._rtp_server.remove_destination(client, client.address)
+        self.sessions.pop(client.session, None)
+        key = "%s:%d" % client.connection
+        if self.clients.get(key) is client:
+            self.clients.pop(key)
+        # Stream can become idle
+        self._streams.evict()
+
     def _remove_client(self, address):
         """
-        Removes client from RTP publish list
+        Forgets the closed connection. Its session lives until TEARDOWN or timeout,
+        since clients can go on with another connection
         :param address: address tuple  of a client
         """
-        if address in self.clients:
-            self.clients.pop(address)
+        self.clients.pop("%s:%d" % address, None)
+
+    def _reap_sessions(self):
+        """
+        Closes sessions, that had no requests for session_timeout
+        """
+        deadline = time() - self.session_timeout
+        for client in [client for client in self.sessions.values() if client.last_seen < deadline]:
+            self.logger.warn("Session %s of %s has expired" % (client.session, client.address))
+            client.set_state(DONE)
+            self._drop_client(client)
+
+    def _is_stream_used(self, stream):
+        """
+        Tells if the stream is played, or held by a session, that has not started playing it yet
+        Such streams are not evicted from the cache
+        :param stream:RtpFrameGenerator
+        :return:bool
+        """
+        if self._rtp_server.is_active(stream):
+            return True
+        return any(client.stream is stream for client in self.sessions.values())
+
+    def _is_stream_shared(self, stream, client):
+        """
+        Tells if other sessions get the stream, so its playback can not be changed by the client
+        :param stream:RtpFrameGenerator
+        :param client:ClientInfo
+        :return:bool
+        """
+        return any(other is not client and other.stream is stream for other in self.sessions.values())
+
+    def _create_stream(self, path):
+        self.logger.info("Initializing stream for %s" % path)
+        return self._stream_factory(path)
+
+    @gen.coroutine
+    def _create_stream_async(self, path):
+        """
+        Creates a stream in a worker thread
+        :return:RtpFrameGenerator, or None if it can not be opened
+        """
+        start = time()
+        try:
+            stream = yield IOLoop.current().run_in_executor(self._open_executor, self._create_stream, path)
+            self.open_time.observe(time() - start)
+        except IOError as e:
+            self.logger.warn("Can not open stream for %s: %s" % (path, str(e)))
+            stream = None
+        except Exception as e:
+            self.logger.exception("Failed to open stream for %s: %s" % (path, str(e)))
+            stream = None
+        finally:
+            self._opening.pop(path, None)
+            if self._admission is not None:
+                self._admission.end_transcode()
+        if stream is not None:
+            self._streams.add(path, stream)
+        else:
+            self.open_failures += 1
+        return stream
+
+    @gen.coroutine
+    def _open_stream(self, path):
+        """
+        Gets a stream for the requested path, creating it if needed
+        Clients, that request the same path meanwhile, wait for the same stream
+        :param path:string path part of the url
+        :return:tuple (RtpFrameGenerator, None), or (None, RTSP error code)
+        """
+        stream = self._streams.get(path)
+        if stream is not None:
+            return stream, None
+        opening = self._opening.get(path)
+        if opening is None:
+            if self._admission is not None and self._admission.begin_transcode() is not None:
+                return None, self.SERVICE_UNAVAILABLE_503
+            opening = self._opening[path] = self._create_stream_async(path)
+        stream = yield opening
+        if stream is None:
+            return None, self.FILE_NOT_FOUND_404
+        return stream, None
+
+    def collect(self):
+        """
+        Gets the current metrics of the server for MetricsRegistry
+        :return: generator of tuples (name, labels, value)
+        """
+        yield 'rtsp_connections', None, len(self.clients)
+        yield 'rtsp_sessions', None, len(self.sessions)
+        if self._admission is not None:
+            yield 'rtsp_sessions_refused_total', None, self._admission.refused
+        yield 'rtsp_streams', None, len(self._streams)
+        yield 'rtsp_stream_memory_bytes', None, self._streams.memory_used
+        yield 'rtsp_stream_cache_hits_total', None, self._streams.hits
+        yield 'rtsp_stream_evictions_total', None, self._streams.evictions
+        yield 'rtsp_stream_open_seconds_count', None, self.open_time.count
+        yield 'rtsp_stream_open_seconds_sum', None, self.open_time.sum
+        yield 'rtsp_stream_open_failures_total', None, self.open_failures
+
+        totals = self._rtp_server.totals
+        yield 'rtp_sent_frames_total', None, totals.frames
+        yield 'rtp_sent_packets_total', None, totals.packets
+        yield 'rtp_sent_bytes_total', None, totals.bytes
+        yield 'rtp_send_errors_total', None, totals.errors
+        yield 'rtp_partial_sends_total', None, totals.partial
+        yield 'rtp_skipped_frames_total', None, totals.skipped
+
+        # Maps stream->number of its sessions
+        playing = {}
+        for client in self.sessions.values():
+            if client.stream is not None and self._rtp_server.is_active(client.stream):
+                playing[client.stream] = playing.get(client.stream, 0) + 1
+        for path, stream in self._streams.items():
+            stats = self._rtp_server.stream_stats(stream)
+            if stats is None:
+                continue
+            labels = {'path': path}
+            yield 'rtp_stream_sessions', labels, playing.get(stream, 0)
+            yield 'rtp_stream_sent_frames_total', labels, stats.frames
+            yield 'rtp_stream_sent_packets_total', labels, stats.packets
+            yield 'rtp_stream_sent_bytes_total', labels, stats.bytes
+            yield 'rtp_stream_skipped_frames_total', labels, stats.skipped
+
+        paths = dict((stream, path) for path, stream in self._streams.items())
+        for client in self.sessions.values():
+            stats = self._rtp_server.destination_stats(client)
+            if stats is None:
+                continue
+            labels = {'session': client.session, 'address': client.address, 'path': paths.get(client.stream, '')}
+            yield 'rtp_session_sent_packets_total', labels, stats.packets
+            yield 'rtp_session_sent_bytes_total', labels, stats.bytes
+            yield 'rtp_session_send_errors_total', labels, stats.errors
+            yield 'rtp_session_partial_sends_total', labels, stats.partial
 
     @staticmethod
     def run():
@@ -191,33 +541,46 @@ class RtspServer(TCPServer):
         """
         Receive RTSP request from the client.
         """
+        parser = RtspRequestParser()
         while True:
             try:
-                request_raw = yield stream.read_until(b'\r\n\r\n')
-                #request_raw = sock.recv(256)
-                if request_raw is None or len(request_raw) == 0:
+                data = yield stream.read_bytes(self.READ_CHUNK_SIZE, partial=True)
+                if not data:
                     self.logger.warn("Should close a socket for some reason")
                     break
-
-                yield from self._handle_raw_request(stream, request_raw, address)
+                parser.feed(data)
+
+                # Single read can bring several pipelined requests
+                while True:
+                    try:
+                        request = parser.next_message()
+                        if request is None:
+                            break
+                    except ValueError as e:
+                        self.logger.error("Corrupted RTSP request: %s" % str(e))
+                        request = None
+                    yield from self._handle_request(stream, request, address)
 
             except StreamClosedError:
                 self.logger.warn("Stream from %s has been closed" % str(address))
                 self._remove_client(address)
                 break
 
-    def _handle_raw_request(self, stream, request_raw, address):
+    def _handle_request(self, stream, request, address):
         """
-        Handles raw http request
+        Handles parsed http request
         :param stream: stream from tornado
-        :param request_raw: raw request packet
+        :param request:HttpMessage, or None if request is corrupted
         :param address: address of requesint side
         :return:
         """
         responses = 0
+        start = perf_counter()
+        # Only the steps of FSM hold IOLoop. It is free while the stream is written or opened
+        tag = tagged('RtspServer._handle_request %s' % (request.type if request is not None else 'corrupted'))
 
         # Gather commands from RTSP protocol processor
-        generator = self._process_rtsp_request(request_raw.decode("utf-8"), address)
+        generator = self._process_rtsp_request(request, address)
 
         out = None
 
@@ -225,39 +588,47 @@ class RtspServer(TCPServer):
         # We should get at least one response, and some other internal commands
         while True:
             try:
-                if out is None:
-                    cmd = next(generator)
-                else:
-                    cmd = generator.send(out)
-                    out = None
+                with tag:
+                    if out is None:
+                        cmd = next(generator)
+                    else:
+                        cmd = generator.send(out)
+                        out = None
 
                 if isinstance(cmd, self.CmdRTSPResponse):  # Generated http response
-                    response_data = HttpMessage.serialise_rtsp(cmd.code, cmd.seq, cmd.values, cmd.data)
-                    self.logger.debug("Responding=%s" % response_data)
-                    yield stream.write(response_data.encode())
+                    if isinstance(cmd.code, RtspResponse):
+                        response_data = cmd.code.render(cmd.seq, cmd.values)
+                    else:
+                        response_data = HttpMessage.serialise_rtsp(cmd.code, cmd.seq, cmd.values, cmd.data)
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug("Responding=%s" % response_data.decode('utf-8', 'replace'))
+                    yield stream.write(response_data)
                     responses += 1
                 elif isinstance(cmd, self.CmdOpenRTP):  # Should open UDP port for streaming
-                    self._rtp_server.add_destination(cmd.client, (cmd.client.address, cmd.client.rtp_ports.start))
-                    self._rtp_server.start()
+                    self._rtp_server.add_destination(cmd.client, (cmd.client.address, cmd.client.rtp_ports.start),
+                                                     cmd.client.quality, cmd.client.stream)
                 elif isinstance(cmd, self.CmdCloseRTP):  # Should close UDP port
-                    self._rtp_server.remove_destination(cmd.client, cmd.client.address)
-                    self._rtp_server.stop()
+                    self._drop_client(cmd.client)
+                elif isinstance(cmd, self.CmdAdmitSession):
+                    if self._admission is not None:
+                        out = self._admission.check_session(address[0], self.sessions.values())
+                elif isinstance(cmd, self.CmdOpenStream):
+                    out = yield self._open_stream(cmd.path)
+                elif isinstance(cmd, self.CmdSendFrame):
+                    self._rtp_server.send_frame(cmd.client.stream, cmd.client)
                 elif isinstance(cmd, self.CmdInitClient):
-                    address_str = "%s:%d" % address
-                    if address not in self.clients:
-                        self._last_client_id += 1
-                        client = ClientInfo(address[0], self._last_client_id)
-                        self.clients[address_str] = client
-                        out = client # Will send it back to coroutine
-                    else:
-                        self.logger.debug("Picking existing ClientInfo for %s" % str(address))
-                        out = self._get_client()
+                    out = self._add_client(address)  # Will send it back to coroutine
                 else:
                     raise Exception("Unhandled yield result: %s" % str(type(cmd)))
 
             except StopIteration:
                 break
 
+        # Stage includes waiting for the stream to be opened and the response to be written.
+        # Unknown methods are counted together, so clients can not make up new stages
+        method = request.type if request is not None and request.type in self._dispatch_table else 'other'
+        stages.observe('rtsp_' + method.lower(), perf_counter() - start)
+
         if responses != 1:
             # TODO: Just send a default server response here
             raise Exception("RTSP FSM is broken. Have generated %d responses instead of single one!" % responses)
@@ -269,7 +640,7 @@ class RtspServer(TCPServer):
         Process OPTIONS request
         :param request:HttpMessage
         """
-        yield self.CmdRTSPResponse(self.OK_200, request.seq, Public="DESCRIBE, SETUP, TEARDOWN, PLAY, PAUSE")
+        yield self.CmdRTSPResponse(self.OPTIONS_RESPONSE, request.seq)
 
     def _response_describe(self, request, client):
         """
@@ -281,24 +652,76 @@ class RtspServer(TCPServer):
 
         url = request.url
 
-        self.logger.info("Initializing stream for %s" % url.path)
+        if client is None:
+            # Viewers, that would be refused by SETUP, do not make the server open their streams
+            refusal = yield self.CmdAdmitSession()
+            if refusal is not None:
+                yield self.CmdRTSPResponse(self.SERVICE_UNAVAILABLE_503, request.seq)
+                return
 
-        if self._stream is None:
-            # TODO: Make a proper stream pool
-            try:
-                self._stream = self._stream_factory(url.path)
-            except FileNotFoundError as e:
-                yield self.CmdRTSPResponse(self.FILE_NOT_FOUND_404, request.seq)
+        if self._catalog is not None:
+            info, code = self._check_catalog(url.path)
+            if info is None:
+                yield self.CmdRTSPResponse(code, request.seq)
+                return
+            # Stream is opened by SETUP
+            stream_options = info.sdp_options(self._catalog.stream_fps(info))
+        else:
+            stream, code = yield self.CmdOpenStream(url.path)
+            if stream is None:
+                yield self.CmdRTSPResponse(code, request.seq)
                 return
+            stream_options = stream.sdp_options()
 
-        sdp = self._stream.get_sdp(self.video_opt)
+        yield self.CmdRTSPResponse(self._describe_response(filename, url, stream_options), request.seq)
 
+    def _check_catalog(self, path):
+        """
+        Looks up the requested path in the catalog. Only cataloged files are opened
+        :param path:string path part of the url
+        :return:tuple (AssetInfo, None), or (None, RTSP error code) if the path can not be streamed
+        """
+        info = self._catalog.get(path)
+        if info is None:
+            return None, self.FILE_NOT_FOUND_404
+        if not info.playable:
+            self.logger.warn("Refusing to stream %s: %s" % (path, info.error))
+            return None, self.UNSUPPORTED_MEDIA_TYPE_415
+        return info, None
+
+    def _describe_response(self, filename, url, stream_options):
+        """
+        Gets DESCRIBE response with SDP of the stream
+        It is rendered once for every url and stream state. Changed stream has other SDP values,
+        so its old response is never picked, and it is evicted from the cache eventually
+        :param filename:string requested url, used as the content base
+        :param url: parsed url
+        :param stream_options:dict SDP values of the stream
+        :return:RtspResponse
+        """
+        key = (filename, tuple(sorted(stream_options.items())))
+        response = self._descriptions.get(key)
+        if response is not None:
+            self._descriptions.move_to_end(key)
+            return response
+
+        # Clients set up the stream by the control url. It keeps the query, so SETUP gets the same variant
+        video_path = url.path.lstrip('/')
+        if url.query:
+            video_path += '?' + url.query
+        options = dict(self.video_opt, url=url.hostname or self._local_address, rtsp_port=url.port or 554,
+                       video_path=video_path)
+        options.update(stream_options)
         values = {
             'x-Accept-Dynamic-Rate': 1,
             'Content-Base': filename,
             'Content-Type': 'application/sdp'
         }
-        yield self.CmdRTSPResponse(self.OK_200, request.seq, sdp, **values)
+        response = RtspResponse(self.OK_200, values, make_sdp2(options))
+        self._descriptions[key] = response
+        if len(self._descriptions) > self.SDP_CACHE_SIZE:
+            self._descriptions.popitem(last=False)
+        return response
 
     def _response_setup(self, request, client):
         """
@@ -307,17 +730,29 @@ class RtspServer(TCPServer):
         """
         url = request.url
         seq = request.seq
+        # Session is set up by this request. It is closed, if the request fails
+        new_session = client is None or client.state == INIT
+
+        if self._catalog is not None and new_session:
+            # SETUP opens the stream, so it is refused the same way as DESCRIBE
+            info, code = self._check_catalog(url.path)
+            if info is None:
+                yield from self._refuse_setup(client, new_session, code, seq)
+                return
 
         if client is None:
+            refusal = yield self.CmdAdmitSession()
+            if refusal is not None:
+                yield from self._refuse_setup(client, new_session, self.SERVICE_UNAVAILABLE_503, seq)
+                return
             # Creating new client
             client = yield self.CmdInitClient()
 
         # Update state
         if client.state == INIT:
-            try:
-                self._rtp_server.set_stream(self._stream)
-            except IOError:
-                yield self.CmdRTSPResponse(self.FILE_NOT_FOUND_404, seq)
+            client.stream, code = yield self.CmdOpenStream(url.path)
+            if client.stream is None:
+                yield from self._refuse_setup(client, new_session, code, seq)
                 return
 
         # Send RTSP reply
@@ -326,19 +761,27 @@ class RtspServer(TCPServer):
 
         if transport is None:
             self.logger.warn("No transport info specified")
-            yield self.CmdRTSPResponse(self.UNSUPPORTED_TRANSPORT_461, seq)
+            yield from self._refuse_setup(client, new_session, self.UNSUPPORTED_TRANSPORT_461, seq)
             return
 
-        client.parse_transport_options(transport)
+        # Request is checked before it changes the session, so a refused SETUP keeps an established session as is
+        options = ClientInfo(client.address, client.id)
+        options.parse_transport_options(transport)
+        options.parse_url_options(url)
 
-        if client.interleaved:
+        if options.interleaved:
             self.logger.warn("Interleaved RTSP stream is not supported")
-            values = {
-                'Transport': request.get('transport')
-            }
-            yield self.CmdRTSPResponse(self.UNSUPPORTED_TRANSPORT_461, seq, values)
+            yield from self._refuse_setup(client, new_session, self.UNSUPPORTED_TRANSPORT_461, seq,
+                                          Transport=transport)
             return
 
+        if self._admission is not None:
+            if self._admission.check_bitrate(client, options.quality, self.sessions.values()) is not None:
+                yield from self._refuse_setup(client, new_session, self.NOT_ENOUGH_BANDWIDTH_453, seq)
+                return
+
+        client.set_transport(options)
+
         # Create a new socket for RTP/UDP. We need this info to tell client where to listen
         yield self.CmdOpenRTP(client)
 
@@ -357,12 +800,27 @@ class RtspServer(TCPServer):
             transport_options.append("server_port=%d-%d" % (start, end))
 
         values = {
-            'Session': self._session,
+            'Session': '%s;timeout=%d' % (client.session, self.session_timeout),
             'Transport': dump_list(transport_options)
         }
         client.set_state(READY)
         yield self.CmdRTSPResponse(self.OK_200, seq, **values)  # seq[0] the sequenceNum received from Client.py
 
+    def _refuse_setup(self, client, new_session, code, seq, **values):
+        """
+        Answers SETUP with an error. Session, that was not set up yet, is closed right away, so it does not
+        count against the session limits, and does not keep its stream till the timeout
+        :param client:ClientInfo, or None if it was not created yet
+        :param new_session:bool True if the session is set up by this request
+        :param code:int RTSP status code
+        """
+        if self._admission is not None and code in (self.SERVICE_UNAVAILABLE_503, self.NOT_ENOUGH_BANDWIDTH_453):
+            # DESCRIBE checks the same viewer in advance, so refusals are counted by SETUP only
+            self._admission.refused += 1
+        yield self.CmdRTSPResponse(code, seq, **values)
+        if client is not None and new_session:
+            yield self.CmdCloseRTP(client)
+
     def _response_play(self, request, client):
         """
         Process PLAY request
@@ -372,30 +830,67 @@ class RtspServer(TCPServer):
         Example RTP-Info:
         RTP-Info: url=rtsp://192.168.0.254/jpeg/track1;seq=20730;rtptime=3869319494,url=rtsp://192.168.0.254/jpeg/track2;seq=33509;rtptime=3066362516
         """
-        rtp_info = list()
-        rtp_info.append(request.url_raw)
-        # TODO: Get a proper seq/rtptime
-        rtp_info.append('seq=0')
-        rtp_info.append('rtptime=0')
+        if client.state not in (READY, PAUSE, PLAYING):
+            raise Exception("Should handle this. Was at state=%d" % client.state)
+
         values = {
-            'Session': self._session,
-            'Range': request.get('range'),
-            'RTP-Info': dump_list(rtp_info)
+            'Session': client.session,
         }
 
+        try:
+            start, end = parse_npt_range(request.get('range')) if request.get('range') else (None, None)
+            scale = float(request.get('scale')) if request.get('scale') else None
+        except ValueError as e:
+            self.logger.warn("Bad PLAY request: %s" % str(e))
+            yield self.CmdRTSPResponse(self.INVALID_RANGE_457, request.seq, **values)
+            return
+
+        stream = client.stream
+        if stream.seekable():
+            if start is not None or scale is not None:
+                if not self._is_stream_shared(stream, client):
+                    # Seeking by the frame index, so it does not depend on the file size
+                    try:
+                        stream.seek(start, scale or 1.0)
+                    except ValueError as e:
+                        self.logger.warn("Can not seek: %s" % str(e))
+                        yield self.CmdRTSPResponse(self.INVALID_RANGE_457, request.seq, **values)
+                        return
+                elif client.played:
+                    # Seek of a stream, shared by the path, would move all its viewers
+                    self.logger.warn("Can not seek %s, other sessions play it" % request.url.path)
+                    yield self.CmdRTSPResponse(self.METHOD_NOT_VALID_455, request.seq, **values)
+                    return
+                # Joining viewers start at the current position of a shared stream.
+                # Playback does not stop at the end of the requested range, so it is open
+                start, actual_scale = stream.position()
+                values['Range'] = 'npt=%.3f-' % start
+                if scale is not None:
+                    values['Scale'] = actual_scale
+        else:
+            if start:
+                yield self.CmdRTSPResponse(self.INVALID_RANGE_457, request.seq, **values)
+                return
+            values['Range'] = 'npt=now-'
+            if scale is not None:
+                # Live streams are played at normal speed only
+                values['Scale'] = 1
+
+        # RTP-Info tells the client which packet starts the requested position
+        seq, rtptime = stream.rtp_info(client.quality)
+        values['RTP-Info'] = 'url=%s;seq=%d;rtptime=%d' % (request.url_raw, seq, rtptime)
+
         if client.state == READY:
             self.logger.debug("READY->PLAYING")
-            client.set_state(PLAYING)
-            yield self.CmdRTSPResponse(self.OK_200, request.seq, **values)
-            return
         # Process RESUME request
         elif client.state == PAUSE:
             self.logger.warn("PAUSE->PLAYING")
-            client.set_state(PLAYING)
-            yield self.CmdRTSPResponse(self.OK_200, request.seq, **values)
-            return
-        else:
-            raise Exception("Should handle this. Was at state=%d" % client.state)
+        client.set_state(PLAYING)
+        client.played = True
+        yield self.CmdRTSPResponse(self.OK_200, request.seq, **values)
+        if stream.static:
+            # Still image is refreshed rarely, so it is not worth waiting for
+            yield self.CmdSendFrame(client)
 
     def _response_pause(self, request, client):
         """
@@ -403,9 +898,9 @@ class RtspServer(TCPServer):
         :param request:HttpMessage
         """
         if client.state == PLAYING:
-            logger.warn('PLAYING->READY')
+            self.logger.warn('PLAYING->READY')
             client.set_state(READY)
-            yield self.CmdRTSPResponse(self.OK_200, request.seq)
+            yield self.CmdRTSPResponse(self.OK_200, request.seq, Session=client.session)
         else:
             raise Exception("Should handle this at state %d" % client.state)
 
@@ -415,22 +910,38 @@ class RtspServer(TCPServer):
         :param request:HttpMessage
         """
         client.set_state(DONE)
-        yield self.CmdRTSPResponse(self.OK_200, request.seq)
+        yield self.CmdRTSPResponse(self.OK_200, request.seq, Session=client.session)
         yield self.CmdCloseRTP(client)
 
-    def _process_rtsp_request(self, raw_data, address):
+    def _response_get_parameter(self, request, client):
+        """
+        Process GET_PARAMETER request. Clients send it to keep their session alive
+        :param request:HttpMessage
+        """
+        if client is None:
+            yield self.CmdRTSPResponse(self.OK_200, request.seq)
+        else:
+            yield self.CmdRTSPResponse(self.OK_200, request.seq, Session=client.session)
+
+    def _process_rtsp_request(self, request, address):
         """
         Coroutine that process RTSP protocol sequence
+        :param request:HttpMessage, or None if request is corrupted
         @:rtype: tuple with HTTP status and data
         """
         #self.logger.warn('-'*60)
-        request = HttpMessage()
-        if not request.deserialize(raw_data):
-            self.logger.error("Corrupted RTSP request")
-            yield self.CmdRTSPResponse(self.BAD_REQUEST_400, request.seq)
+        if request is None:
+            yield self.CmdRTSPResponse(self.BAD_REQUEST_400, None)
             return
 
-        client = self._get_client(address)
+        client = self._find_client(request, address)
+        if client is not None:
+            # Any request keeps the session alive
+            client.last_seen = time()
+        elif request.get('session') is not None or request.type in self._session_methods:
+            self.logger.warn("Session not found for %s %s" % (request.type, request.url_raw))
+            yield self.CmdRTSPResponse(self.SESSION_NOT_FOUND_454, request.seq)
+            return
         handler = self._dispatch_table.get(request.type)
 
         if handler is not None:
@@ -447,4 +958,8 @@ class RtspServer(TCPServer):
         Protocol.PLAY: _response_play,
         Protocol.PAUSE: _response_pause,
         Protocol.TEARDOWN: _response_teardown,
+        Protocol.GET_PARAMETER: _response_get_parameter,
     }
+
+    # Methods, that need a session from SETUP
+    _session_methods = (Protocol.PLAY, Protocol.PAUSE, Protocol.TEARDOWN)
@@ -0,0 +1,173 @@
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
+from time import sleep
+from weakref import WeakValueDictionary
+import logging
+import os
+
+from AssetCache import prewarm_asset
+from JpegRtpStillStream import RtpJpegFileStream
+from JpegRtpVideoStream import RtpJpegVideoStream
+
+logger = logging.getLogger(__name__)
+
+"""
+Hot reload of the source directory
+
+Watcher polls modification times of media files. Changed jpegs are transcoded again in background,
+and active streams swap to the new image at a frame boundary, so clients do not reconnect.
+Streams of changed .mjpeg files are indexed again and go on from the same position
+"""
+
+
+class SourceWatcher:
+    """
+    Detects new, changed and removed files by polling their size and mtime
+    Polling is portable and costs a stat() per file, that is cheap for directories of assets
+    """
+    def __init__(self, root, extensions, interval=2.0):
+        """
+        :param root:string directory to be watched, with subdirectories
+        :param extensions:tuple of lowercase file extensions to be watched
+        :param interval:float seconds between polls
+        """
+        self.root = root
+        self.extensions = extensions
+        self.interval = interval
+        self._stats = self.snapshot()
+        self._closed = False
+
+    def snapshot(self):
+        """
+        :return:dict path->(size, mtime)
+        """
+        result = {}
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if not name.lower().endswith(self.extensions):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stats = os.stat(path)
+                except OSError:
+                    continue
+                result[path] = (stats.st_size, stats.st_mtime_ns)
+        return result
+
+    def poll(self):
+        """
+        Compares files with the previous poll
+        :return:tuple (list of new or changed paths, list of removed paths)
+        """
+        stats = self.snapshot()
+        changed = [path for path, stat in stats.items() if self._stats.get(path) != stat]
+        removed = [path for path in self._stats if path not in stats]
+        self._stats = stats
+        return changed, removed
+
+    def _run(self, callback):
+        while not self._closed:
+            sleep(self.interval)
+            changed, removed = self.poll()
+            if not changed and not removed:
+                continue
+            try:
+                callback(changed, removed)
+            except Exception as e:
+                logger.exception("Failed to reload %d changed files: %s" % (len(changed), str(e)))
+
+    def start(self, callback):
+        """
+        Polls the directory in a daemon thread
+        :param callback:function(changed, removed), called from the watcher thread
+        """
+        thread = Thread(target=self._run, args=(callback,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close(self):
+        self._closed = True
+
+
+class AssetReloader:
+    """
+    Transcodes changed files and swaps them into the streams, that are playing them
+    """
+    def __init__(self, catalog, qualities, frame_budget=None, cache=None, workers=1):
+        """
+        :param catalog:AssetCatalog to be updated
+        :param qualities:list of int jpeg qualities
+        :param frame_budget:int maximum size of encoded frame, or None
+        :param cache:AssetCache with prewarmed assets, or None
+        :param workers:int number of transcoding processes
+        """
+        self._catalog = catalog
+        self._qualities = qualities
+        self._frame_budget = frame_budget
+        self._cache = cache
+        self._workers = workers
+        # Maps path->RtpJpegFileStream or RtpJpegVideoStream, that is playing it
+        self._streams = WeakValueDictionary()
+
+    def register(self, path, stream):
+        """
+        Tells that the stream plays the file
+        """
+        if isinstance(stream, (RtpJpegFileStream, RtpJpegVideoStream)):
+            self._streams[path] = stream
+
+    def on_change(self, changed, removed):
+        """
+        Handles changes, found by SourceWatcher
+        :param changed:list of paths to new or changed files
+        :param removed:list of paths to removed files
+        """
+        logger.info("Source files changed: %d, removed: %d" % (len(changed), len(removed)))
+        self._catalog.update(changed, removed)
+        for path in changed + removed:
+            if self._cache is not None:
+                self._cache.discard(path)
+
+        # Files, that nobody has seen yet, are transcoded when they are requested
+        reload = []
+        for path in changed:
+            info = self._catalog.get(self._catalog.url_path(path))
+            if info is None or not info.playable:
+                continue
+            if info.kind == 'video':
+                self._reopen_video(path)
+                continue
+            if info.kind != 'jpeg':
+                continue
+            if path in self._streams or self._cache is not None:
+                reload.append(path)
+        if not reload:
+            return
+
+        with ProcessPoolExecutor(max_workers=self._workers) as executor:
+            futures = [(path, executor.submit(prewarm_asset, path, self._qualities, self._frame_budget,
+                                              RtpJpegFileStream.DEFAULT_PACKET_SIZE)) for path in reload]
+            for path, future in futures:
+                if future.exception() is not None:
+                    logger.error("Failed to transcode changed %s: %s" % (path, str(future.exception())))
+                    continue
+                encoded, elapsed = future.result()
+                logger.info("Transcoded changed %s in %.3fs" % (path, elapsed))
+                if self._cache is not None:
+                    self._cache.store(path, encoded)
+                stream = self._streams.get(path)
+                if stream is not None:
+                    stream.replace_variants(encoded)
+
+    def _reopen_video(self, path):
+        """
+        Indexes the changed .mjpeg file again for its stream. Nothing is done if it is not played
+        """
+        stream = self._streams.get(path)
+        if not isinstance(stream, RtpJpegVideoStream):
+            return
+        try:
+            stream.reopen()
+        except (IOError, ValueError) as e:
+            logger.error("Failed to reopen changed %s: %s" % (path, str(e)))
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StreamCache:
+    """
+    Keeps opened streams for reuse, within a memory budget
+
+    Every stream is charged by its real memory_size(). When the budget is exceeded,
+    the least recently used streams, that nobody plays or holds, are closed and dropped.
+    Active streams are never evicted, so the budget can be exceeded temporarily
+    """
+    def __init__(self, memory_budget, is_active):
+        """
+        :param memory_budget:int number of bytes, that cached streams can use. Streams are never evicted if None
+        :param is_active:function(stream) that tells if the stream is played right now, or held by a session
+        """
+        self.memory_budget = memory_budget
+        self._is_active = is_active
+        # Maps path->stream, the least recently used first
+        self._streams = OrderedDict()
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._streams)
+
+    def items(self):
+        """
+        :return:list of tuples (path, stream)
+        """
+        return list(self._streams.items())
+
+    @property
+    def memory_used(self):
+        # Streams can change their size, like after a reload, so it is not cached
+        return sum(stream.memory_size() for stream in set(self._streams.values()))
+
+    def get(self, path):
+        """
+        Gets a cached stream
+        :param path:string path part of the url
+        :return:RtpFrameGenerator, or None if it is not cached
+        """
+        stream = self._streams.get(path)
+        if stream is None:
+            self.misses += 1
+            return None
+        self._streams.move_to_end(path)
+        self.hits += 1
+        return stream
+
+    def add(self, path, stream):
+        """
+        Caches a newly opened stream
+        :param path:string path part of the url
+        :param stream:RtpFrameGenerator
+        """
+        self._streams[path] = stream
+        # Requested stream is not played yet, but it should survive
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Drops idle streams until the cache fits the budget
+        :param keep:string path of a stream, that should not be evicted
+        :return:int number of evicted streams
+        """
+        if self.memory_budget is None:
+            return 0
+        evicted = 0
+        used = self.memory_used
+        for path in list(self._streams):
+            if used <= self.memory_budget:
+                break
+            stream = self._streams[path]
+            if path == keep or self._is_active(stream):
+                continue
+            size = stream.memory_size()
+            del self._streams[path]
+            # The same stream can be cached for several paths, like a live stream
+            if stream not in self._streams.values():
+                stream.close()
+            used -= size
+            evicted += 1
+            logger.info("Evicted stream %s, %d bytes. Cache uses %d of %d bytes" %
+                        (path, size, used, self.memory_budget))
+        self.evictions += evicted
+        return evicted
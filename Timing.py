@@ -0,0 +1,145 @@
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+"""
+Durations of processing stages, like file reading, jpeg decoding, encoding and sending
+
+Stages record their durations into histograms of the process, that are exported with the
+other metrics. Worker processes, like prewarm ones, keep their own histograms, that are not exported
+"""
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Counts observed values by buckets
+    Stages run in IOLoop and executor threads, so observations are locked
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets:tuple of sorted upper bounds of buckets
+        """
+        self.buckets = buckets
+        # The last one counts values above all the bounds
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self):
+        """
+        :return:list of tuples (upper bound as a string, number of values up to it), ending with '+Inf'
+        """
+        with self._lock:
+            counts = list(self.counts)
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            result.append((str(bound), total))
+        result.append(('+Inf', total + counts[-1]))
+        return result
+
+
+class _StageTimer:
+    """
+    Context manager, that records the time spent inside it
+    """
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(perf_counter() - self._start)
+        return False
+
+
+class StageTimings:
+    """
+    Histograms of stage durations, by stage name
+    It is a source of MetricsRegistry
+    """
+    METRICS = (
+        ('stage_duration_seconds', 'histogram', 'Duration of processing stages'),
+    )
+
+    def __init__(self):
+        # Maps stage name->Histogram
+        self._stages = {}
+
+    def get(self, stage):
+        """
+        :param stage:string stage name
+        :return:Histogram of the stage
+        """
+        histogram = self._stages.get(stage)
+        if histogram is None:
+            histogram = self._stages.setdefault(stage, Histogram())
+        return histogram
+
+    def observe(self, stage, seconds):
+        self.get(stage).observe(seconds)
+
+    def time(self, stage):
+        """
+        Times a block of code:
+            with stages.time('file_read'):
+                ...
+        :param stage:string stage name
+        :return: context manager
+        """
+        return _StageTimer(self.get(stage))
+
+    def timed(self, stage):
+        """
+        Decorator, that times every call of a function
+        :param stage:string stage name
+        """
+        def decorator(function):
+            histogram = self.get(stage)
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    histogram.observe(perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def collect(self):
+        for stage, histogram in sorted(self._stages.items()):
+            for bound, count in histogram.cumulative():
+                yield 'stage_duration_seconds_bucket', {'stage': stage, 'le': bound}, count
+            yield 'stage_duration_seconds_sum', {'stage': stage}, histogram.sum
+            yield 'stage_duration_seconds_count', {'stage': stage}, histogram.count
+
+
+# Stage timings of this process
+stages = StageTimings()
+
+
+def timed(stage):
+    """
+    Decorator, that records durations of a function into the process stage timings
+    :param stage:string stage name
+    """
+    return stages.timed(stage)
@@ -1,7 +1,14 @@
-from struct import pack, unpack
+from struct import pack, unpack, Struct
+from array import array
+from weakref import WeakValueDictionary
+import logging
+import mmap
+import os
 
 __author__ = 'Tibbers'
 
+logger = logging.getLogger(__name__)
+
 
 # Wraps file io
 class VideoStream:
@@ -63,3 +70,202 @@ class VideoStream:
     def frameNbr(self):
         """Get frame number."""
         return self.frameNum
+
+
+class IndexedVideoFile:
+    """
+    Memory-mapped .mjpeg file with an index of frames
+
+    File contains frames, each prefixed by 5-digit ASCII length, the same way VideoStream reads it.
+    Index of frame offsets is built in a single pass and saved to a sidecar file, so the next
+    opening does not scan the file again. Frames are returned as memoryviews of the mapping,
+    so any number of streams can share the file without copying the data
+    """
+    INDEX_MAGIC = b'MJIX'
+    INDEX_VERSION = 1
+    # magic, version, file size, file mtime, number of frames
+    _index_header = Struct('!4sHQQI')
+    LENGTH_SIZE = 5
+
+    def __init__(self, filename, index_path=None):
+        """
+        :param filename:string path to .mjpeg file
+        :param index_path:string path to sidecar index. filename + '.idx' is used if None
+        """
+        self.filename = filename
+        self._index_path = index_path or filename + '.idx'
+        self._file = open(filename, 'rb')
+        stats = os.fstat(self._file.fileno())
+        self._size = stats.st_size
+        self._mtime = stats.st_mtime_ns
+        if self._size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        else:
+            self._map = None
+            self._view = memoryview(b'')
+        # Offsets to the frame data and frame lengths
+        self.offsets = array('Q')
+        self.lengths = array('I')
+
+        if not self._load_index():
+            self._build_index()
+            self._save_index()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def frame_count(self):
+        return len(self.offsets)
+
+    def frame(self, index):
+        """
+        Get frame data without copying
+        :param index:int frame number, starting from 0
+        :return:memoryview with jpeg data
+        raises IOError if the file was truncated under the frame. Reading such pages of the mapping kills
+        the process by SIGBUS
+        """
+        offset = self.offsets[index]
+        end = offset + self.lengths[index]
+        if end > os.fstat(self._file.fileno()).st_size:
+            raise IOError("Frame %d of %s is beyond the end of the changed file" % (index, self.filename))
+        return self._view[offset:end]
+
+    def _build_index(self):
+        data = self._view
+        size = self._size
+        pos = 0
+        offsets, lengths = self.offsets, self.lengths
+        while pos + self.LENGTH_SIZE <= size:
+            try:
+                length = int(data[pos:pos + self.LENGTH_SIZE].tobytes())
+            except ValueError:
+                logger.error("Corrupted frame length at offset %d of %s" % (pos, self.filename))
+                break
+            pos += self.LENGTH_SIZE
+            if pos + length > size:
+                logger.error("Incomplete frame at offset %d of %s" % (pos, self.filename))
+                break
+            offsets.append(pos)
+            lengths.append(length)
+            pos += length
+        logger.info("Indexed %d frames of %s" % (len(offsets), self.filename))
+
+    def _load_index(self):
+        """
+        Loads sidecar index. It is ignored if video file was changed after index was saved
+        :return:bool True if index was loaded
+        """
+        try:
+            with open(self._index_path, 'rb') as file:
+                data = file.read()
+        except IOError:
+            return False
+
+        header_size = self._index_header.size
+        if len(data) < header_size:
+            return False
+        magic, version, size, mtime, count = self._index_header.unpack_from(data, 0)
+        if magic != self.INDEX_MAGIC or version != self.INDEX_VERSION:
+            return False
+        if size != self._size or mtime != self._mtime:
+            logger.info("Index %s is outdated" % self._index_path)
+            return False
+        offsets, lengths = array('Q'), array('I')
+        offsets_end = header_size + count * offsets.itemsize
+        if len(data) != offsets_end + count * lengths.itemsize:
+            return False
+        offsets.frombytes(data[header_size:offsets_end])
+        lengths.frombytes(data[offsets_end:])
+        self.offsets, self.lengths = offsets, lengths
+        return True
+
+    def _save_index(self):
+        header = self._index_header.pack(self.INDEX_MAGIC, self.INDEX_VERSION, self._size, self._mtime,
+                                         len(self.offsets))
+        try:
+            with open(self._index_path, 'wb') as file:
+                file.write(header)
+                file.write(self.offsets.tobytes())
+                file.write(self.lengths.tobytes())
+        except IOError as e:
+            # Index is just an optimization. Video directory can be read-only
+            logger.warn("Failed to save index %s: %s" % (self._index_path, str(e)))
+
+    def close(self):
+        """
+        Closes the mapping. Frames, returned by this file, should be released before
+        """
+        try:
+            self._view.release()
+            if self._map is not None:
+                self._map.close()
+        except BufferError:
+            logger.error("Closing %s while its frames are still in use" % self.filename)
+            return
+        self._file.close()
+
+
+# Maps real path->IndexedVideoFile, that is used by some streams
+_shared_files = WeakValueDictionary()
+
+
+def open_indexed(filename):
+    """
+    Opens indexed video file, sharing it with other streams of the same file
+    :param filename:string path to .mjpeg file
+    :return:IndexedVideoFile
+    """
+    key = os.path.realpath(filename)
+    video = _shared_files.get(key)
+    if video is None or video._mtime != os.stat(key).st_mtime_ns:
+        video = IndexedVideoFile(filename)
+        _shared_files[key] = video
+    return video
+
+
+class IndexedVideoStream:
+    """
+    Playback cursor over a shared IndexedVideoFile
+    It has the same interface as VideoStream, and supports random access to frames
+    """
+    def __init__(self, filename):
+        if filename[0] == '/':
+            filename = filename[1:]
+        if filename[-1] == '/':
+            filename = filename[:-1]
+
+        self._filename = filename
+        self.video = open_indexed(filename)
+        self.frameNum = 0
+
+    def __len__(self):
+        return len(self.video)
+
+    def seek(self, frame_index):
+        """
+        Moves to the specified frame. Next call to nextFrame returns it
+        :param frame_index:int frame number, starting from 0
+        """
+        if frame_index < 0 or frame_index >= len(self.video):
+            raise IndexError("Frame %d is out of range [0, %d)" % (frame_index, len(self.video)))
+        self.frameNum = frame_index
+
+    def nextFrame(self):
+        """
+        Get next frame
+        :return:tuple (memoryview frame, frame number). Frame is None at the end of file
+        """
+        if self.frameNum >= len(self.video):
+            frameNum = self.frameNum
+            self.frameNum = 0
+            return None, frameNum
+        frame = self.video.frame(self.frameNum)
+        self.frameNum += 1
+        return frame, self.frameNum
+
+    def frameNbr(self):
+        """Get frame number."""
+        return self.frameNum
@@ -0,0 +1,75 @@
+import argparse
+import logging
+import sys
+import time
+
+"""
+This example streams live raw frames
+Frames are generated by a test pattern, or read from stdin:
+
+ffmpeg -i video.mp4 -f rawvideo -pix_fmt rgb24 -s 320x240 pipe:1 | python live_jpeg_streamer.py --stdin
+
+Ready jpeg frames can be streamed without transcoding:
+
+ffmpeg -i video.mp4 -f mjpeg pipe:1 | python live_jpeg_streamer.py --mjpeg -
+"""
+
+from RtspServer import RtspServer
+from JpegRtpLiveStream import RtpJpegLiveStream, make_test_pattern, read_raw_frames, start_reader_thread
+from JpegRtpPipeStream import RtpJpegPipeStream
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs RTSP server that streams live raw frames')
+    parser.add_argument('-p', '--port', type=int, default=1025, help='port for RTSP server')
+    parser.add_argument('--address', type=str, default='127.0.0.1', help='Base hostname to be announced through RTSP')
+    parser.add_argument('--width', type=int, default=320, help='Frame width')
+    parser.add_argument('--height', type=int, default=240, help='Frame height')
+    parser.add_argument('--fps', type=float, default=25.0, help='Source framerate')
+    parser.add_argument('--format', default='rgb', help='Pixel format of raw frames: rgb, yuv or gray')
+    parser.add_argument('--quality', type=int, default=80, help='Jpeg quality')
+    parser.add_argument('--workers', type=int, default=2, help='Number of encoder processes')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Encode only changed bands of frames. Suits screen captures and fixed cameras')
+    parser.add_argument('--stdin', action='store_true', help='Read raw frames from stdin instead of test pattern')
+    parser.add_argument('--mjpeg', default=None,
+                        help='Stream concatenated jpeg frames from a file, FIFO or stdin (-) instead of raw frames')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(message)s',
+                        datefmt='%m-%d %H:%M')
+
+    if args.mjpeg is not None:
+        source = sys.stdin.buffer if args.mjpeg == '-' else args.mjpeg
+        stream = RtpJpegPipeStream(source, fps=args.fps, quality=args.quality)
+    else:
+        stream = RtpJpegLiveStream(args.width, args.height, args.format, quality=args.quality, fps=args.fps,
+                                   workers=args.workers, incremental=args.incremental)
+
+    def test_pattern():
+        index = 0
+        period = 1.0 / args.fps
+        while True:
+            stream.push_frame(make_test_pattern(args.width, args.height, index))
+            index += 1
+            time.sleep(period)
+
+    # Pipe stream reads frames by itself
+    if args.mjpeg is None:
+        if args.stdin:
+            start_reader_thread(read_raw_frames, sys.stdin.buffer, stream)
+        else:
+            start_reader_thread(test_pattern)
+
+    # Every url gets the same live stream
+    def stream_factory(path):
+        return stream
+
+    server = RtspServer(args.port, stream_factory)
+    print("Will stream to rtsp://%s:%d/"%(args.address, args.port))
+    server.run()
+
+# Program Start Point
+if __name__ == "__main__":
+    main()
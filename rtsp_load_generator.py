@@ -0,0 +1,366 @@
+from struct import Struct
+from time import perf_counter
+from urllib.parse import urlparse
+import argparse
+import logging
+import socket
+import sys
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+"""
+Headless load generator for the RTSP server
+
+Simulates concurrent viewers on a single IOLoop. Every viewer runs OPTIONS, DESCRIBE, SETUP and PLAY,
+receives RTP on its own UDP port for a while, then sends TEARDOWN. Setup latency, received packets,
+sequence loss and completeness of jpeg frames are reported for all the viewers.
+
+Example:
+    python rtsp_load_generator.py rtsp://127.0.0.1:1025/image.jpg --clients 50 --duration 10
+"""
+
+logger = logging.getLogger(__name__)
+
+# RTP header fields: flags, marker and payload type, sequence number, timestamp
+_rtp_header = Struct('!BBHI')
+RTP_HEADER_SIZE = 12
+
+
+class RtspError(Exception):
+    """
+    Request, that got a non-200 response
+    """
+    def __init__(self, method, code, reason):
+        super(RtspError, self).__init__("%s failed with %d %s" % (method, code, reason))
+        self.code = code
+
+
+class ViewerStats:
+    """
+    Results of a single simulated viewer
+    """
+    def __init__(self):
+        # Seconds from connecting to PLAY response
+        self.setup_time = None
+        # Seconds from PLAY request to the first RTP packet
+        self.first_packet_time = None
+        # Seconds between the first and the last received packets
+        self.receive_time = 0.0
+        self.packets = 0
+        self.bytes = 0
+        # Packets, missing in the sequence
+        self.lost = 0
+        self.frames_complete = 0
+        self.frames_incomplete = 0
+        # Reason of a failure, or None
+        self.error = None
+        # RTSP status code of a failure, or None
+        self.error_code = None
+
+
+class RtpReceiver:
+    """
+    Counts RTP/JPEG packets, received on a UDP socket
+    Frame is complete, if it starts at fragment offset 0 and ends with a marker, without sequence gaps
+    """
+    def __init__(self, address='127.0.0.1'):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.socket.bind((address, 0))
+        self.socket.setblocking(False)
+        self.port = self.socket.getsockname()[1]
+        self.packets = 0
+        self.bytes = 0
+        self.first_time = None
+        self.last_time = None
+        self.frames_complete = 0
+        self.frames_incomplete = 0
+        # Extended sequence numbers of the first and the latest packets
+        self._first_seq = None
+        self._last_seq = None
+        # Timestamp of the frame being received, and if it has no gaps so far
+        self._frame_timestamp = None
+        self._frame_ok = False
+
+    @property
+    def lost(self):
+        if self._first_seq is None:
+            return 0
+        return max(self._last_seq - self._first_seq + 1 - self.packets, 0)
+
+    def start(self):
+        IOLoop.current().add_handler(self.socket.fileno(), self._on_readable, IOLoop.READ)
+
+    def close(self):
+        IOLoop.current().remove_handler(self.socket.fileno())
+        self.socket.close()
+
+    def _on_readable(self, fd, events):
+        # Socket is drained, so a burst of a frame is handled by a single callback
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                break
+            self._on_packet(data)
+
+    def _on_packet(self, data):
+        if len(data) < RTP_HEADER_SIZE + 8:
+            return
+        now = perf_counter()
+        if self.first_time is None:
+            self.first_time = now
+        self.last_time = now
+        self.packets += 1
+        self.bytes += len(data)
+
+        flags, marker_pt, seq, timestamp = _rtp_header.unpack_from(data)
+        if self._last_seq is None:
+            self._first_seq = self._last_seq = seq
+            in_order = True
+        else:
+            delta = (seq - self._last_seq) & 0xffff
+            # Late or duplicate packets do not move the sequence back
+            in_order = delta == 1
+            if 0 < delta < 0x8000:
+                self._last_seq += delta
+
+        if timestamp != self._frame_timestamp:
+            if self._frame_timestamp is not None and self._frame_ok:
+                # Previous frame has lost its marker
+                self.frames_incomplete += 1
+            self._frame_timestamp = timestamp
+            # RTP/JPEG header has 24-bit fragment offset after the type-specific byte
+            offset = data[RTP_HEADER_SIZE + 1] << 16 | data[RTP_HEADER_SIZE + 2] << 8 | data[RTP_HEADER_SIZE + 3]
+            self._frame_ok = offset == 0
+            if not self._frame_ok:
+                self.frames_incomplete += 1
+        elif self._frame_ok and not in_order:
+            self._frame_ok = False
+            self.frames_incomplete += 1
+
+        if marker_pt & 0x80:
+            if self._frame_ok:
+                self.frames_complete += 1
+            # Next packets of this frame, if any, are not counted again
+            self._frame_ok = False
+
+
+class RtspViewer:
+    """
+    Simulated RTSP client
+    """
+    def __init__(self, url, duration, address='127.0.0.1'):
+        """
+        :param url:string stream url
+        :param duration:float seconds to receive RTP
+        :param address:string local address to receive RTP at
+        """
+        self.url = url
+        self.duration = duration
+        self.address = address
+        self.stats = ViewerStats()
+        self._stream = None
+        self._seq = 0
+        self._session = None
+        # Seconds between keep-alive requests
+        self._keepalive = None
+
+    @gen.coroutine
+    def _request(self, method, headers=None):
+        """
+        Sends a request and reads its response
+        :return:tuple (dict lowercase header->value, bytes body)
+        """
+        self._seq += 1
+        lines = ['%s %s RTSP/1.0' % (method, self.url), 'CSeq: %d' % self._seq]
+        if self._session is not None:
+            lines.append('Session: %s' % self._session)
+        for name, value in (headers or {}).items():
+            lines.append('%s: %s' % (name, value))
+        yield self._stream.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+
+        head = yield self._stream.read_until(b'\r\n\r\n', max_bytes=65536)
+        head_lines = head.decode('utf-8', 'replace').split('\r\n')
+        status = head_lines[0].split(' ', 2)
+        if len(status) < 2 or not status[1].isdigit():
+            raise RtspError(method, 0, "Broken response: %s" % head_lines[0])
+        values = {}
+        for line in head_lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                values[name.strip().lower()] = value.strip()
+        body = b''
+        length = int(values.get('content-length', 0))
+        if length:
+            body = yield self._stream.read_bytes(length)
+        code = int(status[1])
+        if code != 200:
+            raise RtspError(method, code, status[2] if len(status) > 2 else '')
+        return values, body
+
+    @gen.coroutine
+    def run(self):
+        """
+        Runs the session and fills in the stats
+        """
+        stats = self.stats
+        url = urlparse(self.url)
+        receiver = RtpReceiver(self.address)
+        start = perf_counter()
+        try:
+            self._stream = yield TCPClient().connect(url.hostname, url.port or 554)
+            yield self._request('OPTIONS')
+            yield self._request('DESCRIBE', {'Accept': 'application/sdp'})
+            values, body = yield self._request('SETUP', {
+                'Transport': 'RTP/AVP;unicast;client_port=%d-%d' % (receiver.port, receiver.port + 1)
+            })
+            session = values.get('session', '')
+            self._session = session.split(';')[0].strip() or None
+            if 'timeout=' in session:
+                self._keepalive = int(session.split('timeout=')[1]) / 2.0
+
+            receiver.start()
+            play_start = perf_counter()
+            yield self._request('PLAY', {'Range': 'npt=0.000-'})
+            stats.setup_time = perf_counter() - start
+
+            end = play_start + self.duration
+            last_request = perf_counter()
+            while True:
+                now = perf_counter()
+                if now >= end:
+                    break
+                if self._keepalive is not None and now - last_request >= self._keepalive:
+                    yield self._request('GET_PARAMETER')
+                    last_request = perf_counter()
+                yield gen.sleep(min(1.0, end - now))
+
+            yield self._request('TEARDOWN')
+            if receiver.first_time is not None:
+                stats.first_packet_time = receiver.first_time - play_start
+        except RtspError as e:
+            stats.error = str(e)
+            stats.error_code = e.code
+        except (StreamClosedError, OSError) as e:
+            stats.error = "Connection failed: %s" % str(e)
+        except Exception as e:
+            # Single broken viewer should not stop the others
+            logger.exception("Viewer of %s failed" % self.url)
+            stats.error = "%s: %s" % (type(e).__name__, str(e))
+        finally:
+            if receiver.first_time is not None:
+                stats.receive_time = receiver.last_time - receiver.first_time
+            stats.packets = receiver.packets
+            stats.bytes = receiver.bytes
+            stats.lost = receiver.lost
+            stats.frames_complete = receiver.frames_complete
+            stats.frames_incomplete = receiver.frames_incomplete
+            receiver.close()
+            if self._stream is not None:
+                self._stream.close()
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    :param values:list of numbers
+    :param points:tuple of percentiles
+    :return:list of values at the percentiles, by nearest rank, or empty list if there are no values
+    """
+    if not values:
+        return []
+    values = sorted(values)
+    result = []
+    for point in points:
+        rank = max(int(round(point / 100.0 * len(values) + 0.5)) - 1, 0)
+        result.append(values[min(rank, len(values) - 1)])
+    return result
+
+
+def report(viewers, elapsed):
+    """
+    Prints a summary of all the viewers
+    :param viewers:list of RtspViewer
+    :param elapsed:float seconds of the whole test
+    :return:int number of failed viewers
+    """
+    stats = [viewer.stats for viewer in viewers]
+    failed = [s for s in stats if s.error is not None]
+    print("Viewers: %d, succeeded: %d, failed: %d, test took %.1fs" %
+          (len(stats), len(stats) - len(failed), len(failed), elapsed))
+    errors = {}
+    for s in failed:
+        errors[s.error] = errors.get(s.error, 0) + 1
+    for error, count in sorted(errors.items(), key=lambda item: -item[1]):
+        print("  %dx %s" % (count, error))
+
+    for name, values in (('Setup latency', [s.setup_time for s in stats if s.setup_time is not None]),
+                         ('First packet', [s.first_packet_time for s in stats if s.first_packet_time is not None])):
+        if values:
+            p50, p90, p99 = percentiles(values)
+            print("%s: p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms" %
+                  (name, p50 * 1000, p90 * 1000, p99 * 1000, max(values) * 1000))
+
+    packets = sum(s.packets for s in stats)
+    size = sum(s.bytes for s in stats)
+    lost = sum(s.lost for s in stats)
+    complete = sum(s.frames_complete for s in stats)
+    incomplete = sum(s.frames_incomplete for s in stats)
+    receiving = [s for s in stats if s.receive_time > 0]
+    print("Received %d packets, %.1f MB: %.0f packets/s, %.2f Mbit/s in total" %
+          (packets, size / 1e6, packets / elapsed, size * 8 / elapsed / 1e6))
+    if receiving:
+        rates = [s.packets / s.receive_time for s in receiving]
+        frame_rates = [s.frames_complete / s.receive_time for s in receiving]
+        print("Per viewer: %.0f packets/s, %.2f complete frames/s on average, the slowest one has %.2f frames/s" %
+              (sum(rates) / len(rates), sum(frame_rates) / len(frame_rates), min(frame_rates)))
+    print("Lost %d packets, %.3f%%" % (lost, 100.0 * lost / (packets + lost) if packets + lost else 0.0))
+    print("Frames: %d complete, %d incomplete, %.3f%% incomplete" %
+          (complete, incomplete, 100.0 * incomplete / (complete + incomplete) if complete + incomplete else 0.0))
+    return len(failed)
+
+
+@gen.coroutine
+def run_load(urls, clients, duration, ramp, address):
+    """
+    Starts the viewers, spread over the ramp time, and waits for all of them
+    :return:list of RtspViewer
+    """
+    viewers = []
+    sessions = []
+    for i in range(clients):
+        viewer = RtspViewer(urls[i % len(urls)], duration, address)
+        viewers.append(viewer)
+        sessions.append(viewer.run())
+        if ramp > 0 and i + 1 < clients:
+            yield gen.sleep(ramp / clients)
+    yield sessions
+    return viewers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates concurrent RTSP viewers and reports server performance')
+    parser.add_argument('urls', nargs='+', help='Stream urls, like rtsp://127.0.0.1:1025/image.jpg. '
+                                                'Viewers are spread over them round-robin')
+    parser.add_argument('-n', '--clients', type=int, default=10, help='Number of concurrent viewers')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='Seconds each viewer receives RTP')
+    parser.add_argument('--ramp', type=float, default=1.0, help='Seconds to spread viewer starts over')
+    parser.add_argument('--address', default='127.0.0.1', help='Local address to receive RTP at')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    start = perf_counter()
+    viewers = IOLoop.current().run_sync(lambda: run_load(args.urls, args.clients, args.duration, args.ramp,
+                                                         args.address))
+    failed = report(viewers, perf_counter() - start)
+    # Failures make the exit code nonzero, so regressions break scripted runs
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -71,6 +71,7 @@ t=0 0
 a=tool:{server_name}
 a=type:broadcast
 a=control:*
+a=range:{range}
 a=recvonly
 a=x-qt-text-nam:{session_name}
 a=x-qt-text-inf:jpeg
@@ -93,6 +94,7 @@ a=framerate:{fps}"""
         'url': '127.0.0.7',
         'rtsp_port': '1025',
         'video_path': 'video.mjpg',
+        'range': 'npt=0-',
     }
     options.update(video_opt)
     return mjpeg_sdp_format2.format(**options)
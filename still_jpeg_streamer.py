@@ -1,13 +1,32 @@
 import argparse
 import logging
+import os
+import signal
+import socket
+import tempfile
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.process import fork_processes
 
 """
-This example streams still jpeg frames
-File is determined by requested URL
+This example streams still jpeg frames and .mjpeg videos
+File is determined by requested URL. Directory and .m3u URLs are played as slideshows
 """
 
 from RtspServer import RtspServer
-from JpegRtpStillStream import RtpJpegFileStream
+from RtpServer import RtpServer
+from AssetCatalog import AssetCatalog, JPEG_EXTENSIONS, VIDEO_EXTENSIONS, PLAYLIST_EXTENSIONS, is_playlist, \
+    source_file
+from AssetCache import AssetCache, prewarm_asset
+from SourceWatcher import SourceWatcher, AssetReloader
+from AdmissionControl import AdmissionControl
+from Metrics import MetricsRegistry, start_metrics_server
+from Profiler import Profiler
+from LoopWatchdog import LoopWatchdog
+from Timing import stages
+from JpegRtpStillStream import RtpJpegFileStream, frame_budget
+from JpegRtpVideoStream import RtpJpegVideoStream
+from JpegRtpPlaylistStream import RtpJpegPlaylistStream
 
 
 def main():
@@ -15,7 +34,83 @@ def main():
     parser.add_argument('-p', '--port', type=int, default=1025, help='port for RTSP server')
     parser.add_argument('--address', type=str, default='127.0.0.1', help='Base hostname to be announced through RTSP')
     parser.add_argument('--src', default='.', help='Directory with jpeg files to be streamed. Each file is accessible from as URL')
+    parser.add_argument('--qualities', type=str, default='80',
+                        help='Comma-separated list of jpeg qualities to be encoded for each file, like 30,50,80. '
+                             'Client picks one using ?quality=N url query or x-quality=N transport option')
+    parser.add_argument('--frame-budget', type=int, default=None,
+                        help='Maximum size of encoded frame, in bytes. Quality is reduced to fit it')
+    parser.add_argument('--bitrate', type=int, default=None,
+                        help='Target bitrate, in kbit/s. Converted to a frame budget at --fps')
+    parser.add_argument('--dwell', type=float, default=RtpJpegPlaylistStream.DEFAULT_DWELL,
+                        help='Seconds to show each image of a directory or .m3u playlist')
+    parser.add_argument('--still-rate', type=float, default=1.0,
+                        help='Framerate of still images and playlists. Image is sent on PLAY, then repeated '
+                             'at this rate to keep decoders alive. 0 sends them at --fps')
+    parser.add_argument('--fps', type=float, default=25.0, help='Stream framerate, used for --bitrate and .mjpeg playback')
+    parser.add_argument('--no-index', action='store_true',
+                        help='Do not probe --src at startup. Files are checked only when they are requested')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes, probing files at startup. Defaults to the number of CPUs')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='Transcode all files in background at startup, so the first viewers do not wait')
+    parser.add_argument('--cache-dir', default=os.path.join(tempfile.gettempdir(), 'rtsp-jpeg-cache'),
+                        help='Directory for transcoded files, used by --prewarm')
+    parser.add_argument('--cache-memory', type=int, default=256,
+                        help='Memory budget for prewarmed files, in MB. The rest are read from --cache-dir')
+    parser.add_argument('--watch', type=float, default=2.0,
+                        help='Interval of polling --src for changed files, in seconds. Changed files are '
+                             'transcoded again and swapped into playing streams. 0 disables it')
+    parser.add_argument('--stream-memory', type=int, default=None,
+                        help='Memory budget for opened streams, in MB. Streams, that nobody plays, are closed '
+                             'in least recently used order to fit it. Streams are kept open if not set')
+    parser.add_argument('--session-timeout', type=int, default=RtspServer.DEFAULT_SESSION_TIMEOUT,
+                        help='Seconds without requests, after which RTSP session is closed and its stream is stopped')
+    parser.add_argument('--max-sessions', type=int, default=None, help='Maximum number of RTSP sessions')
+    parser.add_argument('--max-sessions-per-ip', type=int, default=None,
+                        help='Maximum number of RTSP sessions from a single address')
+    parser.add_argument('--max-transcodes', type=int, default=None,
+                        help='Maximum number of streams being opened at once. Opening a jpeg transcodes it')
+    parser.add_argument('--max-bitrate', type=int, default=None,
+                        help='Maximum aggregate egress, in kbit/s. New sessions, that do not fit it, are refused')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of server processes. They share --port with SO_REUSEPORT, and transcoded '
+                             'files through --cache-dir. Capacity limits apply to each process. A client must '
+                             'keep its RTSP connection, since its session lives in a single process')
+    parser.add_argument('--rtp-port', type=int, default=RtpServer.DEFAULT_PORT,
+                        help='First UDP port to send RTP from. Every process takes the next two ports')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='HTTP port to serve Prometheus metrics at /metrics. With --processes, '
+                             'every process takes the next port')
+    parser.add_argument('--metrics-address', default='127.0.0.1',
+                        help='Local address of --metrics-port. POST /profile is not authenticated, so it is '
+                             'served on the loopback by default. Empty string listens on all the interfaces')
+    parser.add_argument('--profile-dir', default=os.path.join(tempfile.gettempdir(), 'rtsp-profiles'),
+                        help='Directory for cProfile stats. Profiling of the IOLoop thread is started by SIGUSR1 '
+                             'or POST /profile?seconds=N to --metrics-port')
+    parser.add_argument('--profile-seconds', type=float, default=Profiler.DEFAULT_DURATION,
+                        help='Duration of profiling, started by SIGUSR1')
+    parser.add_argument('--loop-threshold', type=float, default=LoopWatchdog.DEFAULT_THRESHOLD,
+                        help='Seconds, that IOLoop can be held by a handler. Longer stalls are logged with '
+                             'the stack of the handler. 0 disables the watchdog')
     args = parser.parse_args()
+    if args.processes > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error("--processes needs SO_REUSEPORT, that is not supported by this system")
+    if args.prewarm and args.no_index:
+        parser.error("--prewarm needs the file index")
+    if args.no_index:
+        args.watch = 0
+    qualities = [int(q) for q in args.qualities.split(',')]
+    budget = args.frame_budget
+    if args.bitrate is not None:
+        budget = frame_budget(args.bitrate * 1000, args.fps)
+    still_rate = args.still_rate or None
+
+    cache = None
+    # Processes share the transcoded files, so each file is transcoded just once
+    if args.prewarm or args.processes > 1:
+        cache = AssetCache(args.cache_dir, qualities, budget, memory_budget=args.cache_memory << 20)
+
+    reloader = None
 
     # Test stream factory. Creates JpegStream for any url
     def stream_factory(path):
@@ -23,9 +118,28 @@ def main():
         :param path: path to be opened. Extracted from URL and starts with '/'
         :return: Created stream or None
         """
-        file = args.src + path
+        file = source_file(args.src, path)
         try:
-            return RtpJpegFileStream(file)
+            if file.endswith('.mjpeg') or file.endswith('.mjpg'):
+                stream = RtpJpegVideoStream(file, fps=args.fps, quality=max(qualities))
+                if reloader is not None:
+                    reloader.register(file, stream)
+                return stream
+            if is_playlist(file):
+                return RtpJpegPlaylistStream(file, dwell=args.dwell, qualities=qualities, frame_budget=budget,
+                                             cache=cache, refresh_rate=still_rate)
+            if cache is not None:
+                encoded = cache.load(file)
+                if encoded is None:
+                    encoded, elapsed = prewarm_asset(file, qualities, budget, RtpJpegFileStream.DEFAULT_PACKET_SIZE)
+                    cache.store(file, encoded)
+                stream = RtpJpegFileStream(file, qualities=qualities, frame_budget=budget, encoded=encoded,
+                                           refresh_rate=still_rate)
+            else:
+                stream = RtpJpegFileStream(file, qualities=qualities, frame_budget=budget, refresh_rate=still_rate)
+            if reloader is not None:
+                reloader.register(file, stream)
+            return stream
         except:
             raise
             # File not found? Should 404 back
@@ -34,11 +148,64 @@ def main():
     # format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
     # set up logging to file - see previous section for more details
     logging.basicConfig(level=logging.DEBUG,
-                        format='%(message)s',
+                        format='%(process)d %(message)s' if args.processes > 1 else '%(message)s',
                         datefmt='%m-%d %H:%M')
     # define a Handler which writes INFO messages or hi
 
-    server = RtspServer(args.port, stream_factory)
+    catalog = None
+    if not args.no_index:
+        catalog = AssetCatalog(args.src, fps=args.fps, still_fps=still_rate)
+        catalog.scan(args.workers)
+
+    worker = 0
+    supervisor = os.getpid()
+    if args.processes > 1:
+        # Catalog is scanned once and inherited. Threads and sockets are started by every worker, after the fork.
+        # Supervisor stays in fork_processes and restarts the workers, that crash
+        worker = fork_processes(args.processes)
+        print("Worker %d publishes RTP from ports %d-%d" %
+              (worker, args.rtp_port + 2 * worker, args.rtp_port + 2 * worker + 1))
+
+    # Other workers pick prewarmed files from the disk cache
+    if args.prewarm and worker == 0:
+        cache.start_prewarm(catalog.paths('jpeg'), args.workers)
+    if args.watch > 0:
+        reloader = AssetReloader(catalog, qualities, budget, cache)
+        watcher = SourceWatcher(args.src, JPEG_EXTENSIONS + VIDEO_EXTENSIONS + PLAYLIST_EXTENSIONS,
+                                args.watch)
+        watcher.start(reloader.on_change)
+
+    stream_memory = None
+    if args.stream_memory is not None:
+        stream_memory = args.stream_memory << 20
+    admission = None
+    if any(value is not None for value in (args.max_sessions, args.max_sessions_per_ip,
+                                           args.max_transcodes, args.max_bitrate)):
+        max_bitrate = args.max_bitrate * 1000 if args.max_bitrate is not None else None
+        admission = AdmissionControl(args.max_sessions, args.max_sessions_per_ip, args.max_transcodes, max_bitrate)
+    server = RtspServer(args.port, stream_factory, catalog, stream_memory, args.session_timeout, admission,
+                        rtp_port=args.rtp_port + 2 * worker, reuse_port=args.processes > 1)
+    profiler = Profiler(args.profile_dir, args.profile_seconds)
+    if hasattr(signal, 'SIGUSR1'):
+        # Handler runs in the IOLoop, so the profile covers its thread
+        IOLoop.current().asyncio_loop.add_signal_handler(signal.SIGUSR1, profiler.start)
+    watchdog = None
+    if args.loop_threshold > 0:
+        watchdog = LoopWatchdog(args.loop_threshold)
+        watchdog.start()
+    if args.metrics_port is not None:
+        registry = MetricsRegistry()
+        registry.register(server)
+        registry.register(stages)
+        if watchdog is not None:
+            registry.register(watchdog)
+        start_metrics_server(registry, args.metrics_port + worker, args.metrics_address, profiler=profiler)
+    if args.processes > 1:
+        # Workers stop when the supervisor is gone, so stopping it stops the whole server
+        def check_supervisor():
+            if os.getppid() != supervisor:
+                IOLoop.current().stop()
+        PeriodicCallback(check_supervisor, 1000).start()
     print("Will stream to rtsp://%s:%d/"%(args.address, args.port))
     server.run()
 
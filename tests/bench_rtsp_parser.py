@@ -0,0 +1,61 @@
+from HttpMessage import HttpMessage, RtspRequestParser
+import argparse
+import time
+
+"""
+Microbenchmark of RTSP request parsing
+Compares string parser of whole requests with the incremental bytes parser,
+on a typical client session, sent as a single pipelined chunk
+"""
+parser = argparse.ArgumentParser(description='Benchmark RTSP request parsers')
+parser.add_argument('-n', '--sessions', type=int, default=20000, help='number of sessions to parse')
+args = parser.parse_args()
+
+url = 'rtsp://127.0.0.1:1025/image.jpg?quality=50'
+session = [
+    'OPTIONS %s RTSP/1.0\r\nCSeq: 1\r\nUser-Agent: LibVLC/3.0.8 (LIVE555 Streaming Media v2018.02.18)\r\n\r\n' % url,
+    'DESCRIBE %s RTSP/1.0\r\nCSeq: 2\r\nUser-Agent: LibVLC/3.0.8 (LIVE555 Streaming Media v2018.02.18)\r\n'
+    'Accept: application/sdp\r\n\r\n' % url,
+    'SETUP %s RTSP/1.0\r\nCSeq: 3\r\nUser-Agent: LibVLC/3.0.8 (LIVE555 Streaming Media v2018.02.18)\r\n'
+    'Transport: RTP/AVP;unicast;client_port=9100-9101\r\n\r\n' % url,
+    'PLAY %s RTSP/1.0\r\nCSeq: 4\r\nUser-Agent: LibVLC/3.0.8 (LIVE555 Streaming Media v2018.02.18)\r\n'
+    'Session: 905750\r\nRange: npt=0.000-\r\n\r\n' % url,
+    'GET_PARAMETER %s RTSP/1.0\r\nCSeq: 5\r\nSession: 905750\r\nContent-Type: text/parameters\r\n'
+    'Content-Length: 8\r\n\r\nposition' % url,
+    'TEARDOWN %s RTSP/1.0\r\nCSeq: 6\r\nSession: 905750\r\n\r\n' % url,
+]
+chunk = ''.join(session).encode()
+requests = args.sessions * len(session)
+
+
+def use(request):
+    # Headers, that request handlers look at
+    return request.type, request.seq, request.url.path, request.get('transport'), request.get('range')
+
+
+def bench_strings():
+    for i in range(args.sessions):
+        # Body of GET_PARAMETER is not split by the old parser, it is glued to the next request
+        for raw in chunk.split(b'\r\n\r\n')[:-1]:
+            request = HttpMessage()
+            if request.deserialize((raw + b'\r\n\r\n').decode('utf-8')):
+                use(request)
+
+
+def bench_bytes():
+    for i in range(args.sessions):
+        rtsp_parser = RtspRequestParser()
+        rtsp_parser.feed(chunk)
+        while True:
+            request = rtsp_parser.next_message()
+            if request is None:
+                break
+            use(request)
+
+
+for name, bench in (('string parser', bench_strings), ('bytes parser', bench_bytes)):
+    start = time.perf_counter()
+    bench()
+    elapsed = time.perf_counter() - start
+    print("%s: %d requests in %.3fs, %.0f requests/s, %.2fus per request" %
+          (name, requests, elapsed, requests / elapsed, elapsed * 1e6 / requests))
@@ -0,0 +1,61 @@
+from AssetCache import AssetCache
+import os
+import shutil
+import tempfile
+import unittest
+
+"""
+Tests of the asset cache, whose sources are removed while it is filled
+Run from the repository root: python -m pytest tests/test_asset_cache.py
+"""
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image.jpg')
+
+
+class RemovingCache(AssetCache):
+    """
+    Removes a source right after it is transcoded, before it is stored
+    """
+    removed = None
+
+    def store(self, path, encoded, evict=True):
+        if path == self.removed:
+            os.remove(path)
+        return super(RemovingCache, self).store(path, encoded, evict)
+
+
+class RemovedSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for name in ('first.jpg', 'second.jpg', 'third.jpg'):
+            path = os.path.join(self.directory, name)
+            shutil.copy(IMAGE, path)
+            self.paths.append(path)
+        self.cache_dir = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store_skips_removed_source(self):
+        cache = AssetCache(self.cache_dir, [50])
+        with open(IMAGE, 'rb') as file:
+            encoded = [(50, file.read(), None)]
+        os.remove(self.paths[0])
+        self.assertFalse(cache.store(self.paths[0], encoded))
+        self.assertEqual(cache.memory_used, 0)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertTrue(cache.store(self.paths[1], encoded))
+        self.assertEqual(cache.load(self.paths[1]), encoded)
+
+    def test_prewarm_goes_on(self):
+        cache = RemovingCache(self.cache_dir, [50])
+        cache.removed = self.paths[1]
+        self.assertEqual(cache.prewarm(self.paths, workers=1), 3)
+        self.assertIsNotNone(cache.load(self.paths[0]))
+        self.assertIsNotNone(cache.load(self.paths[2]))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
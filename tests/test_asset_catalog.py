@@ -0,0 +1,58 @@
+from AssetCatalog import source_file
+import os
+import shutil
+import tempfile
+import unittest
+
+"""
+Tests of mapping URL paths to source files
+Run from the repository root: python -m pytest tests/test_asset_catalog.py
+"""
+
+
+class SourceFileTest(unittest.TestCase):
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.root = os.path.join(self.base, 'src')
+        os.makedirs(os.path.join(self.root, 'show'))
+        with open(os.path.join(self.base, 'secret.jpg'), 'wb') as file:
+            file.write(b'secret')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_files_under_root(self):
+        self.assertEqual(source_file(self.root, '/image.jpg'), os.path.join(self.root, 'image.jpg'))
+        self.assertEqual(source_file(self.root, '/show/a.jpg'), os.path.join(self.root, 'show', 'a.jpg'))
+        self.assertEqual(source_file(self.root, '/show/../image.jpg'), os.path.join(self.root, 'show/../image.jpg'))
+        # Root directory is a playlist
+        self.assertEqual(source_file(self.root, '/'), os.path.join(self.root, ''))
+
+    def test_parent_directories(self):
+        for path in ('/../secret.jpg', '/../../etc/hostname', '/show/../../secret.jpg', '/..'):
+            with self.assertRaises(IOError):
+                source_file(self.root, path)
+
+    def test_sibling_with_common_prefix(self):
+        os.makedirs(os.path.join(self.base, 'src2'))
+        with self.assertRaises(IOError):
+            source_file(self.root, '/../src2/image.jpg')
+
+    def test_symlink_outside(self):
+        os.symlink(os.path.join(self.base, 'secret.jpg'), os.path.join(self.root, 'link.jpg'))
+        with self.assertRaises(IOError):
+            source_file(self.root, '/link.jpg')
+
+    def test_relative_root(self):
+        cwd = os.getcwd()
+        os.chdir(self.base)
+        try:
+            self.assertEqual(source_file('src', '/image.jpg'), os.path.join('src', 'image.jpg'))
+            with self.assertRaises(IOError):
+                source_file('src', '/../secret.jpg')
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+from JpegFile import JpegFile, ReferenceJpeg, serialize_coefficients, serialize_for_size, transform_blocks
+from JpegRtpStillStream import RtpJpegEncoder, RtpJpegFileStream, RtpPacket, encode_variants
+import os
+import unittest
+
+"""
+Tests of jpeg encoding with a frame budget
+Run from the repository root: python -m pytest tests/test_jpeg_encoder.py
+"""
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image.jpg')
+
+
+def read_image():
+    with open(IMAGE, 'rb') as file:
+        return file.read()
+
+
+class FrameBudgetTest(unittest.TestCase):
+    def test_packetized_frame_fits_budget(self):
+        raw_data = read_image()
+        for packet_size in (500, 1400):
+            for budget in (8000, 12345):
+                quality, used_quality, data = encode_variants(raw_data, [95], budget, packet_size)[0]
+                jpeg = JpegFile()
+                jpeg.load_data(data)
+                payloads = RtpJpegEncoder().packetize(jpeg, packet_size)
+                size = sum(len(payload) for payload in payloads) + len(payloads) * RtpPacket.HEADER_SIZE
+                self.assertLessEqual(size, budget)
+                # Admission control estimates the same size
+                stream = RtpJpegFileStream(IMAGE, packet_size, encoded=[(quality, data, None)])
+                self.assertEqual(stream.frame_size(), size)
+
+
+class RateControlTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.image = ReferenceJpeg(read_image())
+        cls.image.decompress_ref()
+        cls.coefficients = transform_blocks(cls.image)
+
+    def scan_size(self, quality):
+        return len(serialize_coefficients(self.coefficients, self.image.n, quality))
+
+    def test_best_quality_within_budget(self):
+        for target in (8000, 11000, 15000):
+            data, quality = serialize_for_size(self.image, target, max_probes=10, coefficients=self.coefficients)
+            self.assertLessEqual(self.scan_size(quality), target)
+            # The next quality does not fit
+            self.assertGreater(self.scan_size(quality + 1), target)
+            # Encoded jpeg carries the same scan
+            jpeg = JpegFile()
+            self.assertTrue(jpeg.load_data(data))
+            self.assertEqual(len(jpeg.image_data) - 2, self.scan_size(quality))
+
+    def test_top_quality(self):
+        data, quality = serialize_for_size(self.image, 1 << 20, max_quality=60, coefficients=self.coefficients)
+        self.assertEqual(quality, 60)
+
+    def test_budget_too_small(self):
+        data, quality = serialize_for_size(self.image, 100, min_quality=5, coefficients=self.coefficients)
+        self.assertEqual(quality, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
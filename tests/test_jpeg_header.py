@@ -0,0 +1,74 @@
+from JpegFile import JpegFile
+import mmap
+import os
+import unittest
+
+"""
+Tests of jpeg header parsing from different kinds of buffers
+Run from the repository root: python -m pytest tests/test_jpeg_header.py
+"""
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image.jpg')
+
+
+def header_fields(jpeg):
+    """
+    :return:dict with everything, that the parser takes from the header
+    """
+    return {
+        'size': (jpeg.width, jpeg.height),
+        'type': jpeg.type,
+        'reset_interval': jpeg.reset_interval,
+        'progressive': jpeg.progressive,
+        'components': [(c.identifier, c.h, c.v, c.destination) for c in jpeg.components],
+        'qtables_raw': dict((index, bytes(table)) for index, table in jpeg.qtables_raw.items()),
+        'htables_raw': dict((index, tuple(bytes(part) for part in table))
+                            for index, table in jpeg.htables_raw.items()),
+        'image_data': bytes(jpeg.image_data),
+    }
+
+
+class MemoryviewLoadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(IMAGE, 'rb') as file:
+            cls.data = file.read()
+        jpeg = JpegFile()
+        assert jpeg.load_data(cls.data)
+        cls.expected = header_fields(jpeg)
+
+    def load(self, buffer, offset=0, end=0):
+        jpeg = JpegFile()
+        self.assertTrue(jpeg.load_data(buffer, offset, end))
+        return jpeg
+
+    def test_memoryview(self):
+        for buffer in (memoryview(self.data), memoryview(bytearray(self.data))):
+            self.assertEqual(header_fields(self.load(buffer)), self.expected)
+
+    def test_view_inside_larger_buffer(self):
+        buffer = bytearray(b'\0' * 100 + self.data + b'\0' * 100)
+        view = memoryview(buffer)
+        # Slice of a view, and offsets inside of it
+        self.assertEqual(header_fields(self.load(view[100:100 + len(self.data)])), self.expected)
+        self.assertEqual(header_fields(self.load(view, 100, 100 + len(self.data))), self.expected)
+
+    def test_image_data_is_not_copied(self):
+        buffer = bytearray(self.data)
+        jpeg = self.load(memoryview(buffer))
+        self.assertIsInstance(jpeg.image_data, memoryview)
+        self.assertIs(jpeg.image_data.obj, buffer)
+
+    def test_mmap(self):
+        with open(IMAGE, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            jpeg = self.load(mapped)
+            self.assertEqual(header_fields(jpeg), self.expected)
+            jpeg.release_data()
+        finally:
+            mapped.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
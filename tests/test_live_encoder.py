@@ -0,0 +1,66 @@
+from JpegFile import IncrementalScanEncoder
+from JpegRtpLiveStream import RawFrame, encode_bands
+import unittest
+
+"""
+Tests of incremental encoding of live frames, split to restart intervals
+Run from the repository root: python -m pytest tests/test_live_encoder.py
+"""
+
+WIDTH = 24
+HEIGHT = 44
+
+
+def make_pattern(seed):
+    """
+    :return:bytearray RGB pixels with a gradient, that depends on the seed
+    """
+    return bytearray((x * 7 + y * 3 + c * 50 + seed * 11) & 0xff
+                     for y in range(HEIGHT) for x in range(WIDTH) for c in range(3))
+
+
+def paint_rows(pixels, y_start, y_end, value):
+    stride = WIDTH * 3
+    pixels[y_start * stride:y_end * stride] = bytes([value]) * ((y_end - y_start) * stride)
+
+
+class IncrementalSpliceTest(unittest.TestCase):
+    def full_encode(self, pixels):
+        encoder = IncrementalScanEncoder(WIDTH, HEIGHT, 3, 75)
+        data, count = encoder.encode(RawFrame(WIDTH, HEIGHT, 'rgb', bytes(pixels)))
+        self.assertEqual(count, encoder.bands)
+        return data
+
+    def test_splice_matches_full_encode(self):
+        encoder = IncrementalScanEncoder(WIDTH, HEIGHT, 3, 75)
+        # The last band is shorter than the rest
+        self.assertEqual(encoder.bands, 6)
+        pixels = make_pattern(0)
+        data, count = encoder.encode(RawFrame(WIDTH, HEIGHT, 'rgb', bytes(pixels)))
+        self.assertEqual(count, 6)
+        self.assertEqual(data, self.full_encode(pixels))
+
+        for y_start, y_end, value in ((8, 16, 200), (40, 44, 10), (0, 24, 90)):
+            paint_rows(pixels, y_start, y_end, value)
+            data, count = encoder.encode(RawFrame(WIDTH, HEIGHT, 'rgb', bytes(pixels)))
+            self.assertEqual(count, (y_end - y_start + 7) // 8)
+            self.assertEqual(data, self.full_encode(pixels))
+
+        # Unchanged frame is spliced from the previous intervals only
+        data, count = encoder.encode(RawFrame(WIDTH, HEIGHT, 'rgb', bytes(pixels)))
+        self.assertEqual(count, 0)
+        self.assertEqual(data, self.full_encode(pixels))
+
+    def test_worker_bands_match_full_encode(self):
+        encoder = IncrementalScanEncoder(WIDTH, HEIGHT, 3, 75)
+        pixels = make_pattern(1)
+        changed = encoder.changed_bands(bytes(pixels))
+        # Bands are encoded by workers from their own pixels, the same way as RtpJpegLiveStream does
+        bands = [encoder.band_pixels(index) for index in changed]
+        for index, data in zip(changed, encode_bands(WIDTH, 'rgb', 75, bands)):
+            encoder.update(index, data)
+        self.assertEqual(encoder.scan_data(), self.full_encode(pixels))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+from HttpMessage import RtspRequestParser
+import unittest
+
+"""
+Tests of the incremental RTSP request parser
+Run from the repository root: python -m pytest tests/test_rtsp_parser.py
+"""
+
+URL = 'rtsp://127.0.0.1:1025/image.jpg'
+
+
+def make_request(method, seq, headers=None, body=b''):
+    lines = ['%s %s RTSP/1.0' % (method, URL), 'CSeq: %d' % seq]
+    for name, value in (headers or []):
+        lines.append('%s: %s' % (name, value))
+    if body:
+        lines.append('Content-Length: %d' % len(body))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+def parse_all(parser):
+    messages = []
+    while True:
+        message = parser.next_message()
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+class RtspRequestParserTest(unittest.TestCase):
+    def test_single_request(self):
+        parser = RtspRequestParser()
+        parser.feed(make_request('OPTIONS', 1))
+        message = parser.next_message()
+        self.assertEqual(message.type, 'OPTIONS')
+        self.assertEqual(message.url_raw, URL)
+        self.assertEqual(message.seq, '1')
+        self.assertEqual(message.payload, b'')
+        self.assertIsNone(parser.next_message())
+        self.assertEqual(parser.buffered, 0)
+
+    def test_incomplete_head(self):
+        parser = RtspRequestParser()
+        data = make_request('DESCRIBE', 2)
+        parser.feed(data[:-3])
+        self.assertIsNone(parser.next_message())
+        parser.feed(data[-3:])
+        self.assertEqual(parser.next_message().type, 'DESCRIBE')
+
+    def test_body_split_across_feeds(self):
+        body = b'position\r\nscale\r\n'
+        data = make_request('GET_PARAMETER', 5, [('Content-Type', 'text/parameters')], body)
+        head_size = len(data) - len(body)
+        parser = RtspRequestParser()
+        # Head and a part of the body come first, the rest byte by byte
+        parser.feed(data[:head_size + 3])
+        self.assertIsNone(parser.next_message())
+        for index in range(head_size + 3, len(data) - 1):
+            parser.feed(data[index:index + 1])
+            self.assertIsNone(parser.next_message())
+        parser.feed(data[-1:])
+        message = parser.next_message()
+        self.assertEqual(message.type, 'GET_PARAMETER')
+        self.assertEqual(message.payload, body)
+        self.assertEqual(parser.buffered, 0)
+
+    def test_body_does_not_leak_into_next_request(self):
+        body = b'OPTIONS * RTSP/1.0\r\n\r\n'
+        data = make_request('SET_PARAMETER', 1, body=body) + make_request('TEARDOWN', 2)
+        parser = RtspRequestParser()
+        parser.feed(data)
+        messages = parse_all(parser)
+        self.assertEqual([message.type for message in messages], ['SET_PARAMETER', 'TEARDOWN'])
+        self.assertEqual(messages[0].payload, body)
+
+    def test_pipelined_requests(self):
+        requests = [make_request('OPTIONS', 1), make_request('DESCRIBE', 2, [('Accept', 'application/sdp')]),
+                    make_request('GET_PARAMETER', 3, body=b'position'), make_request('TEARDOWN', 4)]
+        parser = RtspRequestParser()
+        # Empty lines between requests are skipped
+        parser.feed(b'\r\n'.join(requests))
+        messages = parse_all(parser)
+        self.assertEqual([message.type for message in messages], ['OPTIONS', 'DESCRIBE', 'GET_PARAMETER', 'TEARDOWN'])
+        self.assertEqual([message.seq for message in messages], ['1', '2', '3', '4'])
+        self.assertEqual(messages[2].payload, b'position')
+
+    def test_pipelined_buffer_is_compacted(self):
+        data = make_request('GET_PARAMETER', 1, body=b'position')
+        parser = RtspRequestParser()
+        # Every chunk ends in the middle of a request, so the buffer is never consumed completely
+        parser.feed(data[:10])
+        for count in range(10000):
+            parser.feed(data[10:] + data[:10])
+            message = parser.next_message()
+            self.assertEqual(message.payload, b'position')
+            self.assertIsNone(parser.next_message())
+        self.assertEqual(parser.buffered, 10)
+        self.assertLessEqual(len(parser._buffer), RtspRequestParser.COMPACT_SIZE + 2 * len(data))
+
+    def test_compaction_keeps_pending_body(self):
+        filler = make_request('OPTIONS', 1)
+        body = b'x' * 100
+        data = make_request('SET_PARAMETER', 2, body=body)
+        parser = RtspRequestParser()
+        parser.feed(filler * (RtspRequestParser.COMPACT_SIZE // len(filler) + 1) + data[:-50])
+        messages = parse_all(parser)
+        self.assertTrue(all(message.type == 'OPTIONS' for message in messages))
+        # Consumed requests are dropped by this feed, while the body is pending
+        parser.feed(data[-50:])
+        self.assertLess(len(parser._buffer), len(data))
+        message = parser.next_message()
+        self.assertEqual(message.type, 'SET_PARAMETER')
+        self.assertEqual(message.payload, body)
+
+    def test_head_too_long(self):
+        parser = RtspRequestParser()
+        parser.feed(b'OPTIONS ' + b'a' * (RtspRequestParser.MAX_HEAD_SIZE + 1))
+        with self.assertRaises(ValueError):
+            parser.next_message()
+        # The broken request is dropped
+        self.assertEqual(parser.buffered, 0)
+        parser.feed(make_request('OPTIONS', 2))
+        self.assertEqual(parser.next_message().seq, '2')
+
+    def test_body_too_long(self):
+        parser = RtspRequestParser()
+        parser.feed(make_request('SET_PARAMETER', 1, [('Content-Length', RtspRequestParser.MAX_BODY_SIZE + 1)]))
+        with self.assertRaises(ValueError):
+            parser.next_message()
+
+    def test_invalid_content_length(self):
+        for value in ('abc', '-1'):
+            parser = RtspRequestParser()
+            parser.feed(make_request('SET_PARAMETER', 1, [('Content-Length', value)]))
+            with self.assertRaises(ValueError):
+                parser.next_message()
+
+    def test_invalid_content_length_drops_body(self):
+        body = b'OPTIONS * RTSP/1.0\r\nCSeq: 7\r\n\r\n'
+        for value in ('abc', RtspRequestParser.MAX_BODY_SIZE + 1):
+            parser = RtspRequestParser()
+            parser.feed(make_request('SET_PARAMETER', 1, [('Content-Length', value)]) + body)
+            with self.assertRaises(ValueError):
+                parser.next_message()
+            # Body is not taken for a request
+            self.assertIsNone(parser.next_message())
+            self.assertEqual(parser.buffered, 0)
+            parser.feed(make_request('OPTIONS', 2))
+            message = parser.next_message()
+            self.assertEqual(message.type, 'OPTIONS')
+            self.assertEqual(message.seq, '2')
+
+    def test_invalid_request_line(self):
+        parser = RtspRequestParser()
+        parser.feed(b'GARBAGE\r\n\r\n' + make_request('OPTIONS', 2))
+        with self.assertRaises(ValueError):
+            parser.next_message()
+        self.assertEqual(parser.next_message().type, 'OPTIONS')
+
+    def test_lazy_header_lookup(self):
+        parser = RtspRequestParser()
+        parser.feed(make_request('SETUP', 3, [('Transport', 'RTP/AVP;unicast;client_port=9100-9101'),
+                                              ('User-Agent', 'LibVLC/3.0.8')]))
+        message = parser.next_message()
+        # Lookups are case insensitive and do not parse all the headers
+        self.assertEqual(message.get('transport'), 'RTP/AVP;unicast;client_port=9100-9101')
+        self.assertEqual(message.get('Transport'), 'RTP/AVP;unicast;client_port=9100-9101')
+        self.assertIsNone(message._values)
+        self.assertIsNone(message.get('session'))
+        self.assertEqual(message.get('session', 'none'), 'none')
+        # Header name is not matched inside values of other headers
+        self.assertIsNone(message.get('client_port'))
+        # All the headers are parsed on demand, and agree with lookups
+        self.assertEqual(message.values['user-agent'], 'LibVLC/3.0.8')
+        self.assertEqual(message.values['cseq'], '3')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+from AdmissionControl import AdmissionControl
+from AssetCatalog import AssetCatalog
+from RtpFrameGenerator import RtpFrameGenerator
+from RtspServer import PLAYING, RtspServer
+from tornado import gen
+from tornado.tcpclient import TCPClient
+from tornado.testing import AsyncTestCase, gen_test
+import os
+import shutil
+import tempfile
+
+"""
+Tests of RTSP request handling, over a real connection
+Run from the repository root: python -m pytest tests/test_rtsp_server.py
+"""
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image.jpg')
+
+
+class SilentStream(RtpFrameGenerator):
+    """
+    Stream without frames. Its frames are estimated to be as many kilobytes, as the requested quality
+    """
+    def next_frame(self, variant=None):
+        return None
+
+    def frame_size(self, variant=None):
+        return 1000 * (variant or 1)
+
+
+class RtspServerTestCase(AsyncTestCase):
+    """
+    Serves a directory with a single jpeg. Streams of the factory record the requested paths, and send nothing
+    """
+    def setUp(self):
+        super(RtspServerTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        shutil.copy(IMAGE, os.path.join(self.root, 'image.jpg'))
+        self.catalog = AssetCatalog(self.root)
+        self.catalog.scan(workers=0)
+        self.opened = []
+        self.server = RtspServer(0, self.open_stream, catalog=self.catalog, rtp_port=0, **self.server_options())
+        self.port = list(self.server._sockets.values())[0].getsockname()[1]
+        self.cseq = 0
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.root)
+        super(RtspServerTestCase, self).tearDown()
+
+    def server_options(self):
+        return {}
+
+    def open_stream(self, path):
+        self.opened.append(path)
+        return SilentStream()
+
+    def connect(self):
+        return TCPClient().connect('127.0.0.1', self.port)
+
+    def request(self, connection, method, url, headers=None):
+        """
+        Sends a request and reads the response
+        :return:tuple (int status code, dict lowercase header name->value)
+        """
+        self.cseq += 1
+        lines = ['%s rtsp://127.0.0.1:%d%s RTSP/1.0' % (method, self.port, url), 'CSeq: %d' % self.cseq]
+        lines.extend('%s: %s' % item for item in (headers or {}).items())
+        connection.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        return self.read_response(connection)
+
+    @gen.coroutine
+    def read_response(self, connection):
+        head = (yield connection.read_until(b'\r\n\r\n')).decode()
+        lines = head.split('\r\n')
+        values = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                values[name.strip().lower()] = value.strip()
+        length = int(values.get('content-length', 0))
+        if length:
+            yield connection.read_bytes(length)
+        return int(lines[0].split(' ')[1]), values
+
+
+class SetupCatalogTest(RtspServerTestCase):
+    @gen_test
+    def test_path_outside_catalog(self):
+        connection = yield self.connect()
+        for path in ('/../../etc/hostname', '/missing.jpg', '/../image.jpg'):
+            code, values = yield self.request(connection, 'SETUP', path,
+                                              {'Transport': 'RTP/AVP;unicast;client_port=9100-9101'})
+            self.assertEqual(code, 404)
+        self.assertEqual(self.opened, [])
+        self.assertEqual(len(self.server.sessions), 0)
+
+    @gen_test
+    def test_cataloged_path(self):
+        connection = yield self.connect()
+        code, values = yield self.request(connection, 'SETUP', '/image.jpg',
+                                          {'Transport': 'RTP/AVP;unicast;client_port=9100-9101'})
+        self.assertEqual(code, 200)
+        self.assertEqual(self.opened, ['/image.jpg'])
+        self.assertEqual(len(self.server.sessions), 1)
+
+
+class SetupErrorTest(RtspServerTestCase):
+    @gen_test
+    def test_failed_setup_closes_session(self):
+        connection = yield self.connect()
+        for headers in ({}, {'Transport': 'RTP/AVP/TCP;interleaved=0-1'}):
+            code, values = yield self.request(connection, 'SETUP', '/image.jpg', headers)
+            self.assertEqual(code, 461)
+            self.assertEqual(len(self.server.sessions), 0)
+            self.assertEqual(len(self.server.clients), 0)
+        self.assertEqual(values['transport'], 'RTP/AVP/TCP;interleaved=0-1')
+        # Stream of the failed session is not held by it
+        stream = self.server._streams.get('/image.jpg')
+        self.assertFalse(self.server._is_stream_used(stream))
+
+    @gen_test
+    def test_failed_setup_keeps_session(self):
+        connection = yield self.connect()
+        code, values = yield self.request(connection, 'SETUP', '/image.jpg',
+                                          {'Transport': 'RTP/AVP;unicast;client_port=9100-9101'})
+        self.assertEqual(code, 200)
+        session = values['session'].split(';')[0]
+        code, values = yield self.request(connection, 'SETUP', '/image.jpg', {'Session': session})
+        self.assertEqual(code, 461)
+        self.assertIn(session, self.server.sessions)
+
+
+class AdmissionTest(RtspServerTestCase):
+    TRANSPORT = {'Transport': 'RTP/AVP;unicast;client_port=9100-9101'}
+
+    def server_options(self):
+        # One session of the default quality fits
+        bitrate = 1000 * 8 * RtpFrameGenerator.DEFAULT_FPS
+        return {'admission': AdmissionControl(max_sessions=2, max_bitrate=bitrate * 1.5)}
+
+    @gen_test
+    def test_refused_setup_keeps_session(self):
+        connection = yield self.connect()
+        code, values = yield self.request(connection, 'SETUP', '/image.jpg', self.TRANSPORT)
+        self.assertEqual(code, 200)
+        session = values['session'].split(';')[0]
+        code, values = yield self.request(connection, 'PLAY', '/image.jpg', {'Session': session})
+        self.assertEqual(code, 200)
+        client = self.server.sessions[session]
+        self.assertEqual(client.state, PLAYING)
+        # Higher quality does not fit, and the session keeps playing the old one
+        headers = dict(self.TRANSPORT, Session=session)
+        code, values = yield self.request(connection, 'SETUP', '/image.jpg?quality=2', headers)
+        self.assertEqual(code, 453)
+        self.assertIs(self.server.sessions[session], client)
+        self.assertEqual(client.state, PLAYING)
+        self.assertIsNone(client.quality)
+        self.assertEqual(client.rtp_ports, range(9100, 9101))
+        self.assertEqual(self.server._admission.refused, 1)
+
+    @gen_test
+    def test_refusal_counted_once(self):
+        connection = yield self.connect()
+        code, values = yield self.request(connection, 'SETUP', '/image.jpg', self.TRANSPORT)
+        self.assertEqual(code, 200)
+        # Egress limit is reached, while the session limit is not
+        other = yield self.connect()
+        code, values = yield self.request(other, 'SETUP', '/image.jpg', self.TRANSPORT)
+        self.assertEqual(code, 453)
+        self.assertEqual(len(self.server.sessions), 1)
+        self.assertEqual(self.server._admission.refused, 1)
+        # Session limit is reached. A viewer, refused by DESCRIBE and then by SETUP, is a single refusal
+        self.server._admission.max_sessions = 1
+        code, values = yield self.request(other, 'DESCRIBE', '/image.jpg')
+        self.assertEqual(code, 503)
+        code, values = yield self.request(other, 'SETUP', '/image.jpg', self.TRANSPORT)
+        self.assertEqual(code, 503)
+        self.assertEqual(self.server._admission.refused, 2)
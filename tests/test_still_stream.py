@@ -0,0 +1,71 @@
+from JpegRtpStillStream import RtpJpegFileStream
+import os
+import unittest
+
+"""
+Tests of still jpeg streams, whose image is replaced while they are played
+Run from the repository root: python -m pytest tests/test_still_stream.py
+"""
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image.jpg')
+
+
+def encode(qualities):
+    with open(IMAGE, 'rb') as file:
+        data = file.read()
+    return [(quality, data, None) for quality in qualities]
+
+
+def send_frame(stream, quality):
+    """
+    Sends the rest of the current frame of the variant
+    :return:int number of packets sent
+    """
+    count = 0
+    while True:
+        packet = stream.next_packet(quality)
+        count += 1
+        if packet.marker:
+            return count
+
+
+class ReplacedImageTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = RtpJpegFileStream(IMAGE, encoded=encode([50, 80]))
+
+    def test_variants_swap_at_their_boundaries(self):
+        stream = self.stream
+        first = stream.get_variant(80)
+        # Both variants are in the middle of a frame, when the image is replaced twice
+        stream.next_packet(50)
+        stream.next_packet(80)
+        stream.replace_variants(encode([50, 80]))
+        stream.replace_variants(encode([50, 80]))
+        latest = dict(stream._pending)
+        send_frame(stream, 80)
+        self.assertIs(stream.get_variant(80), first)
+        # Next frame of each variant is the latest image, however the variant is late
+        stream.next_packet(80)
+        self.assertIs(stream.get_variant(80), latest[80])
+        send_frame(stream, 50)
+        stream.next_packet(50)
+        self.assertIs(stream.get_variant(50), latest[50])
+        # Sequence of the RTP stream goes on across the images
+        self.assertEqual(stream.get_variant(80).seq, len(first.payloads) + 1)
+
+    def test_idle_variant_swaps_to_latest(self):
+        stream = self.stream
+        stream.replace_variants(encode([50, 80]))
+        send_frame(stream, 80)
+        stream.replace_variants(encode([50, 80]))
+        latest = dict(stream._pending)
+        # Variant, that was swapped already, and variant, that sent nothing, both get the latest image
+        for quality in (80, 50):
+            self.assertEqual(send_frame(stream, quality), len(latest[quality].payloads))
+            self.assertIs(stream.get_variant(quality), latest[quality])
+        # Swapped variants are not counted twice
+        self.assertEqual(stream.memory_size(), sum(variant.frame_size for variant in latest.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
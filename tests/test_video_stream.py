@@ -0,0 +1,96 @@
+from JpegRtpVideoStream import RtpJpegVideoStream
+from VideoStream import IndexedVideoFile
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+"""
+Tests of .mjpeg streams, whose files are changed while they are played
+Reading truncated pages of a mapped file kills the process by SIGBUS, so these tests crash rather than fail
+Run from the repository root: python -m pytest tests/test_video_stream.py
+"""
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image.jpg')
+
+
+def write_video(path, frames):
+    """
+    Writes .mjpeg file with length-prefixed copies of the test image, overwriting it in place
+    """
+    with open(IMAGE, 'rb') as file:
+        frame = file.read()
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+        file.truncate(0)
+        for i in range(frames):
+            file.write(b'%05d' % len(frame))
+            file.write(frame)
+    # Changes within the same timestamp tick are noticed as well
+    stats = os.stat(path)
+    os.utime(path, ns=(stats.st_atime_ns, stats.st_mtime_ns + 1000000))
+
+
+def next_frames(stream, count, timeout=5.0):
+    """
+    :return:list of frames, or less of them if the stream ended
+    """
+    frames = []
+    deadline = time.time() + timeout
+    while len(frames) < count and time.time() < deadline:
+        packets = stream.next_frame()
+        if packets is None:
+            if stream._finished:
+                break
+            time.sleep(0.005)
+            continue
+        frames.append(packets)
+    return frames
+
+
+class ChangedVideoTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'movie.mjpeg')
+        write_video(self.path, 40)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_truncated_frame_raises(self):
+        video = IndexedVideoFile(self.path)
+        self.assertEqual(len(video), 40)
+        video.frame(39).release()
+        write_video(self.path, 2)
+        video.frame(1).release()
+        with self.assertRaises(IOError):
+            video.frame(39)
+
+    def test_truncated_stream_ends(self):
+        stream = RtpJpegVideoStream(self.path, prefetch=4)
+        try:
+            self.assertEqual(len(next_frames(stream, 3)), 3)
+            write_video(self.path, 2)
+            # Frames, prepared before the change, are sent. Then the stream ends instead of faulting
+            frames = next_frames(stream, 40)
+            self.assertLess(len(frames), 40)
+            self.assertTrue(stream._finished)
+        finally:
+            stream.close()
+
+    def test_reopen(self):
+        stream = RtpJpegVideoStream(self.path, prefetch=4)
+        try:
+            self.assertEqual(len(next_frames(stream, 3)), 3)
+            write_video(self.path, 2)
+            stream.reopen()
+            self.assertEqual(len(stream.video), 2)
+            # Position is past the end of the new file, so it starts over, and loops
+            self.assertEqual(len(next_frames(stream, 10)), 10)
+            self.assertEqual(stream.position()[0], 1 / stream.fps)
+        finally:
+            stream.close()
+
+
+if __name__ == '__main__':
+    unittest.main()